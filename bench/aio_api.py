@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Compare sync osv.api with async osv.aio, driving many VMs (fake OSv REST servers) from one process.
+Each VM gets count env vars and one app started.
+
+Run from top source directory:
+    python -m bench.aio_api --vms 32 --count 20 --latency 0.005
+'''
+
+import argparse
+import threading
+from time import time
+
+from osv import api, aio
+from test.fake_osv import FakeOsv
+
+
+def sync_one_vm(vm, env, workers):
+    api.EnvAll(vm).set_many(env, workers=workers)
+    api.App(vm, '/usr/bin/app.so').run()
+
+
+def aio_one_vm(vm, env, workers):
+    yield aio.EnvAll(vm).set_many(env, workers=workers)
+    yield aio.App(vm, '/usr/bin/app.so').run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Many VMs, sync api vs async api')
+    parser.add_argument('--vms', type=int, default=32, help='number of fake VMs')
+    parser.add_argument('--count', type=int, default=20, help='env vars per VM')
+    parser.add_argument('--latency', type=float, default=0.005, help='fake server latency per request [s]')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent requests per VM')
+    args = parser.parse_args()
+
+    env = dict([('VAR_%d' % ii, 'value_%d' % ii) for ii in range(args.count)])
+    fakes = [FakeOsv(latency=args.latency).start() for ii in range(args.vms)]
+    try:
+        # sequential over VMs, set_many uses worker threads
+        vms = [fake.vm() for fake in fakes]
+        t0 = time()
+        for vm in vms:
+            sync_one_vm(vm, env, args.workers)
+        t_seq = time() - t0
+
+        # one thread per VM
+        vms = [fake.vm() for fake in fakes]
+        t0 = time()
+        threads = [threading.Thread(target=sync_one_vm, args=(vm, env, args.workers)) for vm in vms]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        t_threads = time() - t0
+
+        # all VMs in one event loop
+        vms = [fake.vm() for fake in fakes]
+        t0 = time()
+        aio.run(aio.wait_all([aio.spawn(aio_one_vm(vm, env, args.workers)) for vm in vms]))
+        t_aio = time() - t0
+        aio_connections = sum([aio.http_stats(vm)['new_connections'] for vm in vms])
+    finally:
+        for fake in fakes:
+            fake.stop()
+
+    requests = args.vms * (args.count + 2)
+    print '%d VMs, %d env vars each, %d requests, latency %.3f s' % (args.vms, args.count, requests, args.latency)
+    print '  sync, VM after VM:     %8.4f s, %6.0f req/s, up to %d threads' % \
+        (t_seq, requests / t_seq, args.workers + 1)
+    print '  sync, thread per VM:   %8.4f s, %6.0f req/s, up to %d threads' % \
+        (t_threads, requests / t_threads, args.vms * (args.workers + 1) + 1)
+    print '  aio, one event loop:   %8.4f s, %6.0f req/s, 1 thread, %d connections' % \
+        (t_aio, requests / t_aio, aio_connections)
+
+
+if __name__ == '__main__':
+    main()
+
+##
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Console scanner throughput (MB/s), on recorded console capture.
+Capture is boot log followed by application output, repeated up to --size MB.
+
+Run from top source directory:
+    python -m bench.console_scan --size 64
+    python -m bench.console_scan --capture /path/to/console.log
+'''
+
+import argparse
+import os.path
+from time import time
+
+from osv.vm import CMD_PROMPT_PATTERN, IP_PATTERN
+from osv.console import ConsoleScanner
+
+BOOT_LOG = os.path.join(os.path.dirname(__file__), '../test/data/osv-boot-console.log')
+
+
+# boot log + OpenFOAM-like solver output
+def make_capture(size_mb):
+    boot = open(BOOT_LOG).read()
+    step = ''.join(['Time = %d\r\n\r\n'
+                    'Courant Number mean: 0.222158 max: 0.852134\r\n'
+                    'smoothSolver:  Solving for Ux, Initial residual = 0.0538101, Final residual = 3.30571e-06, No Iterations 5\r\n'
+                    'smoothSolver:  Solving for Uy, Initial residual = 0.030925, Final residual = 2.30518e-06, No Iterations 5\r\n'
+                    'DICPCG:  Solving for p, Initial residual = 0.350612, Final residual = 9.06235e-07, No Iterations 35\r\n'
+                    'ExecutionTime = 0.19 s  ClockTime = 0 s\r\n\r\n' % ii for ii in range(100)])
+    data = boot + '\r\n'
+    while len(data) < size_mb * 1024 * 1024:
+        data += step
+    return data
+
+
+def scan(data, chunk_size, custom_matcher):
+    scanner = ConsoleScanner()
+    scanner.add_matcher('cmd_prompt', CMD_PROMPT_PATTERN, lambda mm: None, once=True, partial=True)
+    scanner.add_matcher('ip', IP_PATTERN, lambda mm: None, once=True)
+    if custom_matcher:
+        # never matches, so every line is scanned
+        scanner.add_matcher('error', r'^(Segmentation fault|Aborted|Assertion failed)', lambda mm: None)
+    t0 = time()
+    for ii in range(0, len(data), chunk_size):
+        scanner.feed(data[ii:ii+chunk_size])
+    return time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Console scanner throughput')
+    parser.add_argument('--size', type=int, default=32, help='size of generated capture in MB')
+    parser.add_argument('--capture', help='use recorded console log instead of generated one')
+    parser.add_argument('--chunk', type=int, default=4096, help='read size in bytes')
+    args = parser.parse_args()
+
+    if args.capture:
+        data = open(args.capture).read()
+    else:
+        data = make_capture(args.size)
+    size_mb = len(data) / (1024.0 * 1024.0)
+    print 'capture %.1f MB, chunk %d bytes' % (size_mb, args.chunk)
+    for custom_matcher in [False, True]:
+        dt = scan(data, args.chunk, custom_matcher)
+        name = 'built-in + custom matcher' if custom_matcher else 'built-in matchers'
+        print '  %-28s %8.1f MB/s' % (name, size_mb / dt)
+
+
+if __name__ == '__main__':
+    main()
+
+##
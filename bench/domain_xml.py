@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Per-launch cost of domain XML rendering and libvirt domain start/cleanup:
+  - template loaded for each launch (old path) vs cached compiled template
+  - defineXML + create + destroy + undefine vs transient createXML + destroy
+
+Default libvirt URI is the test driver (test:///default), no libvirtd is needed.
+
+Run from top source directory:
+    python -m bench.domain_xml --count 200
+'''
+
+import argparse
+from time import time
+from jinja2 import Environment, PackageLoader
+
+from osv import VM
+from osv import connection
+
+
+def render_uncached(vm):
+    tmpl_env = Environment(loader=PackageLoader('lin_proxy', 'templates'))
+    template = tmpl_env.get_template('osv-libvirt.template.xml')
+    return template.render(vm={'name': vm._param._vm_name})
+
+
+def render_cached(vm):
+    return vm._domain_xml()
+
+
+def xml_for_uri(vm, uri):
+    xml = vm._domain_xml()
+    if uri.startswith('test:'):
+        # test driver supports only domain type 'test'
+        xml = xml.replace("<domain type='kvm'", "<domain type='test'", 1)
+    return xml
+
+
+def start_persistent(conn, xml):
+    dom = conn.defineXML(xml)
+    dom.create()
+    dom.destroy()
+    dom.undefine()
+
+
+def start_transient(conn, xml):
+    dom = conn.createXML(xml, 0)
+    dom.destroy()
+
+
+def measure(func, args_list):
+    t0 = time()
+    for args in args_list:
+        func(*args)
+    return (time() - t0) / len(args_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Domain XML render and start/cleanup cost per launch')
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--uri', default='test:///default')
+    args = parser.parse_args()
+
+    vms = [VM() for ii in range(args.count)]
+    print 'per launch [ms], %d launches' % args.count
+    print '  render, template loaded each time:   %8.3f' % (1000 * measure(render_uncached, [(vm,) for vm in vms]))
+    print '  render, cached template:             %8.3f' % (1000 * measure(render_cached, [(vm,) for vm in vms]))
+
+    conn = connection.get(args.uri)
+    xmls = [xml_for_uri(vm, args.uri) for vm in vms]
+    print '  defineXML + create + destroy + undefine: %8.3f' % (1000 * measure(start_persistent, [(conn, xml) for xml in xmls]))
+    print '  createXML + destroy (transient):         %8.3f' % (1000 * measure(start_transient, [(conn, xml) for xml in xmls]))
+    connection.close_all()
+
+
+if __name__ == '__main__':
+    main()
+
+##
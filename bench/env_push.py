@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+'''
+Compare sequential Env(name).set() with EnvAll.set_many(), against fake OSv REST server.
+
+Run from top source directory:
+    python -m bench.env_push --count 100 --latency 0.002
+'''
+
+import argparse
+from time import time
+
+from osv import Env, EnvAll
+from test.fake_osv import FakeOsv
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Env push latency, sequential vs set_many')
+    parser.add_argument('--count', type=int, default=100, help='number of env vars')
+    parser.add_argument('--latency', type=float, default=0.002, help='fake server latency per request [s]')
+    parser.add_argument('--workers', type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict([('VAR_%d' % ii, 'value_%d' % ii) for ii in range(args.count)])
+    fake = FakeOsv(latency=args.latency).start()
+    try:
+        vm = fake.vm()
+        EnvAll(vm).wait_up()
+
+        t0 = time()
+        for name, value in env.items():
+            Env(vm, name).set(value)
+        t_seq = time() - t0
+
+        t0 = time()
+        EnvAll(vm).set_many(env, workers=args.workers)
+        t_many = time() - t0
+    finally:
+        fake.stop()
+
+    print '%d vars, latency %.3f s' % (args.count, args.latency)
+    print '  sequential set: %8.4f s' % t_seq
+    print '  set_many:       %8.4f s (workers %d)' % (t_many, args.workers)
+    print '  speedup:        %8.2f x' % (t_seq / t_many)
+
+
+if __name__ == '__main__':
+    main()
+
+##
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Measure how VM image preparation time (part of VM launch) depends on image size,
+for full image copy and for qcow2 overlay.
+
+Run from top source directory:
+    python -m bench.image_copy --sizes 64,256,1024
+'''
+
+import argparse
+import os
+import os.path
+import tempfile
+import shutil
+from subprocess import check_call
+from time import time
+
+from osv import VMParam
+import osv.settings as settings
+
+
+# qcow2 image with size_mb of (random, incompressible) data
+def make_image(path, size_mb):
+    raw = path + '.raw'
+    chunk = os.urandom(1024 * 1024)
+    with open(raw, 'wb') as fout:
+        for ii in range(size_mb):
+            fout.write(chunk)
+    check_call([settings.OSV_QEMU_IMG, 'convert', '-q', '-f', 'raw', '-O', 'qcow2', raw, path])
+    os.remove(raw)
+
+
+def measure(image, mode, repeat):
+    times = []
+    for ii in range(repeat):
+        t0 = time()
+        vmp = VMParam(image=image, use_image_copy=True, image_copy_mode=mode)
+        times.append(time() - t0)
+        vmp.remove_image_copy()
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Image copy vs overlay launch cost')
+    parser.add_argument('--sizes', default='64,256,1024', help='comma separated image sizes in MiB')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--work-dir', default=settings.OSV_WORK_DIR,
+                        help='where copies/overlays are created (default OSV_WORK_DIR)')
+    args = parser.parse_args()
+
+    settings.OSV_WORK_DIR = args.work_dir
+    if not os.path.isdir(settings.OSV_WORK_DIR):
+        os.mkdir(settings.OSV_WORK_DIR)
+    img_dir = tempfile.mkdtemp(dir=settings.OSV_WORK_DIR)
+    try:
+        print '%10s %14s %14s %14s %14s' % ('size[MiB]', 'copy min[s]', 'copy avg[s]', 'overlay min[s]', 'overlay avg[s]')
+        for size_mb in [int(ss) for ss in args.sizes.split(',')]:
+            image = os.path.join(img_dir, 'base-%d.img' % size_mb)
+            make_image(image, size_mb)
+            copy_min, copy_avg = measure(image, VMParam.IMAGE_COPY, args.repeat)
+            overlay_min, overlay_avg = measure(image, VMParam.IMAGE_OVERLAY, args.repeat)
+            print '%10d %14.4f %14.4f %14.4f %14.4f' % (size_mb, copy_min, copy_avg, overlay_min, overlay_avg)
+            os.remove(image)
+    finally:
+        shutil.rmtree(img_dir)
+
+
+if __name__ == '__main__':
+    main()
+
+##
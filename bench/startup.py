@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+lin_proxy.py startup cost - lin_proxy runs once per orted launch, each time in a fresh interpreter:
+  - import: import lin_proxy (with conf.settings)
+  - first libvirt call: from start of import to libvirt connection open, on lin_proxy launch path
+    (parse args, admit, VM image setup, VM start)
+  - start: from start of import until VM domain is started
+Heavy modules (requests, jinja2, ...) should be imported only on paths which need them, those
+imported by lin_proxy itself are listed.
+
+.pyc files are compiled before timing (a clean checkout, or PYTHONDONTWRITEBYTECODE, would
+otherwise compile all modules in each run), and one untimed run warms page cache. Best of runs
+is reported, it depends on host load much less than median.
+
+libvirt is replaced by test.fake_libvirt, imgedit.py by a no-op script (see bench.suite.setup).
+
+Run from top source directory:
+    python -m bench.startup --runs 20
+'''
+
+import argparse
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['requests', 'jinja2', 'psutil', 'distutils.version', 'argparse']
+
+# runs in new interpreter, prints times (seconds) as last line of stdout
+CHILD = r'''
+import sys
+from time import time
+from test import fake_libvirt
+fake_libvirt.install()
+first_call = []
+def _open(name=None, _orig_open=fake_libvirt.open):
+    first_call.append(time())
+    return _orig_open(name)
+fake_libvirt.open = _open
+sys.argv = [%(top_dir)r + '/lin_proxy.py', '/usr/lib/app.so']
+
+t0 = time()
+import lin_proxy
+t_import = time()
+heavy = [name for name in %(heavy)r if name in sys.modules]
+
+# conf/local_settings.py (if any) is overridden by bench settings
+import local_settings
+import osv.settings
+import osv.ledger
+for name in dir(local_settings):
+    if name.isupper():
+        setattr(lin_proxy.settings, name, getattr(local_settings, name))
+osv.settings.update(vars(local_settings))
+lin_proxy.make_work_dir()
+args = lin_proxy.parse_args()
+lin_proxy.admit(args)
+vm = lin_proxy.VM(**lin_proxy.vm_kwargs(args.image, args.cpus, args.memory))
+vm.edit_image()
+vm.start()
+t_start = time()
+vm._vm.destroy()
+vm.terminate()
+osv.ledger.release(args.ledger_id)
+print
+print repr({'import': t_import - t0, 'first_call': first_call[0] - t0, 'start': t_start - t0, 'heavy': heavy})
+'''
+
+
+def write_settings(settings_dir):
+    """
+    Write local_settings.py for lin_proxy with osv settings of bench (fake OSv source tree and work dir).
+    """
+    import osv.settings as settings
+    names = ['OSV_SRC', 'OSV_WORK_DIR', 'OSV_QEMU_IMG', 'OSV_LIBVIRT_URI', 'OSV_PIN_CPUS']
+    with open(os.path.join(settings_dir, 'local_settings.py'), 'w') as fout:
+        for name in names:
+            fout.write('%s = %r\n' % (name, getattr(settings, name)))
+        fout.write('OSV_TRACE = False\n')
+        fout.write('POOL_USE = False\n')
+        fout.write('LOG_FILE = %r\n' % os.path.join(settings_dir, 'lin_proxy.log'))
+
+
+def compile_sources(settings_dir):
+    """
+    Write .pyc of lin_proxy, osv modules and bench settings, timed runs only load them.
+    """
+    import compileall
+    import py_compile
+    py_compile.compile(os.path.join(TOP_DIR, 'lin_proxy.py'), doraise=True)
+    for path in [os.path.join(TOP_DIR, name) for name in ['conf', 'osv', 'test']] + [settings_dir]:
+        compileall.compile_dir(path, maxlevels=0, quiet=1)
+
+
+def best(runs, name):
+    return min([run[name] for run in runs])
+
+
+def measure(work_dir, image, runs):
+    """
+    Run lin_proxy startup runs times, each in new interpreter. Return list of dicts with
+    import, first_call and start (seconds), and heavy (modules imported by lin_proxy).
+    """
+    import ast
+    import osv.settings as settings
+    settings_dir = os.path.join(work_dir, 'startup')
+    os.mkdir(settings_dir)
+    write_settings(settings_dir)
+    compile_sources(settings_dir)
+    # lin_proxy VM image
+    image_dir = os.path.join(settings.OSV_SRC, 'build/debug')
+    if not os.path.isdir(image_dir):
+        os.makedirs(image_dir)
+    shutil.copy(image, os.path.join(image_dir, 'usr.img'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([settings_dir] + [path for path in [env.get('PYTHONPATH')] if path])
+    code = CHILD % {'top_dir': TOP_DIR, 'heavy': HEAVY}
+    results = []
+    # first run is not timed
+    for ii in range(runs + 1):
+        proc = Popen([sys.executable, '-c', code], cwd=TOP_DIR, env=env, stdout=PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError('lin_proxy startup run failed, exit status %d' % proc.returncode)
+        results.append(ast.literal_eval(out.splitlines()[-1]))
+    return results[1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lin_proxy import and time to first libvirt call')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    # before anything imports osv
+    from test import fake_libvirt
+    fake_libvirt.install()
+    from bench.suite import setup
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        runs = measure(work_dir, setup(work_dir), args.runs)
+    finally:
+        shutil.rmtree(work_dir)
+    print 'best [ms] of %d runs' % args.runs
+    for name in ['import', 'first_call', 'start']:
+        print '  %-12s %8.1f' % (name, 1000 * best(runs, name))
+    print '  heavy modules imported by lin_proxy: %s' % (', '.join(runs[0]['heavy']) or 'none')
+
+
+if __name__ == '__main__':
+    main()
+
+##
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+'''
+Offline benchmark suite - overhead of osv itself, no KVM, libvirtd or OSv source tree needed.
+libvirt is replaced by test.fake_libvirt (started domain replays recorded boot console log),
+OSv REST api by test.fake_osv, and scripts/imgedit.py by a no-op script.
+
+Metrics are compared with bench/baselines.json, exit status is 1 if any metric is worse
+than its baseline by more than --tolerance. Baselines depend on the host, refresh them with
+--save-baseline after an intended change or on a new host. Startup (bench.startup) also fails
+if lin_proxy imports any of the heavy modules, which are to be imported only when needed.
+
+Boot and restore take no time by default, so launch_ms and restore_ms are osv overhead only.
+With --boot-seconds larger than --restore-seconds, restore also fails if it is not faster than
+cold boot. Launches are sequential, so each one restores the same snapshot. A snapshot keeps MAC,
+IP and UUID of the saved VM and is used by one VM at a time - N concurrent VMs are restored only
+after N VMs were cold booted (and saved), this benchmark does not show that.
+
+Run from top source directory:
+    python -m bench.suite
+    python -m bench.suite --only launch --phases
+    python -m bench.suite --only launch,restore --boot-seconds 1
+    python -m bench.suite --only startup --startup-runs 50
+    python -m bench.suite --save-baseline
+'''
+
+import argparse
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import platform
+from time import time
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+# name, unit, higher is better, checked against baseline (tail latency is too noisy for that)
+METRICS = [
+    ('launch_ms', 'ms', False, True),
+    ('launch_p90_ms', 'ms', False, False),
+    ('restore_ms', 'ms', False, True),
+    ('startup_import_ms', 'ms', False, True),
+    ('startup_first_call_ms', 'ms', False, True),
+    ('api_calls_per_s', 'calls/s', True, True),
+    ('api_batch_calls_per_s', 'calls/s', True, True),
+    ('console_mb_per_s', 'MB/s', True, True),
+    ('forward_mb_per_s', 'MB/s', True, True),
+    ('get_dir_mb_per_s', 'MB/s', True, True),
+]
+
+
+class _Quiet:
+    """
+    Redirect stdout (VM.edit_image prints imgedit command) to /dev/null.
+    """
+    def __enter__(self):
+        sys.stdout.flush()
+        self._saved = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        sys.stdout.flush()
+        os.dup2(self._saved, 1)
+        os.close(self._saved)
+
+
+def setup(work_dir):
+    """
+    Point osv settings to fake OSv source tree and work dir, with a 1 MB image, and to a fake
+    qemu-img (only creates the overlay file). Return image path.
+    """
+    import osv.settings as settings
+    src = os.path.join(work_dir, 'osv-src')
+    os.makedirs(os.path.join(src, 'scripts'))
+    imgedit = os.path.join(src, 'scripts/imgedit.py')
+    with open(imgedit, 'w') as fout:
+        fout.write('#!/bin/sh\nexit 0\n')
+    os.chmod(imgedit, 0755)
+    qemu_img = os.path.join(work_dir, 'qemu-img')
+    with open(qemu_img, 'w') as fout:
+        fout.write('#!/bin/sh\nfor last; do true; done\n: > "$last"\n')
+    os.chmod(qemu_img, 0755)
+    settings.OSV_QEMU_IMG = qemu_img
+    settings.OSV_SRC = src
+    settings.OSV_WORK_DIR = os.path.join(work_dir, 'osv-work')
+    os.mkdir(settings.OSV_WORK_DIR)
+    settings.OSV_LIBVIRT_URI = 'fake:///bench'
+    settings.OSV_PIN_CPUS = False
+    image = os.path.join(work_dir, 'usr.img')
+    with open(image, 'wb') as fout:
+        fout.write('\0' * 1024 * 1024)
+    return image
+
+
+def bench_launch(image, count, boot_seconds, snapshot=False):
+    """
+    Full lin_proxy-like launch and terminate, return per-launch seconds.
+    With boot_seconds 0, all measured time is osv overhead.
+    With snapshot, VMs are restored from osv.snapshot - first launch boots and saves it, and is not measured.
+    """
+    from test import fake_libvirt
+    from test.fake_osv import FakeOsv
+    from osv import VM, VMParam
+    fake_libvirt.boot_seconds = boot_seconds
+    env = dict([('VAR_%d' % ii, 'value_%d' % ii) for ii in range(10)])
+    times = []
+    for ii in range(count + 1 if snapshot else count):
+        fake = FakeOsv().start()
+        try:
+            with _Quiet():
+                t0 = time()
+                vm = VM(image=image, use_image_copy=True, image_copy_mode=VMParam.IMAGE_COPY,
+                        net_ip='127.0.0.1/8', cpus=1, memory=256, snapshot=snapshot)
+                vm._api_port = fake.port
+                vm.edit_image()
+                vm.start()
+                fake.on_shutdown = vm._vm.shutdown
+                vm.wait_up()
+                vm.env_api().set_many(env)
+                vm.app_api('/usr/lib/app.so').run()
+                vm.terminate()
+                times.append(time() - t0)
+        finally:
+            fake.stop()
+    return times[1:] if snapshot else times
+
+
+def bench_api(count):
+    """
+    Return env set calls/s, sequential and with EnvAll.set_many.
+    """
+    from test.fake_osv import FakeOsv
+    from osv import Env, EnvAll
+    env = dict([('VAR_%d' % ii, 'value_%d' % ii) for ii in range(count)])
+    fake = FakeOsv().start()
+    try:
+        vm = fake.vm()
+        EnvAll(vm).wait_up()
+        t0 = time()
+        for name, value in env.items():
+            Env(vm, name).set(value)
+        t_seq = time() - t0
+        t0 = time()
+        EnvAll(vm).set_many(env)
+        t_many = time() - t0
+    finally:
+        fake.stop()
+    return count / t_seq, count / t_many
+
+
+def bench_console(size_mb):
+    from bench.console_scan import make_capture, scan
+    data = make_capture(size_mb)
+    return len(data) / (1024.0 * 1024.0) / scan(data, 4096, True)
+
+
+def bench_forward(work_dir, size_mb):
+    """
+    App console output to stdout file (lin_proxy after boot), return MB/s.
+    """
+    from osv import VM
+    console_log = os.path.join(work_dir, 'forward-console.log')
+    out_path = os.path.join(work_dir, 'forward-out')
+    with open(console_log, 'w') as fout:
+        line = 'Time = 0.1 residual 1e-6 ' + 'x' * 100 + '\r\n'
+        fout.write(line * (size_mb * 1024 * 1024 / len(line)))
+    vm = VM()
+    vm._console_log_fd = open(console_log)
+    # VM state after wait_up
+    vm._ip = '127.0.0.1'
+    vm._child_cmdline_up = True
+    try:
+        with open(out_path, 'w') as fout:
+            t0 = time()
+            size = vm.forward_std(fout.fileno())
+            dt = time() - t0
+    finally:
+        vm._console_log_fd.close()
+        os.unlink(console_log)
+        os.unlink(out_path)
+    return size / (1024.0 * 1024.0) / dt
+
+
+def bench_get_dir(work_dir, files, file_kb):
+    from test.fake_osv import FakeOsv
+    root = os.path.join(work_dir, 'vm-root')
+    for ii in range(files):
+        dir_path = os.path.join(root, 'data/dir%d' % (ii % 4))
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, 'file%d' % ii), 'wb') as fout:
+            fout.write(os.urandom(file_kb * 1024))
+    fake = FakeOsv(file_root=root).start()
+    try:
+        vm = fake.vm()
+        dest = os.path.join(work_dir, 'dest')
+        t0 = time()
+        stats = vm.file_api().get_dir('/data', dest)
+        dt = time() - t0
+    finally:
+        fake.stop()
+    return stats['bytes'] / (1024.0 * 1024.0) / dt
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def compare(results, baselines, tolerance):
+    """
+    Print results and baselines, return list of regressed metric names.
+    """
+    regressed = []
+    print '%-24s %12s %12s %8s' % ('metric', 'value', 'baseline', 'change')
+    for name, unit, higher_better, checked in METRICS:
+        if name not in results:
+            continue
+        value = results[name]
+        base = baselines.get(name)
+        line = '%-24s %12.2f' % (name, value)
+        if base:
+            change = (value - base) / base
+            worse = -change if higher_better else change
+            line += ' %12.2f %+7.1f%%' % (base, 100 * change)
+            if checked and worse > tolerance:
+                line += '  REGRESSION'
+                regressed.append(name)
+        print line + ' ' + unit
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline osv benchmark suite with fake libvirt and OSv')
+    parser.add_argument('--only', default='launch,restore,startup,api,console,forward,get_dir',
+                        help='comma separated benchmarks')
+    parser.add_argument('--launches', type=int, default=20)
+    parser.add_argument('--boot-seconds', type=float, default=0.0, help='replayed boot duration')
+    parser.add_argument('--restore-seconds', type=float, default=0.0, help='restore from saved state duration')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of throughput benchmarks')
+    parser.add_argument('--startup-runs', type=int, default=20, help='lin_proxy startups, each in new interpreter')
+    parser.add_argument('--api-calls', type=int, default=500)
+    parser.add_argument('--console-mb', type=int, default=16)
+    parser.add_argument('--files', type=int, default=64, help='get_dir files')
+    parser.add_argument('--file-kb', type=int, default=256, help='get_dir file size')
+    parser.add_argument('--phases', action='store_true', help='print launch phase percentiles (osv.trace)')
+    parser.add_argument('--console', default='file', choices=['file', 'stream'], help='OSV_CONSOLE_MODE of launch')
+    parser.add_argument('--image-cache', action='store_true', help='launch with OSV_IMAGE_CACHE')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed relative regression')
+    parser.add_argument('--save-baseline', action='store_true', help='store results to %s' % BASELINES)
+    args = parser.parse_args()
+    only = args.only.split(',')
+
+    # before anything imports osv
+    from test import fake_libvirt
+    fake_libvirt.install()
+    import simplejson
+    import osv.settings as settings
+    import osv.trace
+    import osv.imagecache
+    import osv.snapshot
+
+    work_dir = tempfile.mkdtemp()
+    results = {}
+    restore_slower = False
+    try:
+        image = setup(work_dir)
+        if 'launch' in only:
+            settings.OSV_TRACE = args.phases
+            settings.OSV_CONSOLE_MODE = args.console
+            settings.OSV_IMAGE_CACHE = args.image_cache
+            times = bench_launch(image, args.launches, args.boot_seconds)
+            results['launch_ms'] = 1000 * median(times)
+            results['launch_p90_ms'] = 1000 * osv.trace.percentile(times, 90)
+            if args.image_cache:
+                print 'Image cache: %(hits)d hits, %(misses)d misses, %(entries)d entries' % osv.imagecache.stats()
+            if args.phases:
+                print osv.trace.report(osv.trace.load(name='vm'))
+                print
+        if 'restore' in only:
+            # same launch, VM restored from saved state instead of booted
+            fake_libvirt.restore_seconds = args.restore_seconds
+            settings.OSV_TRACE = args.phases
+            settings.OSV_CONSOLE_MODE = args.console
+            settings.OSV_IMAGE_CACHE = args.image_cache
+            t0 = time()
+            times = bench_launch(image, args.launches, args.boot_seconds, snapshot=True)
+            results['restore_ms'] = 1000 * median(times)
+            stats = osv.snapshot.stats()
+            print 'Snapshot: %d saved, %d restored' % (stats['saves'], stats['hits'])
+            if args.phases:
+                print osv.trace.report([rec for rec in osv.trace.load(name='vm', since=t0)
+                                        if rec.get('snapshot') == 'restore'])
+                print
+            if 'launch_ms' in results:
+                # sequential launches - one VM per snapshot at a time, concurrent VMs need a snapshot each
+                print 'Restore vs cold boot: %.1f ms vs %.1f ms (boot %.2f s, restore %.2f s)' % \
+                    (results['restore_ms'], results['launch_ms'], args.boot_seconds, args.restore_seconds)
+                # with no boot time modeled, restore only trades imgedit for a libvirt restore
+                restore_slower = args.boot_seconds > args.restore_seconds and \
+                    results['restore_ms'] >= results['launch_ms']
+        heavy = []
+        if 'startup' in only:
+            import bench.startup
+            runs = bench.startup.measure(work_dir, image, args.startup_runs)
+            # best of runs, like throughput below
+            results['startup_import_ms'] = 1000 * bench.startup.best(runs, 'import')
+            results['startup_first_call_ms'] = 1000 * bench.startup.best(runs, 'first_call')
+            heavy = sorted(set([name for run in runs for name in run['heavy']]))
+        # throughput is best of repeat runs, less noisy than average
+        if 'api' in only:
+            rates = [bench_api(args.api_calls) for ii in range(args.repeat)]
+            results['api_calls_per_s'] = max([seq for seq, many in rates])
+            results['api_batch_calls_per_s'] = max([many for seq, many in rates])
+        if 'console' in only:
+            results['console_mb_per_s'] = max([bench_console(args.console_mb) for ii in range(args.repeat)])
+        if 'forward' in only:
+            results['forward_mb_per_s'] = max([bench_forward(work_dir, args.console_mb * 4)
+                                               for ii in range(args.repeat)])
+        if 'get_dir' in only:
+            results['get_dir_mb_per_s'] = max([bench_get_dir(os.path.join(work_dir, 'get_dir%d' % ii),
+                                                             args.files, args.file_kb)
+                                               for ii in range(args.repeat)])
+    finally:
+        shutil.rmtree(work_dir)
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as fin:
+            baselines = simplejson.load(fin)
+    regressed = compare(results, baselines.get('metrics', {}), args.tolerance)
+    if heavy:
+        print 'lin_proxy imports heavy modules: %s' % ', '.join(heavy)
+        regressed.append('startup_heavy_modules')
+    if restore_slower:
+        print 'Restore from snapshot is not faster than cold boot'
+        regressed.append('restore_slower_than_boot')
+    if args.save_baseline:
+        baselines.setdefault('metrics', {}).update(results)
+        baselines['host'] = '%s, %s, python %s' % (platform.node(), platform.processor() or platform.machine(),
+                                                   platform.python_version())
+        with open(BASELINES, 'w') as fout:
+            simplejson.dump(baselines, fout, indent=2, sort_keys=True)
+            fout.write('\n')
+        print 'Baselines saved to %s' % BASELINES
+        return 0
+    if regressed:
+        print 'Regressed: %s' % ', '.join(regressed)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+##
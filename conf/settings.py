@@ -11,11 +11,6 @@ Within subnet, only IPs in range OSV_IP_SUBNET+[OSV_IP_MIN, OSV_IP_MAX] will are
 
 # NET_DHCP or NET_STATIC
 OSV_IP_MODE = VMParam.NET_DHCP
-# configuration for static IP - a random IP is picked from [OSV_IP_MIN, OSV_IP_MAX] range
-OSV_IP_SUBNET = '192.168.122.0'
-OSV_IP_MIN = 200
-OSV_IP_MAX = 250
-OSV_IP_MASK = 24
 OSV_GW = '192.168.122.1'
 OSV_NS = '192.168.122.1'
 
@@ -23,16 +18,29 @@ OSV_NS = '192.168.122.1'
 LOG_FILE = '/tmp/orted_lin_proxy.log'
 LOG_LEVEL = logging.DEBUG
 
+# lin_proxy claims pre-booted VM from pool (if osv_pool.py is running and has a VM ready)
+POOL_USE = True
+POOL_SIZE = 1  # number of ready VMs kept by osv_pool.py
+POOL_LOG_FILE = '/tmp/osv_pool.log'
+
 # Import OSV_* variables from osv.setting, then override them in local_settings
 # OSV_SRC, OSV_BRIDGE, OSV_CLI_APP, OSV_API_PORT, OSV_WORK_DIR
 from osv.settings import *
 
+# configuration for static IP - a free IP is leased from [OSV_IP_MIN, OSV_IP_MAX] range (see osv.lease)
+OSV_IP_SUBNET = '192.168.122.0'
+OSV_IP_MIN = 200
+OSV_IP_MAX = 250
+OSV_IP_MASK = 24
+
+# lin_proxy starts all VMs from the same image, a thin overlay is much cheaper than full copy
+OSV_IMAGE_COPY_MODE = VMParam.IMAGE_OVERLAY
+# transient domain does not need undefine, and is not left defined if lin_proxy crashes
+OSV_TRANSIENT_DOMAIN = True
+
 # update values
 from local_settings import *
 
-# osv.settings.OSV_SRC is separate var, update the value.
-# Ugly and bad?
+# osv modules read osv.settings, apply OSV_* values above (with local_settings) to it
 import osv.settings
-for name in osv.settings.__dict__:
-    if name.startswith('OSV_'):
-        osv.settings.__dict__[name] = globals()[name]
+osv.settings.update(globals())
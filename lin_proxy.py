@@ -4,13 +4,14 @@ import sys
 import os
 import logging
 import logging.config
-from time import sleep
 from os import environ
 from osv import VM, Env, VMParam
-from random import randint
-import argparse
+import osv.pool
+import osv.ledger
+import osv.trace
+import osv.ready
+import osv.completion
 from copy import deepcopy
-import psutil
 
 import conf.settings as settings
 
@@ -20,11 +21,24 @@ def copy_env(vm):
     Ignore variables without value (like SELINUX_LEVEL_REQUESTED on fedora) - http PUT would fail.
     """
     log = logging.getLogger(__name__)
+    env = {}
     for name in environ.keys():
         value = str(environ.get(name))
         ## log.info('Env %s = %s', name, value)
         if(value):
-            vm.env_api(name).set(value)
+            env[name] = value
+    vm.env_api().set_many(env)
+
+
+def default_vm_size():
+    """
+    Return cpus, memory (in MB) for new VM.
+    VM pool (osv_pool.py) uses same size, so that pooled VMs match lin_proxy VMs.
+    """
+    # just use all cpus, all memory ?
+    cpus, memory = osv.ledger.host_size()
+    memory = int(memory * 0.50)  # until some better idea
+    return cpus, memory
 
 
 def parse_args():
@@ -35,10 +49,7 @@ def parse_args():
     args.unsafe_cache = True
     args.image = settings.OSV_SRC + '/build/debug/usr.img'
 
-    # just use all cpus, all memory ?
-    args.cpus = psutil.cpu_count()
-    args.memory = psutil.virtual_memory().total / (1024*1024)
-    args.memory = int( args.memory * 0.50)  # until some better idea
+    args.cpus, args.memory = default_vm_size()
 
     args.env = []
     args.env = ['MPI_BUFFER_SIZE=2100100', 'TERM=xterm']
@@ -72,44 +83,37 @@ def parse_args():
     return args
 
 
-def get_network_param():
+def admit(args):
+    """
+    Get resources for VM - claim a pre-booted VM (args.pool_vm, its resources are held by osv_pool.py),
+    or allocate cpus/memory from host ledger (args.ledger_id). Waits or fails if host is full,
+    see OSV_LEDGER_POLICY.
+    """
     log = logging.getLogger(__name__)
-    net_mac = 'rand'
-
-    ## net_ip = settings.'192.168.122.%d/24' % randint(200, 250)
-    ip0 = settings.OSV_IP_SUBNET
-    ipmin = settings.OSV_IP_MIN
-    ipmax = settings.OSV_IP_MAX
-
-    # validate ipmin/max vs mask
-    ip_range_from_mask = 2**(32-settings.OSV_IP_MASK)
-    # for x.x.x.0/24, .1 is first valid IP, .254 is last valid IP
-    assert(ipmin <= ipmax)
-    assert(1 <= ipmin)
-    assert(ipmin <= (ip_range_from_mask-2))
-    assert(1 <= ipmax)
-    assert(ipmax <= (ip_range_from_mask-2))
-
-    ip0_bytes = [int(bb) for bb in ip0.split('.')]
-    ip0_i32 = ip0_bytes[0] * 256**3 + ip0_bytes[1] * 256**2 + ip0_bytes[2] * 256**1 + ip0_bytes[3]
-    assert(ip0_i32 % ip_range_from_mask == 0), 'subnet start IP is not aligned with mask'
-    ip_i32 = ip0_i32 + randint(ipmin, ipmax)
-    # split to individual bytes
-    ip_i32_cumsum = 0
-    ip_bytes = [0, 0, 0, 0]
-    for ii in range(4):
-        ip_bytes[ii] = (ip_i32 - ip_i32_cumsum) / 256**(3-ii)
-        ip_i32_cumsum += ip_bytes[ii] * 256**(3-ii)
-    net_ip = '%d.%d.%d.%d/%d' % (ip_bytes[0], ip_bytes[1], ip_bytes[2], ip_bytes[3], settings.OSV_IP_MASK)
+    args.pool_vm = None
+    args.ledger_id = None
+    if settings.POOL_USE:
+        args.pool_vm = osv.pool.claim(args.cpus, args.memory)
+    if args.pool_vm is None:
+        args.ledger_id = osv.ledger.allocate(args.cpus, args.memory)
+        log.info('Allocated %d cpus, %d MB from ledger, entry %s', args.cpus, args.memory, args.ledger_id)
 
+
+def get_network_param():
+    """
+    Return network params for new VM. IP and MAC are leased by VMParam (see osv.lease),
+    so concurrent lin_proxy processes never pick the same ones.
+    """
+    log = logging.getLogger(__name__)
+    net_mac = 'lease'
+    net_ip = 'lease'
     net_gw = settings.OSV_GW
     net_dns = settings.OSV_NS
     log.info('VM MAC %s, IP %s, GW %s, DNS %s', net_mac, net_ip, net_gw, net_dns)
     return net_mac, net_ip, net_gw, net_dns
 
 
-def main():
-    log = logging.getLogger(__name__)
+def make_work_dir():
     # OSV_WORK_DIR - where to put VM image files and console log.
     # /tmp/** and /var/tmp/** might be forbidded in default libvirtd apparmor profile, so don't use them.
     ## OSV_WORK_DIR = '/tmp/osv-work'  # apparmor problem
@@ -119,11 +123,13 @@ def main():
         os.mkdir(settings.OSV_WORK_DIR)
         # others need write perm (libvirt, kvm)
         os.chmod(settings.OSV_WORK_DIR, 0777)
-    args = parse_args()
-    #
-    # run new VM
-    # unsafe-cache for NFS mount
 
+
+def vm_kwargs(image, cpus, memory):
+    """
+    Return VM() kwargs for new VM, with new network params.
+    """
+    # unsafe-cache for NFS mount
     net_mac, net_ip, net_gw, net_dns = get_network_param()
     if settings.OSV_IP_MODE == VMParam.NET_DHCP:
         # if net_ip isn't set, DHCP will be used
@@ -134,53 +140,113 @@ def main():
     gdb_port = 0  # disable gdb
     # gdb_port = randint(10000, 20000) # enable gdb at rand port
 
+    return dict(debug=True,
+                image=image,
+                command='',
+                cpus=cpus,
+                memory=memory,
+                use_image_copy=True,
+                net_mac=net_mac, net_ip=net_ip, net_gw=net_gw, net_dns=net_dns,
+                gdb_port=gdb_port)
+
+
+def main():
+    # phase timings of this launch, see osv.trace and osv_trace.py
+    tr = osv.trace.begin('lin_proxy')
+    try:
+        status = _main(tr)
+    except BaseException as ex:
+        tr.finish('error', error=repr(ex))
+        raise
+    tr.finish()
+    return status
+
+
+def _main(tr):
+    log = logging.getLogger(__name__)
+    make_work_dir()
+    args = parse_args()
     osv_command = ' '.join(args.osv_command)
+    with tr.phase('admit'):
+        admit(args)
 
-    vm = VM(debug=True,
-            image=args.image,
-            command='',
-            cpus=args.cpus,
-            memory=args.memory,
-            use_image_copy=True,
-            net_mac=net_mac, net_ip=net_ip, net_gw=net_gw, net_dns=net_dns,
-            gdb_port=gdb_port)
-    stdout_data = vm.run(wait_up=True)
-    sys.stdout.write(stdout_data)
-    sys.stdout.flush()
-
-    # copy_env is not needed any more
-    # Now lin_proxy.py starts VM with orted.so, and orted.so will set up OpenMPI related env vars.
-    # copy_env(vm)
-    # Add additional env vars added by user (those required by the OpenFOAM app).
-    for env_var in args.env:
-        name, value = env_var.split('=', 1)
-        vm.env_api(name).set(value)
-
-    # osv_command = '/usr/lib/mpi_hello.so 192.168.122.1 8080'
-    log.info('Run program %s', osv_command)
-    if osv_command:
-        vm.app_api(osv_command).run()
-
-    # shutdown
-    # TODO Exit when osv_command finishes. Can that be detected via api?
-    ii = 0
-    while ii >= 0:
-        if ii%100 == 0:
-            log.info('lin_proxy wait on vm terminate')
-        if not vm.is_up():
-            log.info('lin_proxy VM not up')
-            break
-        stdout_data = vm.read_std()
-        sys.stdout.write(stdout_data)
+    # use pre-booted VM if osv_pool.py is running, else run new VM
+    vm = args.pool_vm
+    from_pool = vm is not None
+    if from_pool:
+        log.info('Using pool VM %s', vm._log_name())
+        vm._trace = tr
+        tr.set(vm=vm._param._vm_name, pool=True)
+    else:
+        vm = None
+        try:
+            vm = VM(tracer=tr, **vm_kwargs(args.image, args.cpus, args.memory))
+            vm.edit_image()
+            vm.start()
+        except Exception:
+            # remove image copy and release MAC/IP leases of VM which did not start
+            if vm:
+                vm.terminate()
+            osv.ledger.release(args.ledger_id)
+            raise
+        # VM holds the resources as long as it runs, even if lin_proxy dies
+        osv.ledger.attach(args.ledger_id, vm._param._vm_name)
+
+    # from here on, VM is handed back to osv_pool.py or terminated however lin_proxy ends
+    try:
+        if not from_pool:
+            try:
+                stdout_data = vm.wait_up(api=True)
+            except osv.ready.ReadyError as ex:
+                log.error('%s', ex)
+                # boot messages tell why VM did not come up
+                sys.stdout.write(ex.output)
+                sys.stdout.flush()
+                raise
+            sys.stdout.write(stdout_data)
+            sys.stdout.flush()
+
+        # copy_env is not needed any more
+        # Now lin_proxy.py starts VM with orted.so, and orted.so will set up OpenMPI related env vars.
+        # copy_env(vm)
+        # Add additional env vars added by user (those required by the OpenFOAM app).
+        env = dict([env_var.split('=', 1) for env_var in args.env])
+        # REST api wait is traced as a phase of its own, not as part of env push
+        vm.env_api().wait_up()
+        with tr.phase('env'):
+            vm.env_api().set_many(env)
+
+        # osv_command = '/usr/lib/mpi_hello.so 192.168.122.1 8080'
+        log.info('Run program %s', osv_command)
+        tid = None
+        if osv_command:
+            with tr.phase('app_run'):
+                tid = vm.app_api(osv_command).run()
+            log.info('Program thread id %s', tid)
+
+        # wait until program finishes (or VM goes down by itself), copying VM console to stdout
+        completion = osv.completion.AppCompletion(vm, tid)
         sys.stdout.flush()
-        ii += 1
-        sleep(0.1)
-    log.info('lin_proxy DONE')
-    vm.terminate()
-    sleep(1)
+        with tr.phase('app'):
+            completion.wait(out_fd=sys.stdout.fileno())
+        tr.set(app_exit=completion.reason, app_status=completion.status)
+        log.info('lin_proxy DONE, program %s, status %s', completion.reason, completion.status)
+        # release VM cpus/memory right away, do not leave idle VM running
+        if vm.is_up():
+            with tr.phase('poweroff'):
+                vm.os_api().poweroff()
+    finally:
+        if from_pool:
+            # osv_pool.py will destroy VM
+            osv.pool.release(vm)
+        else:
+            vm.terminate()
+            osv.ledger.release(args.ledger_id)
+    # exit status is known only if program printed OSV_APP_EXIT_PATTERN marker
+    return completion.status or 0
 
 
-def setup_logging():
+def setup_logging(log_file=None):
     LOGGING = {
         'version': 1,
         'disable_existing_loggers': True,
@@ -203,7 +269,7 @@ def setup_logging():
                 'level': 'DEBUG',
                 'class': 'logging.FileHandler',
                 'formatter': 'verbose',
-                'filename': settings.LOG_FILE,
+                'filename': log_file or settings.LOG_FILE,
             },
         },
         'loggers': {
@@ -225,7 +291,8 @@ if __name__ == '__main__':
     for arg in sys.argv:
         logger.info('  argv[%d] = %s', ii, arg)
         ii += 1
-    main()
-    logger.info('Done /*--------------------------------*/')
+    status = main()
+    logger.info('Done, exit status %d /*--------------------------------*/', status)
+    sys.exit(status)
 
 ##
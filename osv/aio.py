@@ -0,0 +1,847 @@
+'''
+Non-blocking REST api to access many OSv VMs from one thread.
+
+Python 2 has no asyncio, so a minimal epoll event loop is here.
+Coroutines are generators. A coroutine can yield:
+  - another coroutine (generator), to call it and get its result,
+  - a Task, to wait on it and get its result,
+  - sleep(seconds), or a socket wait (used internally by HttpConnection).
+A coroutine returns a value by raising Return(value).
+
+The api classes have the same names and semantics as in osv.api, but methods
+are coroutines:
+
+    def setup(vm):
+        yield aio.EnvAll(vm).set_many({'OMP_NUM_THREADS': '4'})
+        yield aio.App(vm, '/usr/bin/app.so').run()
+
+    aio.run(aio.wait_all([aio.spawn(setup(vm)) for vm in vms]))
+'''
+
+import os
+import sys
+import errno
+import select
+import socket
+import heapq
+import collections
+import threading
+import types
+import ast
+import logging
+from time import time
+from urllib import urlencode
+from uuid import uuid4
+import requests.exceptions
+import simplejson
+
+from osv import VM
+import settings
+import ready
+from api import ApiResponseError, ApiBatchError, env_var_split
+
+
+class Return(Exception):
+    """
+    Raise Return(value) to return value from coroutine.
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class _Wait:
+    # what a task is waiting on - fd readiness and/or deadline
+    def __init__(self, fd=None, events=0, deadline=None):
+        self.fd = fd
+        self.events = events
+        self.deadline = deadline
+        self.task = None
+        self.done = False
+
+
+def sleep(seconds):
+    return _Wait(deadline=time() + seconds)
+
+
+def _wait_fd(sock, events, timeout):
+    return _Wait(sock.fileno(), events, time() + timeout if timeout is not None else None)
+
+
+class Task:
+    """
+    Coroutine scheduled in Loop. Yield it from another coroutine to wait for its result.
+    """
+    def __init__(self, loop, coro):
+        self._loop = loop
+        self._stack = [coro]
+        self._joiners = []
+        self.done = False
+        self.result = None
+        self.exc_info = None
+
+    def _step(self, value, exc_info):
+        while True:
+            gen = self._stack[-1]
+            try:
+                if exc_info:
+                    yielded = gen.throw(*exc_info)
+                    exc_info = None
+                else:
+                    yielded = gen.send(value)
+            except (Return, StopIteration) as ret:
+                self._stack.pop()
+                value = getattr(ret, 'value', None)
+                if not self._stack:
+                    return self._finish(value, None)
+                continue
+            except Exception:
+                self._stack.pop()
+                value, exc_info = None, sys.exc_info()
+                if not self._stack:
+                    return self._finish(None, exc_info)
+                continue
+
+            value = None
+            if isinstance(yielded, types.GeneratorType):
+                self._stack.append(yielded)
+            elif isinstance(yielded, Task):
+                if not yielded.done:
+                    yielded._joiners.append(self)
+                    return
+                value, exc_info = yielded.result, yielded.exc_info
+            elif isinstance(yielded, _Wait):
+                self._loop._add_wait(self, yielded)
+                return
+            else:
+                exc_info = (TypeError, TypeError('Coroutine yielded %r' % (yielded,)), None)
+
+    def _finish(self, result, exc_info):
+        self.done = True
+        self.result = result
+        self.exc_info = exc_info
+        for task in self._joiners:
+            self._loop._ready.append((task, result, exc_info))
+        self._joiners = []
+
+
+class Loop:
+    """
+    Event loop, runs tasks until they wait on socket or timer.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._ready = collections.deque()  # (task, value, exc_info)
+        self._fd_waits = {}  # fd: _Wait
+        self._timers = []  # heap of (deadline, seq, _Wait)
+        self._seq = 0
+
+    def spawn(self, coro):
+        task = Task(self, coro)
+        self._ready.append((task, None, None))
+        return task
+
+    def run_until_complete(self, coro):
+        task = coro if isinstance(coro, Task) else self.spawn(coro)
+        while True:
+            self._run_ready()
+            if task.done:
+                break
+            self._poll()
+        if task.exc_info:
+            raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        return task.result
+
+    def _add_wait(self, task, wait):
+        wait.task = task
+        if wait.fd is not None:
+            self._epoll.register(wait.fd, wait.events)
+            self._fd_waits[wait.fd] = wait
+        if wait.deadline is not None:
+            self._seq += 1
+            heapq.heappush(self._timers, (wait.deadline, self._seq, wait))
+
+    def _wake(self, wait, exc_info=None):
+        wait.done = True
+        if wait.fd is not None:
+            self._epoll.unregister(wait.fd)
+            del self._fd_waits[wait.fd]
+        self._ready.append((wait.task, None, exc_info))
+
+    def _run_ready(self):
+        while self._ready:
+            task, value, exc_info = self._ready.popleft()
+            task._step(value, exc_info)
+
+    def _poll(self):
+        if not self._fd_waits and not self._timers:
+            raise RuntimeError('Event loop deadlock, no task can make progress')
+        timeout = -1
+        while self._timers and self._timers[0][2].done:
+            heapq.heappop(self._timers)
+        if self._timers:
+            timeout = max(self._timers[0][0] - time(), 0)
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            self._wake(self._fd_waits[fd])
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, wait = heapq.heappop(self._timers)
+            if wait.done:
+                continue
+            exc_info = None
+            if wait.fd is not None:
+                exc_info = (socket.timeout, socket.timeout('timed out'), None)
+            self._wake(wait, exc_info)
+
+
+_local = threading.local()
+
+
+def get_loop():
+    """
+    Return event loop of current thread.
+    """
+    if getattr(_local, 'loop', None) is None:
+        _local.loop = Loop()
+    return _local.loop
+
+
+def spawn(coro):
+    return get_loop().spawn(coro)
+
+
+def run(coro):
+    """
+    Run coroutine (or Task) until it completes, return its result.
+    """
+    return get_loop().run_until_complete(coro)
+
+
+def wait_all(tasks):
+    """
+    Coroutine, wait for all tasks and return list of results.
+    If some tasks failed, first exception is raised after all tasks are done.
+    """
+    results = []
+    first_exc_info = None
+    for task in tasks:
+        try:
+            result = yield task
+        except Exception:
+            result = None
+            if first_exc_info is None:
+                first_exc_info = sys.exc_info()
+        results.append(result)
+    if first_exc_info:
+        raise first_exc_info[0], first_exc_info[1], first_exc_info[2]
+    raise Return(results)
+
+
+def run_parallel(func, items, workers):
+    """
+    Coroutine, run coroutine func(item) for each item, at most workers at the same time.
+    Return dict with exception for each failed item.
+    """
+    errors = {}
+    items = collections.deque(items)
+
+    def worker():
+        while items:
+            item = items.popleft()
+            try:
+                yield func(item)
+            except Exception as ex:
+                errors[item] = ex
+
+    loop = get_loop()
+    yield wait_all([loop.spawn(worker()) for ii in range(min(workers, len(items)))])
+    raise Return(errors)
+
+
+class HttpResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers  # lowercase names
+        self.content = content
+
+
+class HttpConnection:
+    """
+    Non-blocking keep-alive HTTP/1.1 client connection.
+    """
+    RECV_SIZE = 64 * 1024
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.reusable = False
+        self._buf = ''
+
+    def connect(self, timeout):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        err = sock.connect_ex((self.host, self.port))
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            try:
+                yield _wait_fd(sock, select.EPOLLOUT, timeout)
+            except socket.timeout:
+                self.close()
+                raise requests.exceptions.ConnectTimeout('Connect to %s:%d timed out' % (self.host, self.port))
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.close()
+            raise requests.exceptions.ConnectionError('Connect to %s:%d failed: %s' %
+                                                      (self.host, self.port, os.strerror(err)))
+
+    def close(self):
+        self.reusable = False
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _send_all(self, data, timeout):
+        offset = 0
+        while offset < len(data):
+            try:
+                offset += self.sock.send(buffer(data, offset))
+            except socket.error as ex:
+                if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                yield _wait_fd(self.sock, select.EPOLLOUT, timeout)
+
+    def _recv(self, timeout):
+        # return data from buffer or socket, '' on EOF
+        if self._buf:
+            data, self._buf = self._buf, ''
+            raise Return(data)
+        while True:
+            try:
+                raise Return(self.sock.recv(self.RECV_SIZE))
+            except socket.error as ex:
+                if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            yield _wait_fd(self.sock, select.EPOLLIN, timeout)
+
+    def _read_until(self, delimiter, timeout):
+        data = ''
+        while True:
+            ii = data.find(delimiter)
+            if ii >= 0:
+                self._buf = data[ii + len(delimiter):] + self._buf
+                raise Return(data[:ii])
+            chunk = yield self._recv(timeout)
+            if not chunk:
+                raise requests.exceptions.ConnectionError('Connection closed by %s:%d' % (self.host, self.port))
+            data += chunk
+
+    def _read_body(self, size, sink, timeout):
+        # read size bytes (None - until EOF), into sink file or return them
+        parts = []
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk = yield self._recv(timeout)
+            if not chunk:
+                if remaining is None:
+                    break
+                raise requests.exceptions.ConnectionError('Connection closed by %s:%d' % (self.host, self.port))
+            if remaining is not None and len(chunk) > remaining:
+                self._buf = chunk[remaining:]
+                chunk = chunk[:remaining]
+            if remaining is not None:
+                remaining -= len(chunk)
+            if sink:
+                sink.write(chunk)
+            else:
+                parts.append(chunk)
+        raise Return(''.join(parts))
+
+    def request(self, method, path, body='', headers=None, timeout=None, sink=None):
+        """
+        Coroutine, send request and read response.
+        body is string, or list of strings and file objects (sent in chunks).
+        If sink is given, response body is written to sink file, not returned.
+        timeout is read timeout in seconds.
+        """
+        parts = body if isinstance(body, list) else [body]
+        length = 0
+        for part in parts:
+            length += len(part) if isinstance(part, str) else os.fstat(part.fileno()).st_size
+        head = '%s %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Length: %d\r\n' % (method, path, self.host, self.port, length)
+        for name, value in (headers or {}).items():
+            head += '%s: %s\r\n' % (name, value)
+        head += '\r\n'
+        self.reusable = False
+        try:
+            if len(parts) == 1 and isinstance(parts[0], str) and len(parts[0]) < self.RECV_SIZE:
+                # request in one segment
+                yield self._send_all(head + parts[0], timeout)
+            else:
+                yield self._send_all(head, timeout)
+                for part in parts:
+                    if isinstance(part, str):
+                        yield self._send_all(part, timeout)
+                        continue
+                    while True:
+                        chunk = part.read(self.RECV_SIZE)
+                        if not chunk:
+                            break
+                        yield self._send_all(chunk, timeout)
+
+            status_line = yield self._read_until('\r\n', timeout)
+            version, status, reason = (status_line.split(' ', 2) + [''])[:3]
+            resp_headers = {}
+            header_lines = yield self._read_until('\r\n\r\n', timeout)
+            for line in header_lines.split('\r\n'):
+                if line:
+                    name, value = line.split(':', 1)
+                    resp_headers[name.strip().lower()] = value.strip()
+
+            if method == 'HEAD' or status in ('204', '304'):
+                content = ''
+            elif resp_headers.get('transfer-encoding', '').lower() == 'chunked':
+                content = ''
+                while True:
+                    size_line = yield self._read_until('\r\n', timeout)
+                    size = int(size_line.split(';')[0], 16)
+                    if size == 0:
+                        yield self._read_until('\r\n', timeout)
+                        break
+                    content += yield self._read_body(size, sink, timeout)
+                    yield self._read_until('\r\n', timeout)
+            elif 'content-length' in resp_headers:
+                content = yield self._read_body(int(resp_headers['content-length']), sink, timeout)
+            else:
+                content = yield self._read_body(None, sink, timeout)
+                resp_headers['connection'] = 'close'
+        except socket.timeout:
+            self.close()
+            raise requests.exceptions.ReadTimeout('Read from %s:%d timed out' % (self.host, self.port))
+        except socket.error as ex:
+            self.close()
+            raise requests.exceptions.ConnectionError('Connection to %s:%d failed: %s' % (self.host, self.port, ex))
+        self.reusable = version == 'HTTP/1.1' and resp_headers.get('connection', '').lower() != 'close'
+        raise Return(HttpResponse(int(status), resp_headers, content))
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive connections to one VM.
+    """
+    def __init__(self, host, port, maxsize):
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self._idle = []
+        self.stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+
+    def request(self, method, path, body='', headers=None, timeout=None, sink=None):
+        """
+        Coroutine, send request over idle connection, or over a new one.
+        timeout is (connect, read) tuple or a single value.
+        """
+        if not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        if self._idle:
+            conn = self._idle.pop()
+            self.stats['reused_connections'] += 1
+        else:
+            conn = HttpConnection(self.host, self.port)
+            yield conn.connect(timeout[0])
+            self.stats['new_connections'] += 1
+        self.stats['requests'] += 1
+        try:
+            resp = yield conn.request(method, path, body, headers, timeout[1], sink)
+        finally:
+            if conn.reusable and len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+            else:
+                conn.close()
+        raise Return(resp)
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle = []
+
+
+def connection_pool(vm):
+    """
+    Return keep-alive connection pool of VM, shared by all async API objects of that VM.
+    """
+    if vm._aio_pool is None or (vm._aio_pool.host, vm._aio_pool.port) != (vm._ip, vm._api_port):
+        vm._aio_pool = ConnectionPool(vm._ip, vm._api_port, settings.OSV_API_POOL_SIZE)
+    return vm._aio_pool
+
+
+def http_stats(vm):
+    """
+    Return count of HTTP requests, new and reused connections for VM async connection pool.
+    """
+    if vm._aio_pool is None:
+        return {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+    return dict(vm._aio_pool.stats)
+
+
+def _default_timeout():
+    return settings.OSV_API_CONNECT_TIMEOUT, settings.OSV_API_READ_TIMEOUT
+
+
+class BaseApi:
+    def __init__(self, vm):
+        assert(isinstance(vm, VM))
+        self.vm = vm
+        self.base_path = ''
+
+    def wait_up(self):
+        """
+        As api.BaseApi.wait_up (ready.wait_ready with IP and api probes), but waits in event loop.
+        Wait until VM IP is known and REST api answers, at most OSV_API_READY_TIMEOUT seconds.
+        Raises ready.ReadyTimeout.
+        """
+        if self.vm._api_up:
+            return
+        log = logging.getLogger(__name__)
+        timeout = settings.OSV_API_READY_TIMEOUT
+        t0 = time()
+        deadline = t0 + timeout
+        errors = {}
+        delay = ready.API_RETRY_MIN
+        while True:
+            if not self.vm._ip and self.vm._vm:
+                self.vm.read_std()
+            if self.vm._ip:
+                try:
+                    # request does not outlive the deadline
+                    yield self._request('GET', '/os/uptime', retries=0, timeout=max(min(1.0, deadline - time()), 0.01))
+                    self.vm._api_up = True
+                    log.info('VM %s api up in %.3f s', self.vm._log_name(), time() - t0)
+                    return
+                except requests.exceptions.RequestException as ex:
+                    errors[ready.API] = str(ex)
+                    log.debug('API %s not up yet: %s', self.uri(), ex)
+            remaining = deadline - time()
+            if remaining <= 0:
+                pending = [ready.API] if self.vm._ip else [ready.IP, ready.API]
+                raise ready.ReadyTimeout('VM %s not ready after %.1f s, waiting for %s%s' %
+                                         (self.vm._log_name(), timeout, ', '.join(pending),
+                                          ''.join(['; %s: %s' % (probe, errors[probe]) for probe in pending
+                                                   if probe in errors])),
+                                         pending, errors, '')
+            # connection refused is retried after a short backoff, IP (from console) is checked as often
+            yield sleep(min(delay, remaining))
+            delay = min(2 * delay, ready.API_RETRY_MAX)
+
+    def uri(self):
+        return 'http://%s:%d' % (self.vm._ip, self.vm._api_port) + self.base_path
+
+    # Same retry rules as api.BaseApi._request. url is path only, host is the VM.
+    def _request(self, method, url, retries=None, timeout=None, **kwargs):
+        log = logging.getLogger(__name__)
+        if retries is None:
+            retries = settings.OSV_API_RETRIES
+        if timeout is None:
+            timeout = _default_timeout()
+        ii = 0
+        while True:
+            try:
+                resp = yield connection_pool(self.vm).request(method, url, timeout=timeout, **kwargs)
+                raise Return(resp)
+            except requests.exceptions.ConnectionError as ex:
+                if ii >= retries:
+                    raise
+                ii += 1
+                log.debug('HTTP %s %s failed (%s), retry %d/%d', method, url, ex, ii, retries)
+                yield sleep(0.1 * ii)
+
+    def _http(self, method, params, path_extra, **kwargs):
+        yield self.wait_up()
+        url_all = self.base_path + path_extra
+        if params:
+            url_all += '?' + urlencode(params)
+        resp = yield self._request(method, url_all, **kwargs)
+        if resp.status_code != 200:
+            raise ApiResponseError('HTTP call failed', resp)
+        raise Return(resp.content)
+
+    def http_get(self, params=None, path_extra='', **kwargs):
+        return self._http('GET', params, path_extra, **kwargs)
+
+    def http_post(self, params=None, data=None, path_extra='', **kwargs):
+        return self._http('POST', params, path_extra, body=data or '', **kwargs)
+
+    def http_put(self, params=None, data=None, path_extra='', **kwargs):
+        return self._http('PUT', params, path_extra, body=data or '', **kwargs)
+
+    def http_delete(self, path_extra='', **kwargs):
+        return self._http('DELETE', None, path_extra, **kwargs)
+
+
+class EnvAll(BaseApi):
+    def __init__(self, vm):
+        BaseApi.__init__(self, vm)
+        self.base_path = '/env'
+
+    # get all env vars
+    def get(self):
+        content = yield self.http_get(path_extra='/')
+        env = {}
+        for kk_vv in ast.literal_eval(content):
+            kk, vv = env_var_split(kk_vv)
+            env[kk] = vv
+        raise Return(env)
+
+    # set many env vars, env is dict name:value
+    def set_many(self, env, workers=None):
+        yield self.wait_up()
+        errors = yield run_parallel(lambda name: Env(self.vm, name).set(env[name]),
+                                    env.keys(), workers or settings.OSV_API_POOL_SIZE)
+        if errors:
+            raise ApiBatchError('Env set failed', errors)
+
+    def delete_many(self, names, workers=None):
+        yield self.wait_up()
+        errors = yield run_parallel(lambda name: Env(self.vm, name).delete(),
+                                    names, workers or settings.OSV_API_POOL_SIZE)
+        if errors:
+            raise ApiBatchError('Env delete failed', errors)
+
+
+class Env(BaseApi):
+    def __init__(self, vm, name):
+        BaseApi.__init__(self, vm)
+        self.base_path = '/env/' + name
+        self._name = name
+
+    def get(self):
+        content = yield self.http_get()
+        # value only, enclosed in ""
+        raise Return(content.strip('"'))
+
+    def set(self, value):
+        return self.http_post({'val': value})
+
+    # delete return HTTP 200 even if no such var is set
+    def delete(self):
+        return self.http_delete()
+
+
+class App(BaseApi):
+    # name - path to .so to run.
+    def __init__(self, vm, name):
+        BaseApi.__init__(self, vm)
+        self.base_path = '/app/'
+        self._name = name
+
+    def run(self):
+        assert(self._name)
+        # do not start app twice
+        return self.http_put({'command': self._name}, retries=0)
+
+
+class Os(BaseApi):
+    def __init__(self, vm):
+        BaseApi.__init__(self, vm)
+        self.base_path = '/os/'
+
+    # As api.Os, request times out when VM goes down.
+    def shutdown(self):
+        log = logging.getLogger(__name__)
+        log.info('http shutdown VM %s', self.vm._log_name())
+        try:
+            yield self.http_post(path_extra='shutdown', timeout=(30, 1), retries=0)
+        except Exception as ex:
+            log.info('Error should be ReadTimeout, msg %s', ex)
+
+    def poweroff(self):
+        log = logging.getLogger(__name__)
+        try:
+            yield self.http_post(path_extra='poweroff', timeout=(30, 1), retries=0)
+        except Exception as ex:
+            log.info('Error should be ReadTimeout, msg %s', ex)
+
+
+class File(BaseApi):
+    """
+    List, download and upload files and directories.
+    """
+    def __init__(self, vm):
+        BaseApi.__init__(self, vm)
+        self.base_path = '/file/'
+
+    # Without dest, return file content. With dest, file is streamed to dest and number of bytes is returned.
+    def _get_file(self, file_path, dest=None):
+        params = {'op': 'GET'}
+        if not dest:
+            content = yield self.http_get(params, path_extra=file_path)
+            raise Return(content)
+        # partially downloaded file must not look complete
+        dest_part = dest + '.part'
+        try:
+            with open(dest_part, 'wb') as fout:
+                yield self.http_get(params, path_extra=file_path, sink=fout)
+                size = fout.tell()
+        except Exception:
+            os.remove(dest_part)
+            raise
+        os.rename(dest_part, dest)
+        raise Return(size)
+
+    def _list_dir(self, dir_path):
+        content = yield self.http_get({'op': 'LISTSTATUS'}, path_extra=dir_path)
+        raise Return(simplejson.loads(content))
+
+    def get_dir(self, path, dest, workers=None):
+        """
+        Download VM dir path recursively to host dir dest, as api.File.get_dir.
+        Directories of one level are listed and files downloaded concurrently, by up to workers coroutines.
+        Files which already exist in dest with the same size are skipped.
+        Returns dict with download statistics.
+        """
+        log = logging.getLogger(__name__)
+        log.info('Downloading VM dir %s', path)
+        yield self.wait_up()
+        workers = workers or settings.OSV_API_POOL_SIZE
+        t0 = time()
+        stats = {'dirs': 0, 'files': 0, 'skipped': 0, 'bytes': 0, 'seconds': 0.0}
+        errors = {}
+        # VM path: (host path, is dir, size), next level is filled in while current one is downloaded
+        level = {path: (dest, True, None)}
+        while level:
+            next_level = {}
+
+            def get(vm_path):
+                host_path, is_dir, size = level[vm_path]
+                if is_dir:
+                    yield self._get_dir_entries(vm_path, host_path, next_level)
+                    stats['dirs'] += 1
+                    return
+                if size is not None and os.path.isfile(host_path) and os.path.getsize(host_path) == size:
+                    log.debug('Skip file %s, same size at destination', vm_path)
+                    stats['skipped'] += 1
+                else:
+                    log.debug('GET file %s', vm_path)
+                    nbytes = yield self._get_file(vm_path, host_path)
+                    stats['bytes'] += nbytes
+                stats['files'] += 1
+            level_errors = yield run_parallel(get, level.keys(), workers)
+            errors.update(level_errors)
+            level = next_level
+        stats['seconds'] = time() - t0
+        log.info('Downloaded VM dir %s: %d dirs, %d files (%d skipped), %.1f MB in %.2f s, %.1f MB/s',
+                 path, stats['dirs'], stats['files'], stats['skipped'], stats['bytes'] / 1e6, stats['seconds'],
+                 stats['bytes'] / 1e6 / max(stats['seconds'], 1e-6))
+        if errors:
+            raise ApiBatchError('Download failed', errors)
+        raise Return(stats)
+
+    def _get_dir_entries(self, path, dest, found):
+        # mkdir dest, add entries of VM dir path to found
+        log = logging.getLogger(__name__)
+        if not os.path.exists(dest):
+            log.info('host mkdir %s', dest)
+            os.mkdir(dest)
+        dir_content = yield self._list_dir(path)
+        for entry in dir_content:
+            name = entry['pathSuffix']
+            if entry['type'] == 'DIRECTORY':
+                if name in ['.', '..']:
+                    continue
+                if path == '/' and name in ['dev', 'proc']:
+                    # do not 'download' /dev/urandom etc
+                    dev_dir = os.path.join(dest, name)
+                    log.info('Only mkdir %s on destination side', dev_dir)
+                    if not os.path.exists(dev_dir):
+                        os.mkdir(dev_dir)
+                    continue
+                found[os.path.join(path, name)] = (os.path.join(dest, name), True, None)
+            elif entry['type'] == 'FILE':
+                found[os.path.join(path, name)] = (os.path.join(dest, name), False, entry.get('length'))
+            else:
+                log.error('Unknown type %s (json data %s)', entry['type'], simplejson.dumps(entry))
+
+    def _mkdirs(self, dir_path):
+        return self.http_put({'op': 'MKDIRS', 'createParent': 'true'}, path_extra=dir_path)
+
+    def put_file(self, src, dest_path):
+        """
+        Upload host file src to VM file dest_path. File is streamed, not read into memory.
+        Returns number of bytes uploaded.
+        """
+        boundary = uuid4().hex
+        head = '--%s\r\n' \
+               'Content-Disposition: form-data; name="file"; filename="%s"\r\n' \
+               'Content-Type: application/octet-stream\r\n\r\n' % (boundary, os.path.basename(dest_path))
+        tail = '\r\n--%s--\r\n' % boundary
+        with open(src, 'rb') as fin:
+            # body can be sent only once
+            yield self.http_post(data=[head, fin, tail], path_extra=dest_path, retries=0,
+                                 headers={'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+            size = os.fstat(fin.fileno()).st_size
+        raise Return(size)
+
+    def put_dir(self, src, dest_path, workers=None):
+        """
+        Upload host dir src recursively to VM dir dest_path, as api.File.put_dir.
+        Directories are created first, then files are uploaded concurrently, by up to workers coroutines.
+        Files which already exist in VM with the same size are skipped.
+        Returns dict with upload statistics.
+        """
+        log = logging.getLogger(__name__)
+        log.info('Uploading host dir %s to VM dir %s', src, dest_path)
+        yield self.wait_up()
+        workers = workers or settings.OSV_API_POOL_SIZE
+        t0 = time()
+        dirs = []
+        files = {}  # VM path: host path
+        # os.walk is top-down, parent dir is created before its subdirs
+        for root, dir_names, file_names in os.walk(src):
+            rel_dir = os.path.relpath(root, src)
+            vm_dir = dest_path if rel_dir == '.' else os.path.join(dest_path, rel_dir)
+            dirs.append(vm_dir)
+            for file_name in file_names:
+                files[os.path.join(vm_dir, file_name)] = os.path.join(root, file_name)
+        for vm_dir in dirs:
+            yield self._mkdirs(vm_dir)
+
+        # size of files already in VM
+        vm_sizes = {}
+
+        def list_dir(vm_dir):
+            entries = yield self._list_dir(vm_dir)
+            for entry in entries:
+                if entry['type'] == 'FILE':
+                    vm_sizes[os.path.join(vm_dir, entry['pathSuffix'])] = entry.get('length')
+        errors = yield run_parallel(list_dir, dirs, workers)
+
+        stats = {'dirs': len(dirs), 'files': len(files), 'skipped': 0, 'bytes': 0, 'seconds': 0.0}
+
+        def upload(vm_file):
+            host_file = files[vm_file]
+            if vm_sizes.get(vm_file) == os.path.getsize(host_file):
+                log.debug('Skip file %s, same size in VM', host_file)
+                stats['skipped'] += 1
+                return
+            log.debug('PUT file %s', vm_file)
+            nbytes = yield self.put_file(host_file, vm_file)
+            stats['bytes'] += nbytes
+        upload_errors = yield run_parallel(upload, files.keys(), workers)
+        errors.update(upload_errors)
+
+        stats['seconds'] = time() - t0
+        log.info('Uploaded host dir %s: %d dirs, %d files (%d skipped), %.1f MB in %.2f s, %.1f MB/s',
+                 src, stats['dirs'], stats['files'], stats['skipped'], stats['bytes'] / 1e6, stats['seconds'],
+                 stats['bytes'] / 1e6 / max(stats['seconds'], 1e-6))
+        if errors:
+            raise ApiBatchError('Upload failed', errors)
+        raise Return(stats)
+
+##
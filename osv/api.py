@@ -5,16 +5,18 @@ REST api to access OSv VM.
 
 from osv import VM
 import settings
-import requests
-#import requests.exceptions
+import ready
 import ast
-from urllib import urlencode
 import logging
-from distutils.version import LooseVersion, StrictVersion
-from time import sleep
+from time import sleep, time
 import simplejson
 import os
 import os.path
+import threading
+import Queue
+from cStringIO import StringIO
+# requests is imported on first REST api call - lin_proxy starts VM (or claims pool VM) without it,
+# and ready.wait_ready imports it in probe thread, while VM boots.
 
 
 class ApiError(Exception):
@@ -27,6 +29,100 @@ class ApiResponseError(ApiError):
         self.response = response
 
 
+class ApiBatchError(ApiError):
+    """
+    Some calls of a batch operation failed.
+    errors is dict, key is item (e.g. env var name), value is exception raised for it.
+    """
+    def __init__(self, message, errors):
+        names = ', '.join(sorted([str(kk) for kk in errors.keys()]))
+        super(ApiError, self).__init__('%s (%d failed: %s)' % (message, len(errors), names))
+        self.errors = errors
+
+
+def http_session(vm):
+    """
+    Return keep-alive HTTP session of VM, shared by all API objects of that VM.
+    """
+    if vm._http_session is None:
+        import requests
+        import requests.adapters
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.OSV_API_POOL_SIZE)
+        session.mount('http://', adapter)
+        vm._http_session = session
+    return vm._http_session
+
+
+def http_stats(vm):
+    """
+    Return count of HTTP requests, new and reused connections for VM http session.
+    """
+    stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+    if vm._http_session is None:
+        return stats
+    poolmanager = vm._http_session.get_adapter('http://').poolmanager
+    for key in poolmanager.pools.keys():
+        pool = poolmanager.pools[key]
+        stats['requests'] += pool.num_requests
+        stats['new_connections'] += pool.num_connections
+    stats['reused_connections'] = max(stats['requests'] - stats['new_connections'], 0)
+    return stats
+
+
+def run_parallel(func, items, workers):
+    """
+    Call func(item) for each item, in at most workers threads.
+    Return dict with exception for each failed item.
+    """
+    errors = {}
+    items_queue = Queue.Queue()
+    for item in items:
+        items_queue.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = items_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(item)
+            except Exception as ex:
+                errors[item] = ex
+
+    threads = [threading.Thread(target=worker) for ii in range(min(workers, items_queue.qsize()))]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return errors
+
+
+_timeout_tuple = None
+
+
+def timeout_tuple():
+    """
+    Return True if requests lib accepts (connect, read) timeout tuple - older have a single timeout value
+    (2.2.1 vs 2.8.1). requests version is checked only once.
+    """
+    global _timeout_tuple
+    if _timeout_tuple is None:
+        import requests
+        from distutils.version import StrictVersion
+        _timeout_tuple = StrictVersion(requests.__version__) >= StrictVersion('2.8.1')
+    return _timeout_tuple
+
+
+def _default_timeout():
+    if timeout_tuple():
+        timeout = (settings.OSV_API_CONNECT_TIMEOUT, settings.OSV_API_READ_TIMEOUT)
+    else:
+        timeout = settings.OSV_API_READ_TIMEOUT
+    return timeout
+
+
 class BaseApi:
     def __init__(self, vm):
         assert(isinstance(vm, VM))
@@ -34,66 +130,90 @@ class BaseApi:
         self.base_path = ''
 
     def wait_up(self):
+        """
+        Wait until VM IP is known and REST api answers, at most OSV_API_READY_TIMEOUT seconds.
+        Raises ready.ReadyTimeout.
+        """
         if not self.vm._api_up:
-            log = logging.getLogger(__name__)
-            self.vm.wait_ip()
-            '''
-            requests.exceptions.ConnectionError occures if VM is not up yet (stdout/err are not redirected to file, and
-            we only blindly set vm._ip to expected static ip.
-            '''
-            iimax = 50
-            for ii in range(1, iimax):
-                try:
-                    # dummy request, just to wait on service up
-                    uri = 'http://%s:%d' % (self.vm._ip, settings.OSV_API_PORT)
-                    uri += '/os/uptime'
-                    resp = requests.get(uri)
-                    self.vm._api_up = True
-                    return
-                except requests.exceptions.ConnectionError:
-                    log.debug('API wait_up requests.exceptions.ConnectionError %d/%d, uri %s', ii, iimax, uri)
-                    sleep(0.1)
+            with self.vm._trace.phase('api_wait_up'):
+                ready.wait_ready(self.vm, [ready.IP, ready.API], settings.OSV_API_READY_TIMEOUT)
 
     def uri(self):
-        return 'http://%s:%d' % (self.vm._ip, settings.OSV_API_PORT) + self.base_path
+        return 'http://%s:%d' % (self.vm._ip, self.vm._api_port) + self.base_path
+
+    def _url(self, path_extra, params):
+        url = self.uri() + path_extra
+        if params:
+            # urllib imports socket and ssl, requests imports it anyway
+            from urllib import urlencode
+            url += '?' + urlencode(params)
+        return url
+
+    # All requests go via VM keep-alive session.
+    # On ConnectionError (connection refused/reset, connect timeout) request is repeated up to retries times.
+    # Use retries=0 for requests which must not be sent twice (e.g. starting an app).
+    def _request(self, method, url, retries=None, **kwargs):
+        log = logging.getLogger(__name__)
+        if retries is None:
+            retries = settings.OSV_API_RETRIES
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = _default_timeout()
+        session = http_session(self.vm)
+        import requests.exceptions
+        ii = 0
+        while True:
+            try:
+                return session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as ex:
+                if ii >= retries:
+                    raise
+                ii += 1
+                log.debug('HTTP %s %s failed (%s), retry %d/%d', method, url, ex, ii, retries)
+                sleep(0.1 * ii)
 
     # kwargs is there only to pass in timeout for requests.get
     def http_get(self, params=None, path_extra='', **kwargs):
         self.wait_up()
-        url_all = self.uri() + path_extra
-        if params:
-            url_all += '?' + urlencode(params)
-        resp = requests.get(url_all, **kwargs)
+        url_all = self._url(path_extra, params)
+        resp = self._request('GET', url_all, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
 
+    # Return response with body not read yet (use resp.iter_content), caller has to close it.
+    def http_get_stream(self, params=None, path_extra='', **kwargs):
+        self.wait_up()
+        url_all = self._url(path_extra, params)
+        resp = self._request('GET', url_all, stream=True, **kwargs)
+        if resp.status_code != 200:
+            # error body is short, read it before connection goes back to pool
+            resp.content
+            resp.close()
+            raise ApiResponseError('HTTP call failed', resp)
+        return resp
+
     # OSv uses data encoded in URL manytimes (more often than POST data).
     def http_post(self, params=None, data=None, path_extra='', **kwargs):
         log = logging.getLogger(__name__)
         self.wait_up()
-        url_all = self.uri() + path_extra
-        if params:
-            url_all += '?' + urlencode(params)
+        url_all = self._url(path_extra, params)
         ## log.debug('http_post %s, data "%s"', url_all, str(data))
-        resp = requests.post(url_all, data, **kwargs)
+        resp = self._request('POST', url_all, data=data, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
 
     def http_put(self, params=None, data=None, path_extra='', **kwargs):
         self.wait_up()
-        url_all = self.uri() + path_extra
-        if params:
-            url_all += '?' + urlencode(params)
-        resp = requests.put(url_all, data, **kwargs)
+        url_all = self._url(path_extra, params)
+        resp = self._request('PUT', url_all, data=data, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
 
     def http_delete(self, path_extra='', **kwargs):
         self.wait_up()
-        resp = requests.delete(self.uri() + path_extra, **kwargs)
+        resp = self._request('DELETE', self.uri() + path_extra, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
@@ -122,6 +242,22 @@ class EnvAll(BaseApi):
             arr2[kk] = vv
         return arr2
 
+    # set many env vars, env is dict name:value
+    # Requests are sent concurrently, over up to workers keep-alive connections.
+    def set_many(self, env, workers=None):
+        self.wait_up()
+        errors = run_parallel(lambda name: Env(self.vm, name).set(env[name]),
+                              env.keys(), workers or settings.OSV_API_POOL_SIZE)
+        if errors:
+            raise ApiBatchError('Env set failed', errors)
+
+    def delete_many(self, names, workers=None):
+        self.wait_up()
+        errors = run_parallel(lambda name: Env(self.vm, name).delete(),
+                              names, workers or settings.OSV_API_POOL_SIZE)
+        if errors:
+            raise ApiBatchError('Env delete failed', errors)
+
 
 class Env(BaseApi):
     def __init__(self, vm, name):
@@ -151,15 +287,20 @@ class App(BaseApi):
         self.base_path = '/app/'
         self._name = name
 
+    # Return thread id of started app, or None if OSv does not report it (older OSv).
     def run(self):
         assert(self._name)
         params = {'command': self._name}
-        self.http_put(params)
+        # do not start app twice
+        content = self.http_put(params, retries=0)
+        try:
+            return int(simplejson.loads(content))
+        except (ValueError, TypeError):
+            return None
 
 
 def _magic_timeout():
-    # older requests lib have a single timeout value, not tuple (2.2.1 vs 2.8.1)
-    if StrictVersion(requests.__version__) >= StrictVersion('2.8.1'):
+    if timeout_tuple():
         timeout = (30, 1)
     else:
         timeout = 5
@@ -178,39 +319,89 @@ class Os(BaseApi):
         log = logging.getLogger(__name__)
         log.info('http shutdown VM %s', self.vm._log_name())
         try:
-            self.http_post(path_extra='shutdown', timeout=_magic_timeout())
+            self.http_post(path_extra='shutdown', timeout=_magic_timeout(), retries=0)
         # TODO what is wrong with that - import in __init__.py, or in tests ?
         # except requests.exceptions.ReadTimeout:
         except Exception as ex:
             log.info('Error should be ReadTimeout, msg %s', ex.message)
             pass
 
+    # Return list of threads, each a dict with 'id', 'name' and cpu usage.
+    def threads(self):
+        content = self.http_get(path_extra='threads')
+        return simplejson.loads(content)['list']
+
     # VM is down without even printing 'Powering off.'
     def poweroff(self):
         log = logging.getLogger(__name__)
         try:
-            self.http_post(path_extra='poweroff', timeout=_magic_timeout())
+            self.http_post(path_extra='poweroff', timeout=_magic_timeout(), retries=0)
         # except requests.exceptions.ReadTimeout:
         except Exception as ex:
             log.info('Error should be ReadTimeout, msg %s', ex.message)
             pass
 
+class _MultipartFile:
+    """
+    File-like multipart/form-data request body with one file part.
+    File content is read in chunks while the body is sent, never as a whole.
+    """
+    def __init__(self, fin, file_name):
+        from uuid import uuid4
+        boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        head = '--%s\r\n' \
+               'Content-Disposition: form-data; name="file"; filename="%s"\r\n' \
+               'Content-Type: application/octet-stream\r\n\r\n' % (boundary, file_name)
+        tail = '\r\n--%s--\r\n' % boundary
+        self.file_size = os.fstat(fin.fileno()).st_size
+        self._size = len(head) + self.file_size + len(tail)
+        self._parts = [StringIO(head), fin, StringIO(tail)]
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        data = ''
+        while self._parts and (size < 0 or len(data) < size):
+            chunk = self._parts[0].read(size - len(data) if size >= 0 else -1)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            data += chunk
+        return data
+
+
 class File(BaseApi):
     """
-    List and download directories etc.
+    List, download and upload directories etc.
     """
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, vm):
         BaseApi.__init__(self, vm)
         self.base_path = '/file/'
 
     # get file
+    # Without dest, return file content. With dest, file is streamed to dest and number of bytes is returned.
     def _get_file(self, file_path, dest=None):
         # GET http://192.168.122.37:8000/file/%2Flibtools.so?op=GET
         params = {'op': 'GET'}
-        content = self.http_get(params, path_extra=file_path)
-        if dest:
-            open(dest, 'w').write(content)
-        return content
+        if not dest:
+            return self.http_get(params, path_extra=file_path)
+        resp = self.http_get_stream(params, path_extra=file_path)
+        # partially downloaded file must not look complete
+        dest_part = dest + '.part'
+        size = 0
+        try:
+            with open(dest_part, 'wb') as fout:
+                for chunk in resp.iter_content(self.CHUNK_SIZE):
+                    fout.write(chunk)
+                    size += len(chunk)
+        finally:
+            resp.close()
+        os.rename(dest_part, dest)
+        return size
 
     def _list_dir(self, dir_path):
         # list dir
@@ -219,15 +410,149 @@ class File(BaseApi):
         content = self.http_get(params, path_extra=dir_path)
         return simplejson.loads(content)
 
-    def get_dir(self, path, dest):
+    def get_dir(self, path, dest, workers=None):
+        """
+        Download VM dir path recursively to host dir dest.
+        Directories are listed and files downloaded concurrently, by up to workers threads.
+        Files which already exist in dest with the same size are skipped.
+        Returns dict with download statistics.
+        """
+        self.wait_up()
+        return _DirDownload(self, workers or settings.OSV_API_POOL_SIZE).run(path, dest)
+
+    def put_file(self, src, dest_path):
+        """
+        Upload host file src to VM file dest_path. File is streamed, not read into memory.
+        Returns number of bytes uploaded.
+        """
+        with open(src, 'rb') as fin:
+            body = _MultipartFile(fin, os.path.basename(dest_path))
+            # body can be sent only once
+            self.http_post(data=body, path_extra=dest_path, retries=0,
+                           headers={'Content-Type': body.content_type})
+        return body.file_size
+
+    def _mkdirs(self, dir_path):
+        params = {'op': 'MKDIRS', 'createParent': 'true'}
+        self.http_put(params, path_extra=dir_path)
+
+    def put_dir(self, src, dest_path, workers=None):
+        """
+        Upload host dir src recursively to VM dir dest_path.
+        Directories are created first, then files are uploaded concurrently, by up to workers threads.
+        Files which already exist in VM with the same size are skipped.
+        Returns dict with upload statistics.
+        """
+        log = logging.getLogger(__name__)
+        log.info('Uploading host dir %s to VM dir %s', src, dest_path)
+        self.wait_up()
+        workers = workers or settings.OSV_API_POOL_SIZE
+        t0 = time()
+        dirs = []
+        files = {}  # VM path: host path
+        # os.walk is top-down, parent dir is created before its subdirs
+        for root, dir_names, file_names in os.walk(src):
+            rel_dir = os.path.relpath(root, src)
+            vm_dir = dest_path if rel_dir == '.' else os.path.join(dest_path, rel_dir)
+            dirs.append(vm_dir)
+            for file_name in file_names:
+                files[os.path.join(vm_dir, file_name)] = os.path.join(root, file_name)
+        for vm_dir in dirs:
+            self._mkdirs(vm_dir)
+
+        # size of files already in VM
+        vm_sizes = {}
+
+        def list_dir(vm_dir):
+            for entry in self._list_dir(vm_dir):
+                if entry['type'] == 'FILE':
+                    vm_sizes[os.path.join(vm_dir, entry['pathSuffix'])] = entry.get('length')
+        errors = run_parallel(list_dir, dirs, workers)
+
+        stats = {'dirs': len(dirs), 'files': len(files), 'skipped': 0, 'bytes': 0, 'seconds': 0.0}
+        lock = threading.Lock()
+
+        def upload(vm_file):
+            host_file = files[vm_file]
+            if vm_sizes.get(vm_file) == os.path.getsize(host_file):
+                log.debug('Skip file %s, same size in VM', host_file)
+                with lock:
+                    stats['skipped'] += 1
+                return
+            log.debug('PUT file %s', vm_file)
+            nbytes = self.put_file(host_file, vm_file)
+            with lock:
+                stats['bytes'] += nbytes
+        errors.update(run_parallel(upload, files.keys(), workers))
+
+        stats['seconds'] = time() - t0
+        log.info('Uploaded host dir %s: %d dirs, %d files (%d skipped), %.1f MB in %.2f s, %.1f MB/s',
+                 src, stats['dirs'], stats['files'], stats['skipped'], stats['bytes'] / 1e6, stats['seconds'],
+                 stats['bytes'] / 1e6 / max(stats['seconds'], 1e-6))
+        if errors:
+            raise ApiBatchError('Upload failed', errors)
+        return stats
+
+
+class _DirDownload:
+    """
+    Recursive download, tasks (list dir, get file) are executed by a pool of worker threads.
+    """
+    def __init__(self, file_api, workers):
+        self._api = file_api
+        self._workers = workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._errors = {}
+        self.stats = {'dirs': 0, 'files': 0, 'skipped': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def run(self, path, dest):
+        log = logging.getLogger(__name__)
+        log.info('Downloading VM dir %s', path)
+        t0 = time()
+        self._queue.put((self._get_dir, path, dest))
+        threads = [threading.Thread(target=self._worker) for ii in range(self._workers)]
+        for th in threads:
+            th.start()
+        self._queue.join()
+        for th in threads:
+            self._queue.put(None)
+        for th in threads:
+            th.join()
+        self.stats['seconds'] = time() - t0
+        log.info('Downloaded VM dir %s: %d dirs, %d files (%d skipped), %.1f MB in %.2f s, %.1f MB/s',
+                 path, self.stats['dirs'], self.stats['files'], self.stats['skipped'],
+                 self.stats['bytes'] / 1e6, self.stats['seconds'],
+                 self.stats['bytes'] / 1e6 / max(self.stats['seconds'], 1e-6))
+        if self._errors:
+            raise ApiBatchError('Download failed', self._errors)
+        return self.stats
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            func, args = task[0], task[1:]
+            try:
+                func(*args)
+            except Exception as ex:
+                with self._lock:
+                    self._errors[args[0]] = ex
+            finally:
+                self._queue.task_done()
+
+    def _get_dir(self, path, dest):
         log = logging.getLogger(__name__)
         # list dir, get it recursively
         # TODO - symlinks
-        log.info('Downloading VM dir %s', path)
         if not os.path.exists(dest):
             log.info('host mkdir %s', dest)
             os.mkdir(dest)
-        dir_content = self._list_dir(path)
+        dir_content = self._api._list_dir(path)
+        with self._lock:
+            self.stats['dirs'] += 1
         for entry in dir_content:
             if entry['type'] == 'DIRECTORY':
                 subdir_name = entry['pathSuffix']
@@ -235,21 +560,34 @@ class File(BaseApi):
                     continue
                 if path == '/' and subdir_name in ['dev', 'proc']:
                     # do not 'download' /dev/urandom etc
-                    dev_dir =  os.path.join(dest, subdir_name)
-                    if os.path.exists(dev_dir):
-                        os.removedirs(dev_dir)
+                    dev_dir = os.path.join(dest, subdir_name)
                     log.info('Only mkdir %s on destination side', dev_dir)
-                    os.mkdir(dev_dir)
+                    if not os.path.exists(dev_dir):
+                        os.mkdir(dev_dir)
                     continue
                 log.debug('Recurse in dir %s', os.path.join(path, subdir_name))
-                self.get_dir(os.path.join(path, subdir_name), os.path.join(dest, subdir_name))
+                self._queue.put((self._get_dir, os.path.join(path, subdir_name), os.path.join(dest, subdir_name)))
             elif entry['type'] == 'FILE':
                 file_name = entry['pathSuffix']
-                log.debug('GET file %s/%s', path, file_name)
-                self._get_file(os.path.join(path, file_name), os.path.join(dest, file_name))
+                self._queue.put((self._get_file, os.path.join(path, file_name), os.path.join(dest, file_name),
+                                 entry.get('length')))
             else:
-                log.error('Unknown type %s (json data %s)', entry['type'], simplejson.dumps(entry) )
-
+                log.error('Unknown type %s (json data %s)', entry['type'], simplejson.dumps(entry))
 
+    def _get_file(self, path, dest, size):
+        log = logging.getLogger(__name__)
+        if size is not None and os.path.isfile(dest) and os.path.getsize(dest) == size:
+            log.debug('Skip file %s, same size at destination', path)
+            with self._lock:
+                self.stats['files'] += 1
+                self.stats['skipped'] += 1
+            return
+        log.debug('GET file %s', path)
+        nbytes = self._api._get_file(path, dest)
+        with self._lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += nbytes
+            if self.stats['files'] % 100 == 0:
+                log.info('Downloaded %d files, %.1f MB', self.stats['files'], self.stats['bytes'] / 1e6)
 
 ##
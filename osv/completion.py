@@ -0,0 +1,108 @@
+__author__ = 'justin_cinkelj'
+'''
+Detect when an app started with App.run is finished, so that its VM can be powered off
+right away instead of idling until it goes down by itself.
+
+App is finished when
+    - a console line matches OSV_APP_EXIT_PATTERN (exit status is known, matching is disabled by default), or
+    - app thread is not listed by REST api /os/threads any more (polled each OSV_APP_POLL_INTERVAL), or
+    - VM is not up any more.
+
+    tid = vm.app_api(command).run()
+    done = AppCompletion(vm, tid)
+    if done.wait(out_fd=sys.stdout.fileno()):
+        print done.reason, done.status
+'''
+
+import logging
+from time import time
+
+import settings
+
+MARKER = 'marker'
+THREAD_GONE = 'thread_gone'
+VM_DOWN = 'vm_down'
+
+
+class AppCompletion:
+    """
+    tid - app thread id returned by App.run, or None (then only console marker and VM state are checked).
+    After wait returned True, reason is MARKER, THREAD_GONE or VM_DOWN, and status is app exit status
+    (None if it was not printed to console).
+    """
+    def __init__(self, vm, tid, poll_interval=None, pattern=None):
+        self.vm = vm
+        self.tid = tid
+        self.reason = None
+        self.status = None
+        self._poll_interval = poll_interval or settings.OSV_APP_POLL_INTERVAL
+        self._pattern = pattern or settings.OSV_APP_EXIT_PATTERN
+        if self._pattern:
+            # marker is matched when console is read (VM.forward_std)
+            vm.add_console_matcher('app_exit', self._pattern, self._on_marker, once=True)
+
+    def _on_marker(self, match):
+        log = logging.getLogger(__name__)
+        if match.groups() and match.group(1) is not None:
+            self.status = int(match.group(1))
+        log.info('VM %s app exit marker, status %s', self.vm._log_name(), self.status)
+        if not self.reason:
+            self.reason = MARKER
+
+    def _thread_gone(self):
+        log = logging.getLogger(__name__)
+        # circular dependency import
+        import api
+        import ready
+        import requests.exceptions
+        try:
+            return self.tid not in [th['id'] for th in self.vm.os_api().threads()]
+        except (requests.exceptions.RequestException, api.ApiError, ready.ReadyError) as ex:
+            # VM might be going down (REST api error, or it does not answer), is_up will tell
+            log.info('VM %s app thread %d state unknown: %s', self.vm._log_name(), self.tid, ex)
+            return False
+
+    def wait(self, timeout=None, out_fd=None):
+        """
+        Wait until app is finished, at most timeout seconds (None - no limit).
+        Console output is moved to file descriptor out_fd (None - discarded) as it is written.
+        Return True if app is finished.
+        """
+        log = logging.getLogger(__name__)
+        vm = self.vm
+        deadline = time() + timeout if timeout is not None else None
+        next_poll = time() + self._poll_interval
+        while not self.reason:
+            vm.forward_std(out_fd)
+            if self.reason:
+                break
+            if not vm.is_up():
+                self.reason = VM_DOWN
+                break
+            now = time()
+            if self.tid is not None and now >= next_poll:
+                if self._thread_gone():
+                    self.reason = THREAD_GONE
+                    break
+                next_poll = time() + self._poll_interval
+                now = time()
+            if deadline is not None and now >= deadline:
+                return False
+            wait_time = next_poll - now if self.tid is not None else 1.0
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - now)
+            # wakes up as soon as VM writes to console or VM state changes (libvirt event)
+            vm.wait_console(max(wait_time, 0))
+        # rest of console output, exit marker might be printed just after app thread ended
+        vm.forward_std(out_fd)
+        self.close()
+        log.info('VM %s app finished (%s), status %s', vm._log_name(), self.reason, self.status)
+        return True
+
+    def close(self):
+        """
+        Stop matching exit marker (wait calls it when app is finished).
+        """
+        self.vm.remove_console_matcher('app_exit')
+
+##
@@ -0,0 +1,103 @@
+'''
+Process-wide cache of libvirt connections, one connection per URI.
+Connection is checked before it is reused, and reopened if it is dead.
+'''
+
+import logging
+import threading
+import atexit
+import libvirt
+import settings
+import events
+import console
+
+_conns = {}
+_lock = threading.Lock()
+_stats = {'opened': 0, 'reused': 0, 'reconnected': 0}
+
+
+def _is_alive(conn):
+    try:
+        return conn.isAlive() == 1
+    except Exception:
+        # libvirtError, or error from already closed connection object
+        return False
+
+
+def get(uri=None):
+    """
+    Return open libvirt connection to uri (default OSV_LIBVIRT_URI).
+    """
+    log = logging.getLogger(__name__)
+    uri = uri or settings.OSV_LIBVIRT_URI
+    with _lock:
+        conn = _conns.get(uri)
+        if conn is not None:
+            if _is_alive(conn):
+                _stats['reused'] += 1
+                return conn
+            log.info('libvirt connection %s is dead, reconnect', uri)
+            _close(conn)
+            _stats['reconnected'] += 1
+        if settings.OSV_LIBVIRT_EVENTS or settings.OSV_CONSOLE_MODE == console.STREAM:
+            # event loop has to be registered before connection is opened, console streams need it too
+            events.start_event_loop()
+        conn = libvirt.open(uri)
+        if settings.OSV_LIBVIRT_EVENTS:
+            events.register(conn)
+        _conns[uri] = conn
+        _stats['opened'] += 1
+        return conn
+
+
+def call(func, uri=None):
+    """
+    Return func(conn). If func fails because connection died, reconnect and call func again.
+    """
+    conn = get(uri)
+    try:
+        return func(conn)
+    except libvirt.libvirtError:
+        if _is_alive(conn):
+            # error not related to connection (e.g. no such domain)
+            raise
+        return func(get(uri))
+
+
+def active_domains(uri=None):
+    """
+    Return set of names of running libvirt domains, or None if libvirt is not accessible.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        domains = call(lambda conn: conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE), uri)
+    except libvirt.libvirtError as ex:
+        log.info('Cannot list libvirt domains: %s', ex.get_error_message())
+        return None
+    return set([dom.name() for dom in domains])
+
+
+def _close(conn):
+    log = logging.getLogger(__name__)
+    try:
+        conn.close()
+    except Exception as ex:
+        log.info('libvirt connection close failed: %s', ex)
+
+
+def close_all():
+    with _lock:
+        for uri in _conns.keys():
+            _close(_conns.pop(uri))
+
+
+def stats():
+    """
+    Return dict with number of opened, reused and reconnected connections.
+    """
+    return dict(_stats)
+
+
+atexit.register(close_all)
+
+##
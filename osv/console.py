@@ -0,0 +1,350 @@
+'''
+VM console (serial port log file) helpers.
+'''
+
+import os
+import re
+import errno
+import select
+import ctypes
+import logging
+import threading
+from collections import deque
+from time import sleep
+import libvirt
+
+from events import _pipe, _notify, _drain
+
+# console modes - serial console is written by qemu to a log file, or read from a pty via libvirt stream
+FILE = 'file'
+STREAM = 'stream'
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_libc = None
+_sendfile = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        # symbols of process (libc is linked in), find_library('c') would run ldconfig
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def _inotify_watch(path):
+    """
+    Return inotify fd watching path for modifications, or -1 if inotify is not available.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        fd = _load_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError) as ex:
+        log.info('inotify not available (%s), console will be polled', ex)
+        return -1
+    if fd < 0:
+        log.info('inotify_init1 failed, errno %d, console will be polled', ctypes.get_errno())
+        return -1
+    wd = _libc.inotify_add_watch(fd, path, IN_MODIFY | IN_CLOSE_WRITE)
+    if wd < 0:
+        log.info('inotify_add_watch %s failed, errno %d, console will be polled', path, ctypes.get_errno())
+        os.close(fd)
+        return -1
+    return fd
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """
+    Copy up to count bytes from in_fd at offset to out_fd in kernel, with sendfile(2).
+    in_fd file position is not changed. Return number of bytes copied.
+    Raises OSError - ENOSYS if sendfile is not available, EINVAL if out_fd does not support it
+    (e.g. opened with O_APPEND).
+    """
+    global _sendfile
+    if _sendfile is None:
+        try:
+            _sendfile = _load_libc().sendfile64
+            _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+            _sendfile.restype = ctypes.c_ssize_t
+        except (OSError, AttributeError):
+            _sendfile = False
+    if not _sendfile:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    off = ctypes.c_int64(offset)
+    while True:
+        ret = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if ret >= 0:
+            return ret
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def write_all(fd, data):
+    """
+    os.write all of data to fd (pipe might take only part of it).
+    """
+    view = buffer(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# select for read, EINTR is like timeout
+def _select(fds, timeout):
+    try:
+        rr, ww, xx = select.select(fds, [], [], max(timeout, 0))
+    except select.error as ex:
+        if ex.args[0] != errno.EINTR:
+            raise
+        return []
+    return rr
+
+
+class ConsoleWatcher:
+    """
+    Wait until data is appended to console log file.
+    Uses inotify, and falls back to polling if inotify is not available.
+    """
+    def __init__(self, path, use_inotify=True):
+        self._path = path
+        self._fd = -1
+        if use_inotify:
+            self._fd = _inotify_watch(path)
+
+    def uses_inotify(self):
+        return self._fd >= 0
+
+    def wait(self, timeout, poll_interval=0.1, wake_fds=()):
+        """
+        Block until file is modified, or timeout (seconds) expires, or one of wake_fds is readable.
+        Returns True if file was modified. Without inotify, it sleeps min(timeout, poll_interval)
+        (or less, if wake_fds get readable) and returns True - caller has to check file content anyway.
+        """
+        if self._fd < 0:
+            if wake_fds:
+                _select(list(wake_fds), min(timeout, poll_interval))
+            else:
+                sleep(min(timeout, poll_interval))
+            return True
+        rr = _select([self._fd] + list(wake_fds), timeout)
+        if self._fd not in rr:
+            return False
+        # drain events, we only care that something happened
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class ConsoleScanner:
+    """
+    Split console output into lines, also when a line is split over several reads,
+    and run matchers (precompiled regex) on each complete line exactly once.
+
+    Patterns are compiled with re.MULTILINE and searched over all complete lines of a read at once,
+    so '^' and '$' match at line start/end; pattern should not match over newline (e.g. with '\\s').
+    Matcher callback is called with re match object. Matcher with once=True is removed after first match.
+    Matcher with partial=True is also tried on the incomplete last line - needed for the
+    cli.so command prompt '/# ', which is not followed by newline. As the same line can be
+    matched again when it is complete, partial matchers should also be once matchers.
+    """
+    MAX_LINE = 64 * 1024  # longer lines are split, so that buffer does not grow without limit
+    MAX_PARTIAL_MATCH = 4096  # partial matchers are tried only on short incomplete lines
+
+    def __init__(self):
+        self._partial = ''
+        self._skip_line = False
+        self._matchers = []  # list of [name, regex, callback, once, partial]
+
+    def add_matcher(self, name, pattern, callback, once=False, partial=False):
+        self.remove_matcher(name)
+        self._matchers.append([name, re.compile(pattern, re.MULTILINE), callback, once, partial])
+
+    def remove_matcher(self, name):
+        self._matchers = [mm for mm in self._matchers if mm[0] != name]
+
+    def has_matchers(self):
+        return len(self._matchers) > 0
+
+    def _match(self, text, partial_line=False):
+        for matcher in list(self._matchers):
+            name, regex, callback, once, partial = matcher
+            if partial_line and not partial:
+                continue
+            for mm in regex.finditer(text):
+                if once:
+                    self._matchers.remove(matcher)
+                callback(mm)
+                if once:
+                    break
+
+    def skip(self):
+        """
+        Some console output was not fed (nobody was matching it). Rest of the current line is
+        not matched either, matching restarts at next line start.
+        """
+        self._partial = ''
+        self._skip_line = True
+
+    def feed(self, data):
+        if not data:
+            return
+        if self._skip_line:
+            ii = data.find('\n')
+            if ii < 0:
+                return
+            self._skip_line = False
+            data = data[ii+1:]
+            if not data:
+                return
+        ii = data.rfind('\n')
+        if ii < 0:
+            self._partial += data
+        else:
+            complete = self._partial + data[:ii+1]
+            self._partial = data[ii+1:]
+            if self._matchers:
+                self._match(complete.replace('\r\n', '\n'))
+        if len(self._partial) > self.MAX_LINE:
+            if self._matchers:
+                self._match(self._partial)
+            self._partial = ''
+        if self._matchers and self._partial and len(self._partial) <= self.MAX_PARTIAL_MATCH:
+            self._match(self._partial, partial_line=True)
+
+class ConsoleStream:
+    """
+    Serial console of a running domain (with pty console), read via libvirt console stream.
+    The stream is non-blocking, its callback runs in libvirt event loop thread (osv.events) and
+    keeps received data in memory until read() - no console log file is written, unless
+    capture_path is given (debugging).
+    At most max_buffer bytes are kept, then stream is not read any more until read() is called
+    (guest console output is paused). fileno() is readable while data is buffered, and after stream
+    is closed by the other side.
+    Output written by guest before the stream is opened is lost.
+    """
+    RECV_SIZE = 64 * 1024
+    EVENTS = libvirt.VIR_STREAM_EVENT_ERROR | libvirt.VIR_STREAM_EVENT_HANGUP
+
+    def __init__(self, conn, dom, max_buffer, capture_path=None):
+        self._lock = threading.Lock()
+        self._data = deque()
+        self._size = 0
+        self._max_buffer = max_buffer
+        self._paused = False
+        self._hangup = False
+        self._closed = False
+        self._pipe_r, self._pipe_w = _pipe()
+        self._capture = open(capture_path, 'a') if capture_path else None
+        self._stream = conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
+        # take console over from previous reader (e.g. osv_pool.py which booted the VM)
+        dom.openConsole(None, self._stream, libvirt.VIR_DOMAIN_CONSOLE_FORCE)
+        self._stream.eventAddCallback(self.EVENTS | libvirt.VIR_STREAM_EVENT_READABLE, self._on_event, None)
+
+    def _on_event(self, stream, events, opaque):
+        log = logging.getLogger(__name__)
+        if events & libvirt.VIR_STREAM_EVENT_READABLE:
+            while True:
+                try:
+                    data = stream.recv(self.RECV_SIZE)
+                except libvirt.libvirtError as ex:
+                    log.info('Console stream recv failed: %s', ex.get_error_message())
+                    events |= libvirt.VIR_STREAM_EVENT_ERROR
+                    break
+                if data == -2:
+                    # EAGAIN
+                    break
+                if not data:
+                    events |= libvirt.VIR_STREAM_EVENT_HANGUP
+                    break
+                with self._lock:
+                    if self._closed:
+                        return
+                    if self._capture:
+                        self._capture.write(data)
+                        self._capture.flush()
+                    self._data.append(data)
+                    self._size += len(data)
+                    if self._size >= self._max_buffer:
+                        # reader is slow, stop reading until it catches up
+                        self._paused = True
+                        stream.eventUpdateCallback(self.EVENTS)
+                        break
+        if events & (libvirt.VIR_STREAM_EVENT_ERROR | libvirt.VIR_STREAM_EVENT_HANGUP):
+            self._hangup = True
+        with self._lock:
+            if not self._closed:
+                _notify(self._pipe_w)
+
+    def fileno(self):
+        return self._pipe_r
+
+    def pending(self):
+        """
+        Return True if read() would return data.
+        """
+        return self._size > 0
+
+    def hangup(self):
+        return self._hangup
+
+    def read(self, max_size=None):
+        """
+        Return buffered console data, at most max_size bytes (None - all), '' if there is none.
+        """
+        with self._lock:
+            _drain(self._pipe_r)
+            if max_size is None or max_size >= self._size:
+                out = ''.join(self._data)
+                self._data.clear()
+            else:
+                parts = []
+                size = 0
+                while size < max_size:
+                    data = self._data.popleft()
+                    if size + len(data) > max_size:
+                        self._data.appendleft(data[max_size - size:])
+                        data = data[:max_size - size]
+                    parts.append(data)
+                    size += len(data)
+                out = ''.join(parts)
+            self._size -= len(out)
+            if self._size:
+                # still readable
+                _notify(self._pipe_w)
+            if self._paused and self._size < self._max_buffer / 2:
+                self._paused = False
+                self._stream.eventUpdateCallback(self.EVENTS | libvirt.VIR_STREAM_EVENT_READABLE)
+        return out
+
+    def close(self):
+        log = logging.getLogger(__name__)
+        try:
+            self._stream.eventRemoveCallback()
+            self._stream.abort()
+        except libvirt.libvirtError as ex:
+            # domain is already gone
+            log.debug('Console stream close: %s', ex.get_error_message())
+        # callback might be running in event loop thread just now
+        with self._lock:
+            self._closed = True
+            os.close(self._pipe_r)
+            os.close(self._pipe_w)
+            if self._capture:
+                self._capture.close()
+                self._capture = None
+
+##
@@ -0,0 +1,190 @@
+'''
+libvirt domain lifecycle events.
+Background thread runs libvirt default event loop; lifecycle callbacks update
+DomainState of watched domains, so callers can block on state change instead of polling isActive().
+'''
+
+import os
+import errno
+import fcntl
+import select
+import logging
+import threading
+from time import time
+import libvirt
+
+STARTED = 'started'
+STOPPED = 'stopped'
+CRASHED = 'crashed'
+SHUTDOWN = 'shutdown'  # guest finished shutdown, STOPPED follows
+
+_loop_thread = None
+_loop_lock = threading.Lock()
+_states = {}  # domain name -> DomainState
+_states_lock = threading.Lock()
+
+
+def _pipe():
+    fds = os.pipe()
+    for fd in fds:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return fds
+
+
+def _notify(fd):
+    try:
+        os.write(fd, 'x')
+    except OSError as ex:
+        # pipe full, reader was already notified
+        if ex.errno != errno.EAGAIN:
+            raise
+
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as ex:
+        if ex.errno != errno.EAGAIN:
+            raise
+
+
+class DomainState:
+    """
+    Last lifecycle state of a domain. wait() blocks until domain reaches one of given states.
+    fileno() is readable after each state change (until drain() is called), so it can be used with select.
+    Waiters are woken up via pipes - python2 threading.Condition.wait(timeout) polls with up to 50 ms sleeps.
+    set() after close() is a no-op - event thread might still deliver an event to unwatched domain.
+    """
+    def __init__(self, state=None):
+        self._state = state
+        self._lock = threading.Lock()
+        self._waiters = []  # write end of pipe for each wait() call
+        self._pipe_r, self._pipe_w = _pipe()
+        self._closed = False
+
+    @property
+    def state(self):
+        return self._state
+
+    def set(self, state):
+        with self._lock:
+            if self._closed:
+                return
+            self._state = state
+            for fd in self._waiters + [self._pipe_w]:
+                _notify(fd)
+
+    def wait(self, states, timeout):
+        """
+        Return True if domain reached one of states within timeout seconds.
+        """
+        deadline = time() + timeout
+        pipe_r, pipe_w = _pipe()
+        with self._lock:
+            self._waiters.append(pipe_w)
+        try:
+            while self._state not in states:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                try:
+                    select.select([pipe_r], [], [], remaining)
+                except select.error as ex:
+                    if ex.args[0] != errno.EINTR:
+                        raise
+                _drain(pipe_r)
+            return True
+        finally:
+            with self._lock:
+                self._waiters.remove(pipe_w)
+            os.close(pipe_r)
+            os.close(pipe_w)
+
+    def fileno(self):
+        return self._pipe_r
+
+    def drain(self):
+        _drain(self._pipe_r)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for fd in [self._pipe_r, self._pipe_w]:
+                os.close(fd)
+
+
+def _run_loop():
+    log = logging.getLogger(__name__)
+    while True:
+        if libvirt.virEventRunDefaultImpl() < 0:
+            log.error('libvirt virEventRunDefaultImpl failed')
+
+
+def start_event_loop():
+    """
+    Register libvirt default event implementation and run it in background thread.
+    Must be called before connection is opened, else events of that connection are not delivered.
+    """
+    global _loop_thread
+    with _loop_lock:
+        if _loop_thread is None:
+            libvirt.virEventRegisterDefaultImpl()
+            _loop_thread = threading.Thread(target=_run_loop, name='libvirt-events')
+            _loop_thread.daemon = True
+            _loop_thread.start()
+
+
+def event_loop_running():
+    return _loop_thread is not None
+
+
+def _lifecycle_cb(conn, dom, event, detail, opaque):
+    log = logging.getLogger(__name__)
+    if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+        state = STARTED
+    elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+        if detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED:
+            state = CRASHED
+        else:
+            state = STOPPED
+    elif event == libvirt.VIR_DOMAIN_EVENT_SHUTDOWN:
+        state = SHUTDOWN
+    elif event == libvirt.VIR_DOMAIN_EVENT_CRASHED:
+        state = CRASHED
+    else:
+        # defined, suspended, resumed etc.
+        return
+    name = dom.name()
+    with _states_lock:
+        dom_state = _states.get(name)
+    log.debug('libvirt domain %s event %d/%d -> %s', name, event, detail, state)
+    if dom_state:
+        dom_state.set(state)
+
+
+def register(conn):
+    """
+    Deliver lifecycle events of all domains on conn to watched DomainState objects.
+    """
+    conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _lifecycle_cb, None)
+
+
+def watch(name, state=None):
+    """
+    Return DomainState for domain name, updated by lifecycle events.
+    """
+    dom_state = DomainState(state)
+    with _states_lock:
+        _states[name] = dom_state
+    return dom_state
+
+
+def unwatch(name):
+    with _states_lock:
+        dom_state = _states.pop(name, None)
+    if dom_state:
+        dom_state.close()
+
+##
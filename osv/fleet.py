@@ -0,0 +1,201 @@
+__author__ = 'justin_cinkelj'
+'''
+Launch a group of VMs in parallel.
+
+Launch of one VM has stages - create (image copy/overlay), edit_image (imgedit.py),
+start (libvirt define/create) and wait_up. Each stage has its own pool of worker threads,
+and VMs move through stages as a pipeline. So image copy of one VM overlaps with
+imgedit and boot of others, and the group is up in about the time of its slowest VM.
+'''
+
+import logging
+import threading
+import Queue
+from time import time
+
+from vm import VM
+import settings
+
+
+class FleetError(Exception):
+    """
+    Some VMs of fleet failed to launch.
+    errors is dict, key is VM index in specs, value is exception raised for it.
+    """
+    def __init__(self, message, errors):
+        indices = ', '.join([str(ii) for ii in sorted(errors.keys())])
+        super(FleetError, self).__init__('%s (%d failed: %s)' % (message, len(errors), indices))
+        self.errors = errors
+
+
+class _Member:
+    def __init__(self, index, spec):
+        self.index = index
+        self.spec = spec
+        self.vm = None
+        self.times = {}  # stage name: seconds
+
+
+class Fleet:
+    """
+    Group of VMs, launched and terminated together.
+    specs - list of dicts with VM kwargs.
+    vm_factory - called as vm_factory(**spec), returns VM.
+    workers - worker threads per stage, int or dict stage name: int.
+    By default wait_up is not limited, each VM waits in its own thread.
+    wait_up_timeout - seconds until VM is up, default is OSV_READY_TIMEOUT.
+    """
+    STAGES = ['create', 'edit_image', 'start', 'wait_up']
+
+    def __init__(self, specs, vm_factory=VM, workers=None, wait_up_timeout=None):
+        self._members = [_Member(ii, spec) for ii, spec in enumerate(specs)]
+        self._vm_factory = vm_factory
+        self._wait_up_timeout = wait_up_timeout
+        if not isinstance(workers, dict):
+            workers = {'create': workers, 'edit_image': workers, 'start': workers}
+        self._workers = dict([(stage, workers.get(stage) or settings.OSV_FLEET_WORKERS) for stage in self.STAGES])
+        self._workers['wait_up'] = workers.get('wait_up') or max(len(specs), 1)
+        self.vms = [None] * len(specs)  # ready VMs, None for failed ones
+        self.errors = {}
+        self.stats = {}
+
+    def _create(self, member):
+        member.vm = self._vm_factory(**member.spec)
+
+    def _edit_image(self, member):
+        member.vm.edit_image()
+
+    def _start(self, member):
+        member.vm.start()
+
+    def _wait_up(self, member):
+        member.vm.wait_up(self._wait_up_timeout)
+        if not member.vm.is_up():
+            raise RuntimeError('VM %d is not running' % member.index)
+
+    def launch(self):
+        """
+        Launch all VMs. Generator, yields (index, vm) as each VM becomes ready.
+        Failed VMs are terminated, and FleetError is raised after all others are ready.
+        If the caller stops iterating early, VMs which were not yielded yet are terminated
+        (VMs already yielded stay up, terminate() them).
+        """
+        log = logging.getLogger(__name__)
+        log.info('Launching fleet of %d VMs', len(self._members))
+        t0 = time()
+        queues = [Queue.Queue() for stage in self.STAGES]
+        done = Queue.Queue()  # (member, exception)
+        cancel = threading.Event()  # skip remaining stages of members not yielded yet
+        thread_counts = []
+        for ii, stage in enumerate(self.STAGES):
+            func = getattr(self, '_' + stage)
+            next_queue = queues[ii + 1] if ii + 1 < len(queues) else None
+            thread_counts.append(min(self._workers[stage], len(self._members)))
+            for jj in range(thread_counts[-1]):
+                th = threading.Thread(target=self._stage_worker, args=(stage, func, queues[ii], next_queue, done,
+                                                                       cancel))
+                th.daemon = True
+                th.start()
+        for member in self._members:
+            queues[0].put(member)
+
+        received = 0
+        try:
+            while received < len(self._members):
+                member, ex = done.get()
+                received += 1
+                if ex is None:
+                    self.vms[member.index] = member.vm
+                    log.info('Fleet VM %d ready in %.2f s', member.index, sum(member.times.values()))
+                    yield member.index, member.vm
+                else:
+                    log.error('Fleet VM %d failed: %s', member.index, ex)
+                    self.errors[member.index] = ex
+                    self._rollback(member)
+        finally:
+            if received < len(self._members):
+                # caller stopped early (or generator was closed) - wait for members still in stages
+                log.info('Fleet launch stopped, terminating %d VMs not yielded', len(self._members) - received)
+                cancel.set()
+                while received < len(self._members):
+                    member, ex = done.get()
+                    received += 1
+                    self._rollback(member)
+            # stop stage workers
+            for queue, count in zip(queues, thread_counts):
+                for jj in range(count):
+                    queue.put(None)
+            self.stats = self._stats(time() - t0)
+        if self.errors:
+            raise FleetError('Fleet launch failed', self.errors)
+
+    def start(self):
+        """
+        Launch all VMs, return list of VMs in specs order.
+        """
+        for index, vm in self.launch():
+            pass
+        return self.vms
+
+    def _stage_worker(self, stage, func, queue, next_queue, done, cancel):
+        while True:
+            member = queue.get()
+            if member is None:
+                return
+            if cancel.is_set():
+                done.put((member, None))
+                continue
+            t0 = time()
+            try:
+                func(member)
+            except Exception as ex:
+                member.times[stage] = time() - t0
+                done.put((member, ex))
+                continue
+            member.times[stage] = time() - t0
+            if next_queue:
+                next_queue.put(member)
+            else:
+                done.put((member, None))
+
+    def _rollback(self, member):
+        log = logging.getLogger(__name__)
+        if member.vm is None:
+            return
+        try:
+            member.vm.terminate()
+        except Exception as ex:
+            log.error('Fleet VM %d rollback failed: %s', member.index, ex)
+
+    def _stats(self, seconds):
+        vm_seconds = [sum(member.times.values()) for member in self._members]
+        stats = {'vms': len(self._members), 'failed': len(self.errors), 'seconds': seconds,
+                 'slowest_vm_seconds': max(vm_seconds or [0]), 'sum_vm_seconds': sum(vm_seconds)}
+        for stage in self.STAGES:
+            stats[stage + '_seconds'] = sum([member.times.get(stage, 0) for member in self._members])
+        log = logging.getLogger(__name__)
+        log.info('Fleet of %d VMs (%d failed) launched in %.2f s, slowest VM %.2f s, sum of all VMs %.2f s',
+                 stats['vms'], stats['failed'], seconds, stats['slowest_vm_seconds'], stats['sum_vm_seconds'])
+        return stats
+
+    def terminate(self):
+        """
+        Terminate all ready VMs in parallel.
+        """
+        log = logging.getLogger(__name__)
+        vms = [vm for vm in self.vms if vm is not None]
+        log.info('Terminating fleet of %d VMs', len(vms))
+
+        def terminate_vm(vm):
+            try:
+                vm.terminate()
+            except Exception as ex:
+                log.error('Fleet VM terminate failed: %s', ex)
+        threads = [threading.Thread(target=terminate_vm, args=(vm,)) for vm in vms]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.vms = [None] * len(self.vms)
+
+##
@@ -0,0 +1,231 @@
+__author__ = 'justin_cinkelj'
+'''
+Content-addressed cache of configured VM images, shared by all processes on the host.
+
+imgedit.py setargs on a fresh image copy is the slow part of VM.edit_image. The result depends only
+on the original image content and on the OSv command line, so configured images are kept in
+OSV_IMAGE_CACHE_DIR (default OSV_WORK_DIR/image-cache), keyed by sha1 of both. On a hit, VM gets
+a reflink clone of the cached image (if filesystem supports it), or a thin qcow2 overlay backed by it.
+
+Cached images are removed in least recently used order when the cache is over OSV_IMAGE_CACHE_SIZE MB.
+Images used as backing file by a VM are never removed. A user is dropped when its process is dead
+and its VM is not running any more, as with osv.lease.
+
+Index (entries, users, stats) is OSV_IMAGE_CACHE_DIR/index.json, see statefile.StateFile.
+'''
+
+import os
+import os.path
+import errno
+import fcntl
+import hashlib
+import shutil
+import logging
+from time import time
+
+import settings
+import connection
+from statefile import StateFile, pid_alive
+
+# from <linux/fs.h>, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def cache_dir():
+    return settings.OSV_IMAGE_CACHE_DIR or os.path.join(settings.OSV_WORK_DIR, 'image-cache')
+
+
+def _make_dir():
+    try:
+        os.makedirs(cache_dir())
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def _index():
+    _make_dir()
+    return StateFile(os.path.join(cache_dir(), 'index.json'))
+
+
+def _load(state):
+    data = state.data
+    data.setdefault('entries', {})
+    data.setdefault('digests', {})
+    data.setdefault('stats', {'hits': 0, 'misses': 0, 'evictions': 0})
+    return data
+
+
+def _file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        while True:
+            data = fin.read(1024 * 1024)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def image_digest(path):
+    """
+    Return sha1 of image content. Digest is remembered in index, and recomputed only if
+    image size, mtime or inode changes.
+    """
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime, st.st_ino]
+    with _index() as state:
+        known = _load(state)['digests'].get(path)
+    if known and known['stamp'] == stamp:
+        return known['sha1']
+    sha1 = _file_sha1(path)
+    with _index() as state:
+        _load(state)['digests'][path] = {'stamp': stamp, 'sha1': sha1}
+    return sha1
+
+
+def cache_key(image, command_line):
+    sha = hashlib.sha1()
+    sha.update(image_digest(image))
+    sha.update('\0')
+    sha.update(command_line)
+    return sha.hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(cache_dir(), key + '.img')
+
+
+def _expire_users(data):
+    log = logging.getLogger(__name__)
+    users = [(entry, vm_name, pid) for entry in data['entries'].values() for vm_name, pid in entry['users'].items()]
+    if not users:
+        return
+    active = connection.active_domains()
+    for entry, vm_name, pid in users:
+        if pid_alive(pid) or active is None or vm_name in active:
+            continue
+        log.info('Drop image cache user %s (pid %d)', vm_name, pid)
+        del entry['users'][vm_name]
+
+
+def _evict(data):
+    """
+    Remove least recently used unused images until cache fits into OSV_IMAGE_CACHE_SIZE.
+    """
+    log = logging.getLogger(__name__)
+    budget = settings.OSV_IMAGE_CACHE_SIZE * 1024 * 1024
+    total = sum([entry['size'] for entry in data['entries'].values()])
+    if total <= budget:
+        return
+    _expire_users(data)
+    for key, entry in sorted(data['entries'].items(), key=lambda kv: kv[1]['last_used']):
+        if total <= budget:
+            break
+        if entry['users']:
+            continue
+        log.info('Evict cached image %s (%d bytes)', key, entry['size'])
+        for path in [_entry_path(key), _entry_path(key) + '.lock']:
+            try:
+                os.remove(path)
+            except OSError as ex:
+                log.info('Cached image file %s remove failed: %s', path, ex)
+        del data['entries'][key]
+        data['stats']['evictions'] += 1
+        total -= entry['size']
+
+
+def _use(key, owner):
+    # return True and register owner if key is cached
+    with _index() as state:
+        data = _load(state)
+        entry = data['entries'].get(key)
+        if entry is None or not os.path.exists(_entry_path(key)):
+            data['entries'].pop(key, None)
+            return False
+        entry['users'][owner] = os.getpid()
+        entry['last_used'] = time()
+        data['stats']['hits'] += 1
+        return True
+
+
+def acquire(image, command_line, owner, configure):
+    """
+    Return (path, key, hit) of image configured with command_line. owner (VM name) holds the cached image
+    until release(key, owner) - it is not evicted while VM uses it as backing file.
+    On a miss, image is copied into cache and configure(path) is called to run imgedit.py on the copy.
+    """
+    log = logging.getLogger(__name__)
+    key = cache_key(image, command_line)
+    path = _entry_path(key)
+    if _use(key, owner):
+        log.info('Image cache hit %s for %s', key, owner)
+        return path, key, True
+    # one process builds the image, concurrent launches with same key wait for it
+    lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0666)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        if _use(key, owner):
+            log.info('Image cache hit %s for %s, after wait', key, owner)
+            return path, key, True
+        log.info('Image cache miss %s for %s, configure %s', key, owner, image)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            shutil.copy(image, tmp_path)
+            configure(tmp_path)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with _index() as state:
+            data = _load(state)
+            data['entries'][key] = {'size': os.path.getsize(path), 'image': image, 'command_line': command_line,
+                                    'created': time(), 'last_used': time(), 'users': {owner: os.getpid()}}
+            data['stats']['misses'] += 1
+            _evict(data)
+        return path, key, False
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+
+def release(key, owner):
+    with _index() as state:
+        data = _load(state)
+        entry = data['entries'].get(key)
+        if entry:
+            entry['users'].pop(owner, None)
+        _evict(data)
+
+
+def clone(src, dest):
+    """
+    Make dest a reflink clone of src (shares data blocks until modified). Return False if
+    filesystem does not support it (dest is not created then).
+    """
+    log = logging.getLogger(__name__)
+    with open(src, 'rb') as fin:
+        with open(dest, 'wb') as fout:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                return True
+            except IOError as ex:
+                log.debug('Reflink %s -> %s not supported: %s', src, dest, ex)
+    os.remove(dest)
+    return False
+
+
+def stats():
+    """
+    Return dict with hits, misses, evictions, entries, bytes (cached images size) and budget (bytes).
+    """
+    with _index() as state:
+        data = _load(state)
+        result = dict(data['stats'])
+        result['entries'] = len(data['entries'])
+        result['bytes'] = sum([entry['size'] for entry in data['entries'].values()])
+    result['budget'] = settings.OSV_IMAGE_CACHE_SIZE * 1024 * 1024
+    return result
+
+##
@@ -0,0 +1,180 @@
+__author__ = 'justin_cinkelj'
+'''
+Static IP and MAC leases, shared by all processes on the host.
+
+Each pool (IP, MAC) is a range of numbered addresses. Used addresses are a bitmap, stored
+together with lease owners in OSV_WORK_DIR/lease-<pool>.json (see statefile.StateFile).
+A free address is found with a few integer operations on the bitmap. The search starts
+after the last allocated address, so a just released address is not reused immediately
+(ARP caches of the bridge and guests still point to the old VM).
+
+A lease is held as long as its owner process is alive, or the owner VM is running.
+Stale leases are expired when the pool is accessed.
+'''
+
+import os
+import os.path
+import logging
+from time import time
+import ipaddress
+
+import settings
+import connection
+from statefile import StateFile, pid_alive
+
+IP = 'ip'
+MAC = 'mac'
+
+
+class LeaseError(Exception):
+    pass
+
+
+def ip_network():
+    """
+    Return ipaddress.IPv4Network for OSV_IP_SUBNET/OSV_IP_MASK.
+    Raises ValueError if subnet address is not aligned with mask.
+    """
+    return ipaddress.ip_network(u'%s/%d' % (settings.OSV_IP_SUBNET, settings.OSV_IP_MASK))
+
+
+def ip_range():
+    """
+    Return first IP address and number of IPs for static leases, OSV_IP_SUBNET + [OSV_IP_MIN, OSV_IP_MAX].
+    """
+    network = ip_network()
+    ipmin, ipmax = settings.OSV_IP_MIN, settings.OSV_IP_MAX
+    # network and broadcast address are not valid host IPs
+    if not (1 <= ipmin <= ipmax <= network.num_addresses - 2):
+        raise ValueError('IP range [%d, %d] is not within subnet %s' % (ipmin, ipmax, network))
+    return network.network_address + ipmin, ipmax - ipmin + 1
+
+
+def format_mac(prefix, index):
+    # prefix '52:54:00:4f', index 0x1234 -> '52:54:00:4f:12:34'
+    octets = prefix.split(':')
+    suffix_len = 6 - len(octets)
+    for ii in range(suffix_len):
+        octets.append('%02x' % ((index >> (8 * (suffix_len - 1 - ii))) & 0xff))
+    return ':'.join(octets)
+
+
+class LeasePool:
+    """
+    size numbered addresses, leases are stored in state file path.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def _load(self, state):
+        data = state.data
+        data.setdefault('bitmap', '0')
+        data.setdefault('cursor', 0)
+        data.setdefault('leases', {})
+        self._expire(data)
+        return data
+
+    def _expire(self, data):
+        log = logging.getLogger(__name__)
+        active = None
+        if [lease for lease in data['leases'].values() if lease.get('vm_name')]:
+            active = connection.active_domains()
+        bitmap = long(data['bitmap'], 16)
+        for index in data['leases'].keys():
+            lease = data['leases'][index]
+            if pid_alive(lease['pid']):
+                continue
+            if lease.get('vm_name') and (active is None or lease['vm_name'] in active):
+                continue
+            log.info('Expire lease %s %s (pid %d, VM %s)', self.path, index, lease['pid'], lease.get('vm_name'))
+            del data['leases'][index]
+            bitmap &= ~(1 << int(index))
+        data['bitmap'] = '%x' % bitmap
+
+    def acquire(self, vm_name='', index=None):
+        """
+        Lease a free address, return its index. If index is given, lease exactly that address
+        (e.g. MAC/IP saved in osv.snapshot), or raise LeaseError if it is leased already.
+        """
+        with StateFile(self.path) as state:
+            data = self._load(state)
+            bitmap = long(data['bitmap'], 16)
+            full = (1 << self.size) - 1
+            if index is not None:
+                if not 0 <= index < self.size or bitmap & (1 << index):
+                    raise LeaseError('Address %d in %s is not available' % (index, self.path))
+            elif (bitmap & full) == full:
+                raise LeaseError('All %d addresses in %s are leased' % (self.size, self.path))
+            else:
+                # lowest clear bit at or after cursor, else lowest clear bit at all
+                cursor = data['cursor'] % self.size
+                from_cursor = bitmap | ((1 << cursor) - 1)
+                if (from_cursor & full) != full:
+                    bitmap_search = from_cursor
+                else:
+                    bitmap_search = bitmap
+                index = ((~bitmap_search) & (bitmap_search + 1)).bit_length() - 1
+            data['bitmap'] = '%x' % (bitmap | (1 << index))
+            data['cursor'] = index + 1
+            data['leases'][str(index)] = {'pid': os.getpid(), 'vm_name': vm_name, 'time': time()}
+            return index
+
+    def release(self, index, vm_name=''):
+        """
+        Release lease. If vm_name is given, lease is released only if it is still owned by that VM.
+        """
+        with StateFile(self.path) as state:
+            data = self._load(state)
+            lease = data['leases'].get(str(index))
+            if not lease or (vm_name and lease.get('vm_name') != vm_name):
+                return
+            del data['leases'][str(index)]
+            data['bitmap'] = '%x' % (long(data['bitmap'], 16) & ~(1 << index))
+
+    def leases(self):
+        """
+        Return dict index: lease (pid, vm_name, time) of valid leases.
+        """
+        with StateFile(self.path) as state:
+            return dict([(int(index), lease) for index, lease in self._load(state)['leases'].items()])
+
+
+def pool(kind):
+    if kind == IP:
+        first_ip, count = ip_range()
+        size = count
+    elif kind == MAC:
+        size = 1 << (8 * (6 - len(settings.OSV_MAC_PREFIX.split(':'))))
+    else:
+        raise ValueError('Unknown lease pool %s' % kind)
+    return LeasePool(os.path.join(settings.OSV_WORK_DIR, 'lease-%s.json' % kind), size)
+
+
+def acquire_ip(vm_name='', index=None):
+    """
+    Lease static IP (with index given, that one), return (IP in CIDR notation 'ip/bits', lease index).
+    """
+    log = logging.getLogger(__name__)
+    index = pool(IP).acquire(vm_name, index)
+    first_ip, count = ip_range()
+    cidr = '%s/%d' % (first_ip + index, settings.OSV_IP_MASK)
+    log.info('Leased IP %s to VM %s', cidr, vm_name)
+    return cidr, index
+
+
+def acquire_mac(vm_name='', index=None):
+    """
+    Lease MAC address OSV_MAC_PREFIX:xx:xx (with index given, that one), return (MAC, lease index).
+    """
+    log = logging.getLogger(__name__)
+    index = pool(MAC).acquire(vm_name, index)
+    mac = format_mac(settings.OSV_MAC_PREFIX, index)
+    log.info('Leased MAC %s to VM %s', mac, vm_name)
+    return mac, index
+
+
+def release(kind, index, vm_name=''):
+    pool(kind).release(index, vm_name)
+
+##
@@ -0,0 +1,164 @@
+__author__ = 'justin_cinkelj'
+'''
+Host-wide ledger of CPUs and memory held by VMs, shared by all processes on the host.
+
+A process allocates VM size from the ledger before it starts the VM, and releases it
+after the VM is terminated. If the host is full, allocate waits (policy QUEUE, first come
+first served) or fails immediately (policy FAIL).
+
+Entries of dead owners are reclaimed: an entry with attached VM name is held as long as
+the libvirt domain is active (VM may outlive the process which started it) or the owner
+process is alive (domain is inactive for a while, e.g. during VM.save_snapshot), other
+entries as long as the owner process is alive.
+'''
+
+import os
+import os.path
+import logging
+from time import sleep, time
+
+import settings
+import connection
+from statefile import StateFile, pid_alive
+
+QUEUE = 'queue'
+FAIL = 'fail'
+
+
+class LedgerFull(Exception):
+    pass
+
+
+def ledger_path():
+    return os.path.join(settings.OSV_WORK_DIR, 'ledger.json')
+
+
+_host_size = None
+
+
+def host_size():
+    """
+    Return cpus, memory (in MB) of host. Read only once per process.
+    """
+    global _host_size
+    if _host_size is None:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024*1024)
+        _host_size = os.sysconf('SC_NPROCESSORS_ONLN'), memory
+    return _host_size
+
+
+def capacity():
+    """
+    Return cpus, memory (in MB) available to all VMs on host.
+    """
+    host_cpus, host_memory = host_size()
+    cpus = settings.OSV_LEDGER_CPUS or host_cpus
+    memory = settings.OSV_LEDGER_MEMORY or int(host_memory * settings.OSV_LEDGER_MEMORY_RATIO)
+    return cpus, memory
+
+
+def _reclaim(data):
+    log = logging.getLogger(__name__)
+    active = None
+    if [entry for entry in data['entries'].values() if entry.get('vm_name')]:
+        active = connection.active_domains()
+    for entry_id in data['entries'].keys():
+        entry = data['entries'][entry_id]
+        dead = not pid_alive(entry['pid'])
+        if entry.get('vm_name') and active is not None:
+            dead = dead and entry['vm_name'] not in active
+        if dead:
+            log.info('Reclaim ledger entry %s (pid %d, VM %s, %d cpus, %d MB)', entry_id, entry['pid'],
+                     entry.get('vm_name'), entry['cpus'], entry['memory'])
+            del data['entries'][entry_id]
+    data['waiting'] = [waiter for waiter in data['waiting'] if pid_alive(waiter['pid'])]
+
+
+def _load(state):
+    state.data.setdefault('entries', {})
+    state.data.setdefault('waiting', [])
+    _reclaim(state.data)
+    return state.data
+
+
+def _used(data):
+    cpus = sum([entry['cpus'] for entry in data['entries'].values()])
+    memory = sum([entry['memory'] for entry in data['entries'].values()])
+    return cpus, memory
+
+
+def allocate(cpus, memory, policy=None, timeout=None, poll_interval=0.2):
+    """
+    Allocate cpus and memory (MB) for a new VM, return ledger entry id.
+    policy QUEUE waits (at most timeout seconds) until there is enough free resources and
+    all earlier waiters are served, FAIL raises LedgerFull if host is full.
+    """
+    log = logging.getLogger(__name__)
+    policy = policy or settings.OSV_LEDGER_POLICY
+    if timeout is None:
+        timeout = settings.OSV_LEDGER_TIMEOUT
+    cap_cpus, cap_memory = capacity()
+    if cpus > cap_cpus or memory > cap_memory:
+        raise LedgerFull('VM size %d cpus, %d MB exceeds host capacity %d cpus, %d MB' %
+                         (cpus, memory, cap_cpus, cap_memory))
+    from uuid import uuid4
+    entry_id = str(uuid4())
+    deadline = time() + timeout
+    full_msg = ''
+    while not full_msg:
+        with StateFile(ledger_path()) as state:
+            data = _load(state)
+            used_cpus, used_memory = _used(data)
+            fits = used_cpus + cpus <= cap_cpus and used_memory + memory <= cap_memory
+            waiting_ids = [waiter['id'] for waiter in data['waiting']]
+            first = not waiting_ids or waiting_ids[0] == entry_id
+            if fits and first:
+                data['waiting'] = [waiter for waiter in data['waiting'] if waiter['id'] != entry_id]
+                data['entries'][entry_id] = {'pid': os.getpid(), 'cpus': cpus, 'memory': memory,
+                                             'vm_name': '', 'created': time()}
+                log.info('Ledger allocated %s: %d cpus, %d MB (used %d/%d cpus, %d/%d MB)', entry_id, cpus, memory,
+                         used_cpus + cpus, cap_cpus, used_memory + memory, cap_memory)
+                return entry_id
+            msg = 'Host is full, used %d/%d cpus, %d/%d MB, %d waiting, requested %d cpus, %d MB' % \
+                  (used_cpus, cap_cpus, used_memory, cap_memory, len(waiting_ids), cpus, memory)
+            if policy == FAIL or time() >= deadline:
+                # raised after state is saved
+                data['waiting'] = [waiter for waiter in data['waiting'] if waiter['id'] != entry_id]
+                full_msg = msg
+                continue
+            if entry_id not in waiting_ids:
+                log.info('%s, waiting', msg)
+                data['waiting'].append({'id': entry_id, 'pid': os.getpid()})
+        sleep(poll_interval)
+    raise LedgerFull(full_msg)
+
+
+def attach(entry_id, vm_name):
+    """
+    Record VM name of entry. Entry is then held as long as the VM is running.
+    """
+    with StateFile(ledger_path()) as state:
+        entry = _load(state)['entries'].get(entry_id)
+        if entry:
+            entry['vm_name'] = vm_name
+
+
+def release(entry_id):
+    log = logging.getLogger(__name__)
+    with StateFile(ledger_path()) as state:
+        if _load(state)['entries'].pop(entry_id, None):
+            log.info('Ledger released %s', entry_id)
+
+
+def usage():
+    """
+    Return dict with used and total cpus and memory, and number of entries and waiters.
+    """
+    with StateFile(ledger_path()) as state:
+        data = _load(state)
+        cpus, memory = _used(data)
+        cap_cpus, cap_memory = capacity()
+        return {'cpus': cpus, 'memory': memory, 'capacity_cpus': cap_cpus, 'capacity_memory': cap_memory,
+                'entries': len(data['entries']), 'waiting': len(data['waiting'])}
+
+##
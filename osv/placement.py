@@ -0,0 +1,244 @@
+__author__ = 'justin_cinkelj'
+'''
+vCPU pinning and NUMA placement of VMs.
+
+Host topology is read from sysfs. Each VM gets a set of host CPUs (pCPUs) which no other
+VM on the host uses, preferably on one NUMA node, and memory from the same node(s).
+Reserved pCPUs and node memory of all VMs are recorded in OSV_WORK_DIR/placement.json, so that
+concurrent processes (lin_proxy.py, osv_pool.py) pick disjoint sets, and do not bind more memory to
+a node than it has.
+'''
+
+import os
+import os.path
+import re
+import glob
+import logging
+
+import settings
+from statefile import StateFile, pid_alive
+
+
+class PlacementError(Exception):
+    pass
+
+
+def parse_cpulist(cpulist):
+    """
+    Parse sysfs/libvirt cpu list, '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """
+    Format cpu list, [0, 1, 2, 3, 8] -> '0-3,8'
+    """
+    parts = []
+    cpus = sorted(cpus)
+    ii = 0
+    while ii < len(cpus):
+        jj = ii
+        while jj + 1 < len(cpus) and cpus[jj + 1] == cpus[jj] + 1:
+            jj += 1
+        parts.append(str(cpus[ii]) if ii == jj else '%d-%d' % (cpus[ii], cpus[jj]))
+        ii = jj + 1
+    return ','.join(parts)
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as fin:
+            return fin.read().strip()
+    except IOError:
+        return default
+
+
+class Topology:
+    """
+    Host CPU topology.
+    nodes - dict NUMA node: list of cpus, ordered so that hyperthread siblings are adjacent.
+    node_memory - dict NUMA node: memory in MiB.
+    """
+    def __init__(self, nodes, node_memory=None):
+        self.nodes = nodes
+        self.node_memory = node_memory or {}
+
+    @classmethod
+    def read(cls, sysfs_root='/sys'):
+        cpu_dir = os.path.join(sysfs_root, 'devices/system/cpu')
+        node_dir = os.path.join(sysfs_root, 'devices/system/node')
+        online = parse_cpulist(_read(os.path.join(cpu_dir, 'online'), ''))
+        # (package, core) of each cpu
+        core_of = {}
+        for cpu in online:
+            topo_dir = os.path.join(cpu_dir, 'cpu%d/topology' % cpu)
+            core_of[cpu] = (int(_read(os.path.join(topo_dir, 'physical_package_id'), 0)),
+                            int(_read(os.path.join(topo_dir, 'core_id'), cpu)))
+        nodes = {}
+        node_memory = {}
+        for path in glob.glob(os.path.join(node_dir, 'node[0-9]*')):
+            node = int(os.path.basename(path)[4:])
+            cpus = [cpu for cpu in parse_cpulist(_read(os.path.join(path, 'cpulist'), '')) if cpu in core_of]
+            if not cpus:
+                # memory-only node
+                continue
+            nodes[node] = cpus
+            # 'Node 0 MemTotal:       16318388 kB'
+            match = re.search(r'MemTotal:\s+(\d+) kB', _read(os.path.join(path, 'meminfo'), ''))
+            if match:
+                node_memory[node] = int(match.group(1)) / 1024
+        if not nodes:
+            # kernel without NUMA support
+            nodes[0] = online
+        for node in nodes:
+            nodes[node] = sorted(nodes[node], key=lambda cpu: (core_of[cpu], cpu))
+        return cls(nodes, node_memory)
+
+    def cpu_count(self):
+        return sum([len(cpus) for cpus in self.nodes.values()])
+
+
+class Placement:
+    """
+    pCPUs and memory of one VM.
+    cells - list of (node, pcpus, memory MiB), one guest NUMA cell per used host node.
+    vCPUs are numbered consecutively over cells.
+    """
+    def __init__(self, cells):
+        self.cells = cells
+
+    def pcpus(self):
+        return sum([list(pcpus) for node, pcpus, memory in self.cells], [])
+
+    def nodes(self):
+        return [node for node, pcpus, memory in self.cells]
+
+    def template_param(self):
+        """
+        Return dict used by domain XML template (cputune, numatune, cpu numa).
+        """
+        pcpus = self.pcpus()
+        cells = []
+        vcpu = 0
+        for ii, (node, cell_pcpus, memory) in enumerate(self.cells):
+            cells.append({'id': ii, 'node': node, 'memory': memory,
+                          'vcpus': format_cpulist(range(vcpu, vcpu + len(cell_pcpus)))})
+            vcpu += len(cell_pcpus)
+        param = {'cpuset': format_cpulist(pcpus),
+                 'vcpupin': list(enumerate(pcpus)),
+                 'nodeset': format_cpulist(self.nodes()),
+                 'cells': cells,
+                 'topology': None}
+        sizes = set([len(cell_pcpus) for node, cell_pcpus, memory in self.cells])
+        if len(sizes) == 1:
+            # sockets * cores * threads must match vcpu count
+            param['topology'] = {'sockets': len(self.cells), 'cores': sizes.pop(), 'threads': 1}
+        return param
+
+
+def place(topology, vcpus, memory, used_cpus=(), used_memory=None):
+    """
+    Pick pCPUs for VM with vcpus vCPUs and memory MiB, avoiding used_cpus.
+    used_memory - dict node: MiB held by other VMs. Memory is checked only on nodes with known size
+    (topology.node_memory).
+    The smallest node with enough free cpus and memory is used (best fit), so large holes remain for large VMs.
+    If no node is large enough, VM spans nodes with most free cpus.
+    Returns Placement, raises PlacementError if there is not enough free cpus or memory.
+    """
+    used_cpus = set(used_cpus)
+    used_memory = used_memory or {}
+    free = dict([(node, [cpu for cpu in cpus if cpu not in used_cpus]) for node, cpus in topology.nodes.items()])
+    # None - unknown, not checked
+    free_memory = dict([(node, topology.node_memory[node] - used_memory.get(node, 0)
+                         if node in topology.node_memory else None) for node in free])
+
+    def memory_fits(node, size):
+        return free_memory[node] is None or free_memory[node] >= size
+
+    fitting = [node for node in free if len(free[node]) >= vcpus and memory_fits(node, memory)]
+    if fitting:
+        node = min(fitting, key=lambda nn: (len(free[nn]), nn))
+        return Placement([(node, free[node][:vcpus], memory)])
+
+    picked = []
+    remaining = vcpus
+    for node in sorted(free, key=lambda nn: (-len(free[nn]), nn)):
+        if remaining <= 0:
+            break
+        # node without free memory would get a cell with no memory
+        if free[node] and memory_fits(node, 1):
+            picked.append((node, free[node][:remaining]))
+            remaining -= len(picked[-1][1])
+    if remaining > 0:
+        raise PlacementError('Not enough free host cpus for %d vcpus (%d of %d free)' %
+                             (vcpus, vcpus - remaining, topology.cpu_count()))
+    # memory split proportional to cpus, last cell gets rounding remainder;
+    # cell is limited to node free memory, what does not fit goes to nodes with memory to spare
+    cells = []
+    memory_left = memory
+    for ii, (node, pcpus) in enumerate(picked):
+        cell_memory = memory_left if ii == len(picked) - 1 else memory * len(pcpus) / vcpus
+        if free_memory[node] is not None:
+            cell_memory = min(cell_memory, free_memory[node])
+        memory_left -= cell_memory
+        cells.append([node, pcpus, cell_memory])
+    for cell in cells:
+        if memory_left <= 0:
+            break
+        node = cell[0]
+        extra = memory_left if free_memory[node] is None else min(memory_left, free_memory[node] - cell[2])
+        cell[2] += extra
+        memory_left -= extra
+    if memory_left > 0:
+        raise PlacementError('Not enough free memory for %d MiB on nodes %s (%d MiB missing)' %
+                             (memory, format_cpulist([node for node, pcpus in picked]), memory_left))
+    return Placement([tuple(cell) for cell in cells])
+
+
+def registry_path():
+    return os.path.join(settings.OSV_WORK_DIR, 'placement.json')
+
+
+def reserve(vm_name, vcpus, memory, topology=None):
+    """
+    Place VM and record its pCPUs and memory per node in host registry. Entries of dead processes are dropped first.
+    """
+    log = logging.getLogger(__name__)
+    topology = topology or Topology.read()
+    with StateFile(registry_path()) as state:
+        for name in state.data.keys():
+            if not pid_alive(state.data[name]['pid']):
+                log.info('Drop placement of %s, process %d is gone', name, state.data[name]['pid'])
+                del state.data[name]
+        used_cpus = sum([entry['cpus'] for entry in state.data.values()], [])
+        used_memory = {}
+        for entry in state.data.values():
+            for node, node_memory in entry.get('memory', []):
+                used_memory[node] = used_memory.get(node, 0) + node_memory
+        placement = place(topology, vcpus, memory, used_cpus, used_memory)
+        # memory as [node, MiB] pairs, json keys would be strings
+        state.data[vm_name] = {'pid': os.getpid(), 'cpus': placement.pcpus(), 'nodes': placement.nodes(),
+                               'memory': [[node, cell_memory] for node, pcpus, cell_memory in placement.cells]}
+    log.info('VM %s placed on cpus %s, nodes %s', vm_name,
+             format_cpulist(placement.pcpus()), format_cpulist(placement.nodes()))
+    return placement
+
+
+def release(vm_name):
+    """
+    Remove VM from host registry.
+    """
+    with StateFile(registry_path()) as state:
+        state.data.pop(vm_name, None)
+
+##
@@ -0,0 +1,298 @@
+'''
+Pool of pre-booted VMs (default cli.so app), so that a VM can be claimed instead of cold-booted.
+
+Pool state is kept in directory OSV_WORK_DIR/pool, one json file per VM:
+    ready/   - VM is up, waiting to be claimed
+    claimed/ - VM is used by some lin_proxy
+    done/    - VM was released, pool manager will destroy it
+Files are moved between directories with os.rename, which is atomic - only one
+of concurrent lin_proxy processes can claim a VM.
+'''
+
+import logging
+import os
+import os.path
+import errno
+import threading
+import simplejson
+from time import sleep, time
+import libvirt
+from vm import VM
+import ledger
+import placement
+import snapshot
+import trace
+import settings
+
+READY = 'ready'
+CLAIMED = 'claimed'
+DONE = 'done'
+
+
+def pool_dir(state=''):
+    return os.path.join(settings.OSV_WORK_DIR, 'pool', state)
+
+
+def _make_dirs():
+    for state in [READY, CLAIMED, DONE]:
+        try:
+            os.makedirs(pool_dir(state))
+        except OSError as ex:
+            # dir might be created by concurrent process
+            if ex.errno != errno.EEXIST:
+                raise
+
+
+def _record_path(state, name):
+    return os.path.join(pool_dir(state), name + '.json')
+
+
+def _read_record(path):
+    with open(path) as fin:
+        return simplejson.load(fin)
+
+
+# write to tmp file, then rename - readers never see partial record
+def _write_record(state, rec):
+    tmp_path = os.path.join(pool_dir(), '.%s.json.tmp' % rec['name'])
+    with open(tmp_path, 'w') as fout:
+        simplejson.dump(rec, fout)
+    os.rename(tmp_path, _record_path(state, rec['name']))
+
+
+def _records(state):
+    recs = []
+    if not os.path.isdir(pool_dir(state)):
+        return recs
+    for file_name in sorted(os.listdir(pool_dir(state))):
+        path = os.path.join(pool_dir(state), file_name)
+        try:
+            recs.append((path, _read_record(path)))
+        except (IOError, OSError, ValueError):
+            # file was just moved away
+            pass
+    return recs
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+def _vm_from_record(rec):
+    """
+    Return VM object for VM started by pool manager, or None if libvirt domain does not exist any more.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        vm = VM.connect_to_existing(rec['ip'], rec['name'])
+    except libvirt.libvirtError as ex:
+        log.info('Pool VM %s not found: %s', rec['name'], ex.get_error_message())
+        return None
+    return _restore_resources(vm, rec)
+
+
+def _restore_resources(vm, rec):
+    """
+    Restore image copy, image cache key, snapshot, leases and placement of VM from its record,
+    so that vm.terminate() releases them (also if VM has no libvirt domain any more).
+    """
+    vm._param._vm_name = rec['name']
+    vm._param._use_image_copy = True
+    vm._param._image_orig = rec['image_orig']
+    vm._param._in_use_image = rec['image']
+    vm._param._image_cache_key = rec.get('image_cache_key', '')
+    if rec.get('snapshot_key'):
+        vm._snapshot = snapshot.Snapshot(rec['snapshot_key'])
+    vm._param._leases = [tuple(kind_index) for kind_index in rec.get('leases', [])]
+    if rec.get('placement'):
+        vm._placement = placement.Placement([tuple(cell) for cell in rec['placement']])
+    vm._console_log = rec['console_log']
+    vm._console_mode = rec.get('console_mode', vm._console_mode)
+    return vm
+
+
+def claim(cpus, memory):
+    """
+    Claim a ready VM with given cpus and memory size.
+    Return VM with console log positioned after boot messages, or None if no VM is available.
+    """
+    log = logging.getLogger(__name__)
+    for src, rec in _records(READY):
+        if rec['cpus'] != cpus or rec['memory'] != memory:
+            continue
+        dst = _record_path(CLAIMED, rec['name'])
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # claimed by someone else
+            continue
+        rec['claimed_pid'] = os.getpid()
+        _write_record(CLAIMED, rec)
+        vm = _vm_from_record(rec)
+        if not vm or not vm.is_up():
+            log.info('Pool VM %s is not up, skip it', rec['name'])
+            if vm:
+                vm._unwatch_state()
+            os.rename(dst, _record_path(DONE, rec['name']))
+            continue
+        vm._open_console(skip_existing=True)
+        # boot messages are skipped, IP and cmd prompt are never seen on console
+        vm._child_cmdline_up = True
+        vm._drop_boot_matchers()
+        log.info('Claimed pool VM %s, ip %s', rec['name'], rec['ip'])
+        return vm
+    return None
+
+
+def release(vm):
+    """
+    Hand claimed VM back to pool manager, it will be destroyed.
+    """
+    log = logging.getLogger(__name__)
+    name = vm._param._vm_name
+    log.info('Release pool VM %s', name)
+    vm._close_console()
+    os.rename(_record_path(CLAIMED, name), _record_path(DONE, name))
+
+
+class VMPool:
+    """
+    Keep size VMs booted and ready to be claimed.
+    vm_kwargs_fn() returns kwargs for VM(), it is called for each new VM (e.g. to get a new MAC/IP).
+    """
+    def __init__(self, size, vm_kwargs_fn, boot_parallel=2):
+        self._size = size
+        self._vm_kwargs_fn = vm_kwargs_fn
+        self._boot_parallel = boot_parallel
+        self._booting = 0
+        self._lock = threading.Lock()
+        self._threads = []
+        _make_dirs()
+
+    def ready_count(self):
+        return len(os.listdir(pool_dir(READY)))
+
+    def refill(self):
+        """
+        Start background boot of missing VMs.
+        """
+        self._threads = [th for th in self._threads if th.is_alive()]
+        with self._lock:
+            missing = self._size - self.ready_count() - self._booting
+            count = min(missing, self._boot_parallel - self._booting)
+            self._booting += max(count, 0)
+        for ii in range(count):
+            th = threading.Thread(target=self._boot)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def _boot(self):
+        log = logging.getLogger(__name__)
+        try:
+            kwargs = self._vm_kwargs_fn()
+            # pool VM does not wait for free resources, lin_proxy might be waiting too
+            # size not given in kwargs is VMParam default
+            try:
+                ledger_id = ledger.allocate(kwargs.get('cpus', 1), kwargs.get('memory', 512), policy=ledger.FAIL)
+            except ledger.LedgerFull as ex:
+                log.info('Pool VM not booted: %s', ex)
+                return
+            try:
+                vm = VM(tracer=trace.begin('pool'), **kwargs)
+            except Exception as ex:
+                log.error('Pool VM create failed: %s', ex)
+                ledger.release(ledger_id)
+                return
+            try:
+                vm.run()
+                ledger.attach(ledger_id, vm._param._vm_name)
+                # VM is put into pool only when REST api is up
+                vm.wait_up(api=True)
+            except Exception as ex:
+                log.error('Pool VM %s boot failed: %s', vm._log_name(), ex)
+                vm._trace.finish('error', error=str(ex))
+                vm.terminate()
+                ledger.release(ledger_id)
+                return
+            rec = {'name': vm._param._vm_name,
+                   'ip': vm._ip,
+                   'mac': vm._param._net_mac,
+                   'cpus': vm._param._cpus,
+                   'memory': vm._param._memory,
+                   'image_orig': vm._param._image_orig,
+                   'image': vm._param._in_use_image,
+                   'image_cache_key': vm._param._image_cache_key,
+                   'snapshot_key': vm._snapshot.key if vm._snapshot else '',
+                   'console_log': vm._console_log,
+                   'console_mode': vm._console_mode,
+                   'pool_pid': os.getpid(),
+                   'ledger_id': ledger_id,
+                   'leases': vm._param._leases,
+                   'placement': vm._placement.cells if vm._placement else [],
+                   'created': time(),
+                   }
+            vm._close_console()
+            _write_record(READY, rec)
+            vm._trace.finish()
+            log.info('Pool VM %s ready, ip %s', rec['name'], rec['ip'])
+        except Exception:
+            # refill boots a replacement, boot thread must not die silently
+            log.exception('Pool VM boot failed')
+        finally:
+            with self._lock:
+                self._booting -= 1
+
+    def _destroy(self, path, rec):
+        log = logging.getLogger(__name__)
+        log.info('Destroy pool VM %s', rec['name'])
+        vm = _vm_from_record(rec)
+        if vm is None:
+            # domain is gone (e.g. VM crashed), release image, leases etc. of VM without domain
+            vm = _restore_resources(VM.connect_to_existing(rec['ip']), rec)
+        vm.terminate()
+        if rec.get('ledger_id'):
+            ledger.release(rec['ledger_id'])
+        os.remove(path)
+
+    def destroy_released(self):
+        """
+        Destroy VMs released by users, and claimed VMs which are not used any more
+        (VM is down, or lin_proxy which claimed it is dead).
+        """
+        for path, rec in _records(DONE):
+            self._destroy(path, rec)
+        for path, rec in _records(CLAIMED):
+            vm = _vm_from_record(rec)
+            claimed_pid = rec.get('claimed_pid')
+            if vm:
+                # _destroy uses VM object of its own
+                vm._unwatch_state()
+            if not vm or not vm.is_up() or (claimed_pid and not _pid_alive(claimed_pid)):
+                self._destroy(path, rec)
+
+    def serve(self, interval=1.0):
+        while True:
+            self.destroy_released()
+            self.refill()
+            sleep(interval)
+
+    def shutdown(self):
+        """
+        Destroy all ready VMs. Claimed VMs are destroyed after release, by next pool manager.
+        """
+        for th in self._threads:
+            th.join()
+        for path, rec in _records(READY):
+            dst = _record_path(DONE, rec['name'])
+            try:
+                os.rename(path, dst)
+            except OSError:
+                continue
+            self._destroy(dst, rec)
+
+##
@@ -0,0 +1,173 @@
+__author__ = 'justin_cinkelj'
+'''
+Readiness of a booting VM - all conditions are checked concurrently, with one overall deadline.
+
+Probes:
+    active     - libvirt domain is running
+    ip         - VM IP is known (static IP, or 'eth0: <ip>' on console with DHCP)
+    cmd_prompt - cli.so command prompt is on console
+    api        - REST api answers GET /os/uptime
+
+Console and libvirt probes are checked whenever console is written or domain state changes,
+so readiness is detected at the moment VM gets ready, not at the next poll step.
+The api probe runs in its own thread once IP is known. Connection refused is retried after a short
+backoff, and immediately when OSv prints that REST server is running.
+
+wait_ready returns as soon as all probes are done. It raises ReadyTimeout naming the probes
+which did not finish (with their last error), or VMStopped if VM stops while booting.
+'''
+
+import os
+import logging
+import threading
+from time import time
+
+import events
+from events import _pipe, _notify, _drain
+
+ACTIVE = 'active'
+IP = 'ip'
+CMD_PROMPT = 'cmd_prompt'
+API = 'api'
+
+API_UP_PATTERN = r'^Rest API server running'
+API_RETRY_MIN = 0.01
+API_RETRY_MAX = 0.1
+
+
+class ReadyError(Exception):
+    """
+    pending - probes which are not done, errors - dict probe: last error message,
+    output - console output read while waiting.
+    """
+    def __init__(self, message, pending, errors, output):
+        Exception.__init__(self, message)
+        self.pending = pending
+        self.errors = errors
+        self.output = output
+
+
+class ReadyTimeout(ReadyError):
+    pass
+
+
+class VMStopped(ReadyError):
+    pass
+
+
+class _Readiness:
+    def __init__(self, vm, probes):
+        self.vm = vm
+        self.probes = probes
+        self.done = {}  # probe: seconds from start
+        self.errors = {}  # probe: last error message
+        self.output = ''
+        self._t0 = time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._api_kick = threading.Event()
+        self._api_thread = None
+        self._wake_r, self._wake_w = _pipe()
+
+    def _set_done(self, probe):
+        with self._lock:
+            if probe not in self.done:
+                self.done[probe] = time() - self._t0
+
+    def _domain_stopped(self):
+        vm = self.vm
+        if vm._use_events():
+            return vm._state.state in [events.STOPPED, events.CRASHED, events.SHUTDOWN]
+        return not vm._is_active()
+
+    def _check(self, deadline):
+        """
+        Update done probes from VM state, raise VMStopped if domain stopped after it was started.
+        """
+        vm = self.vm
+        if ACTIVE in self.probes:
+            if ACTIVE in self.done:
+                if self._domain_stopped():
+                    raise VMStopped('VM %s stopped while booting' % vm._param._vm_name,
+                                    self._pending(), self.errors, self.output)
+            elif (vm._use_events() and vm._state.state == events.STARTED) or vm._is_active():
+                self._set_done(ACTIVE)
+        if vm._ip:
+            self._set_done(IP)
+            if API in self.probes and self._api_thread is None:
+                self._api_thread = threading.Thread(target=self._probe_api, args=(deadline,), name='ready-api')
+                self._api_thread.daemon = True
+                self._api_thread.start()
+        if vm._child_cmdline_up:
+            self._set_done(CMD_PROMPT)
+
+    def _pending(self):
+        with self._lock:
+            return [probe for probe in self.probes if probe not in self.done]
+
+    def _probe_api(self, deadline):
+        log = logging.getLogger(__name__)
+        # circular dependency import
+        import api
+        import requests.exceptions
+        base = api.BaseApi(self.vm)
+        uri = 'http://%s:%d/os/uptime' % (self.vm._ip, self.vm._api_port)
+        delay = API_RETRY_MIN
+        while not self._stop.is_set():
+            try:
+                # request does not outlive the deadline, run() joins this thread
+                base._request('GET', uri, retries=0, timeout=max(min(1.0, deadline - time()), 0.01))
+                self.vm._api_up = True
+                self._set_done(API)
+                _notify(self._wake_w)
+                return
+            except requests.exceptions.RequestException as ex:
+                self.errors[API] = str(ex)
+                log.debug('API %s not up yet: %s', uri, ex)
+            self._api_kick.wait(delay)
+            self._api_kick.clear()
+            delay = min(2 * delay, API_RETRY_MAX)
+
+    def run(self, timeout, poll_interval):
+        log = logging.getLogger(__name__)
+        vm = self.vm
+        deadline = self._t0 + timeout
+        if API in self.probes:
+            vm.add_console_matcher('ready_api', API_UP_PATTERN, lambda mm: self._api_kick.set(), once=True)
+        try:
+            while True:
+                self.output += vm.read_std()
+                self._check(deadline)
+                pending = self._pending()
+                if not pending:
+                    log.info('VM %s ready in %.3f s (%s)', vm._param._vm_name, time() - self._t0,
+                             ', '.join(['%s %.3f s' % (probe, self.done[probe]) for probe in self.probes]))
+                    return self.output
+                remaining = deadline - time()
+                if remaining <= 0:
+                    errors = ''.join(['; %s: %s' % (probe, self.errors[probe])
+                                      for probe in pending if probe in self.errors])
+                    raise ReadyTimeout('VM %s not ready after %.1f s, waiting for %s%s' %
+                                       (vm._param._vm_name, timeout, ', '.join(pending), errors),
+                                       pending, self.errors, self.output)
+                vm.wait_console(remaining, poll_interval, [self._wake_r])
+                _drain(self._wake_r)
+        finally:
+            if API in self.probes:
+                vm.remove_console_matcher('ready_api')
+            self._stop.set()
+            self._api_kick.set()
+            if self._api_thread:
+                self._api_thread.join()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+
+
+def wait_ready(vm, probes, timeout, poll_interval=0.1):
+    """
+    Wait until all probes are done, at most timeout seconds. Return console output read while waiting.
+    poll_interval is used only if console change notification (inotify) is not available.
+    """
+    return _Readiness(vm, probes).run(timeout, poll_interval)
+
+##
@@ -7,7 +7,83 @@ import os
 # where is OSv source code (scripts/run.py and friends)
 OSV_SRC = '/opt/osv-src'
 OSV_BRIDGE = 'virbr0'
+OSV_LIBVIRT_URI = 'qemu:///system'
+OSV_LIBVIRT_EVENTS = True  # use domain lifecycle events instead of polling isActive()
+OSV_TRANSIENT_DOMAIN = False  # start VM with createXML (nothing to undefine) instead of defineXML + create
+OSV_PIN_CPUS = False  # pin vCPUs to host cpus not used by other VMs, and memory to same NUMA node(s)
 OSV_CLI_APP = '/cli/cli.so'  # path to cli app inside OSv VMs
 OSV_API_PORT = 8000
+# static IP/MAC leases (osv.lease) - IPs OSV_IP_SUBNET/OSV_IP_MASK + [OSV_IP_MIN, OSV_IP_MAX]
+OSV_IP_SUBNET = '192.168.122.0'
+OSV_IP_MASK = 24
+OSV_IP_MIN = 200
+OSV_IP_MAX = 250
+OSV_MAC_PREFIX = '52:54:00:4f'  # leased MACs are OSV_MAC_PREFIX:xx:xx
+# REST api - timeouts in seconds, number of retries on connection error, keep-alive connections per VM
+OSV_API_CONNECT_TIMEOUT = 5
+OSV_API_READ_TIMEOUT = 30
+OSV_API_RETRIES = 2
+OSV_API_POOL_SIZE = 10
+# osv.ready - max seconds until booted VM is up (VM.wait_up), and until REST api answers (BaseApi.wait_up)
+OSV_READY_TIMEOUT = 15
+OSV_API_READY_TIMEOUT = 5
+# osv.completion - app started with App.run is finished when its thread is gone (REST api is polled each
+# OSV_APP_POLL_INTERVAL seconds), or when a console line matches OSV_APP_EXIT_PATTERN (group 1 is exit status),
+# e.g. r'^app exited with status (-?\d+)'. OSv does not print exit status by itself, the app (or a wrapper
+# script) has to print the marker. Empty pattern disables matching, app output is then forwarded
+# without being read into python (see VM.forward_std).
+OSV_APP_POLL_INTERVAL = 0.5
+OSV_APP_EXIT_PATTERN = ''
+# VM.forward_std - max bytes of console output moved at once
+OSV_CONSOLE_CHUNK = 256 * 1024
+# VM serial console - 'file' is written by qemu to OSV_WORK_DIR/<vm>-console.log and tailed from there,
+# 'stream' is a pty read via libvirt console stream into memory (see osv.console.ConsoleStream), nothing is
+# written to OSV_WORK_DIR unless OSV_CONSOLE_CAPTURE is set. In 'stream' mode, at most OSV_CONSOLE_BUFFER
+# bytes are buffered, then guest console output is paused until it is read.
+OSV_CONSOLE_MODE = 'file'
+OSV_CONSOLE_CAPTURE = False
+OSV_CONSOLE_BUFFER = 1024 * 1024
+
+# osv.fleet.Fleet - worker threads per launch stage (image copy, imgedit, libvirt start)
+OSV_FLEET_WORKERS = 4
+
+# osv.ledger - host cpus/memory shared by all VMs. 0 means all host cpus, OSV_LEDGER_MEMORY_RATIO of host memory.
+OSV_LEDGER_CPUS = 0
+OSV_LEDGER_MEMORY = 0  # MB
+OSV_LEDGER_MEMORY_RATIO = 0.9
+OSV_LEDGER_POLICY = 'queue'  # if host is full, 'queue' waits for free resources, 'fail' fails immediately
+OSV_LEDGER_TIMEOUT = 600  # max wait in 'queue' policy, seconds
 
 OSV_WORK_DIR = os.environ['HOME'] + '/osv-work'  # can be auto-generated
+
+# osv.trace - append launch phase timings to OSV_TRACE_FILE (default OSV_WORK_DIR/trace.jsonl)
+OSV_TRACE = False
+OSV_TRACE_FILE = ''
+
+# VMParam(use_image_copy=True) - 'copy' makes full image copy, 'overlay' makes thin qcow2 overlay
+OSV_IMAGE_COPY_MODE = 'copy'
+OSV_QEMU_IMG = 'qemu-img'
+# osv.imagecache - with use_image_copy=True, take images already configured by imgedit.py from a host-wide
+# cache (reflink clone or qcow2 overlay), instead of copying image and running imgedit.py for each VM.
+# Least recently used images are removed when cache is larger than OSV_IMAGE_CACHE_SIZE MB.
+OSV_IMAGE_CACHE = False
+OSV_IMAGE_CACHE_DIR = ''  # default OSV_WORK_DIR/image-cache
+OSV_IMAGE_CACHE_SIZE = 4096
+# osv.snapshot - with use_image_copy=True, VM booted to cli.so prompt is saved (libvirt save) to OSV_SNAPSHOT_DIR,
+# and later VMs with same image, command line, size and console mode are restored from it instead of booted.
+# Saved state includes MAC and IP, so a snapshot is used by one VM at a time - VMs with leased IP/MAC take over
+# leases of a free snapshot. Least recently used snapshots are removed when larger than OSV_SNAPSHOT_SIZE MB.
+OSV_SNAPSHOT = False
+OSV_SNAPSHOT_DIR = ''  # default OSV_WORK_DIR/snapshot
+OSV_SNAPSHOT_SIZE = 16384
+
+
+def update(values):
+    '''
+    Set OSV_* settings from dict values (e.g. globals() of conf.settings, after its local_settings).
+    Names which are not settings here are ignored.
+    '''
+    settings = globals()
+    for name, value in values.items():
+        if name.startswith('OSV_') and name in settings:
+            settings[name] = value
@@ -0,0 +1,259 @@
+__author__ = 'justin_cinkelj'
+'''
+Saved VM state (libvirt save), shared by all processes on the host - VM is restored from it in about the
+time of reading its memory, instead of being booted.
+
+A VM booted to cli.so prompt is saved by VM.wait_up to OSV_SNAPSHOT_DIR (default OSV_WORK_DIR/snapshot):
+    <key>.save - memory and device state, written by libvirt
+    <key>.img  - VM image at the moment of save, restored VMs get a clone (or qcow2 overlay) of it
+VM is restored with its own name, image and console, but libvirt requires same UUID and MAC as the saved
+domain, and OSv configured its IP while booting. So the key includes MAC and IP, and each snapshot is
+used by one running VM at a time. A VM with leased MAC/IP takes over leases of a free snapshot with the
+same family_key (image, command line, VM size, ...), so VMs with fresh leases still find a snapshot.
+
+Users of a snapshot are tracked as in osv.imagecache - a user is dropped when its process is dead and its
+VM is not running any more. Least recently used snapshots without users are removed when all snapshots
+are larger than OSV_SNAPSHOT_SIZE MB.
+'''
+
+import os
+import os.path
+import errno
+import shutil
+import hashlib
+import logging
+from subprocess import check_call
+from time import time
+
+import settings
+import connection
+import imagecache
+import lease
+from statefile import StateFile, pid_alive
+
+
+def snapshot_dir():
+    return settings.OSV_SNAPSHOT_DIR or os.path.join(settings.OSV_WORK_DIR, 'snapshot')
+
+
+def _make_dir():
+    try:
+        os.makedirs(snapshot_dir())
+        # libvirtd (or qemu) writes saved state
+        os.chmod(snapshot_dir(), 0777)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def _index():
+    _make_dir()
+    return StateFile(os.path.join(snapshot_dir(), 'index.json'))
+
+
+def _load(state):
+    data = state.data
+    data.setdefault('entries', {})
+    data.setdefault('stats', {'hits': 0, 'misses': 0, 'saves': 0, 'failures': 0, 'evictions': 0})
+    return data
+
+
+def _sha1(parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part)
+        sha.update('\0')
+    return sha.hexdigest()
+
+
+class Snapshot:
+    """
+    Snapshot key. entry (uuid, ip, leases, ...) is None until VM state is saved.
+    """
+    def __init__(self, key, family='', entry=None):
+        self.key = key
+        self.family = family
+        self.entry = entry
+
+    @property
+    def state_path(self):
+        return os.path.join(snapshot_dir(), self.key + '.save')
+
+    @property
+    def image_path(self):
+        return os.path.join(snapshot_dir(), self.key + '.img')
+
+    def exists(self):
+        return os.path.exists(self.state_path) and os.path.exists(self.image_path)
+
+
+def family_key(vm):
+    """
+    Return sha1 of everything a restored VM depends on, except leased MAC/IP - original image content,
+    OSv command line, libvirt domain XML (VM size, console mode, ...) and hypervisor version.
+    """
+    param = vm._param
+    leased = dict(param._leases)
+    xml = vm._domain_xml(name='', image_file='', image_backing_file='', console_log='',
+                         net_mac='' if lease.MAC in leased else param._net_mac)
+    command_line = param._full_command_line
+    if lease.IP in leased:
+        command_line = command_line.replace(param._net_ip.split('/')[0], '')
+    version = connection.call(lambda conn: conn.getVersion())
+    return _sha1([imagecache.image_digest(param._image_orig), str(version), xml, command_line])
+
+
+def _expire_users(data):
+    log = logging.getLogger(__name__)
+    users = [(entry, vm_name, pid) for entry in data['entries'].values() for vm_name, pid in entry['users'].items()]
+    if not users:
+        return
+    active = connection.active_domains()
+    for entry, vm_name, pid in users:
+        if pid_alive(pid) or active is None or vm_name in active:
+            continue
+        log.info('Drop snapshot user %s (pid %d)', vm_name, pid)
+        del entry['users'][vm_name]
+
+
+def _usable(key, entry):
+    return not entry['users'] and not entry.get('failed') and Snapshot(key).exists()
+
+
+def find(vm):
+    """
+    Return Snapshot to restore vm from, vm is registered as its user. If there is no snapshot with VM MAC/IP,
+    and VM MAC/IP are leased, VM takes over leases of a free snapshot of same family (see VMParam.adopt_leases).
+    Return Snapshot without entry if there is none (VM.wait_up saves it then), or None if snapshot with
+    VM MAC/IP is used by another VM.
+    """
+    log = logging.getLogger(__name__)
+    param = vm._param
+    family = family_key(vm)
+    key = _sha1([family, param._net_ip, param._net_mac])
+    leased = set(dict(param._leases).keys())
+    with _index() as state:
+        data = _load(state)
+        _expire_users(data)
+        entry = data['entries'].get(key)
+        if entry and entry['users']:
+            log.info('Snapshot %s is used by %s', key, ', '.join(entry['users'].keys()))
+            return None
+        if entry and not _usable(key, entry):
+            entry = None
+        if entry is None and leased:
+            free = [(cand['last_used'], cand_key) for cand_key, cand in data['entries'].items()
+                    if cand['family'] == family and set(cand['leases'].keys()) == leased and _usable(cand_key, cand)]
+            for last_used, cand_key in sorted(free, reverse=True):
+                if param.adopt_leases(data['entries'][cand_key]['leases']):
+                    key, entry = cand_key, data['entries'][cand_key]
+                    break
+        if entry is None:
+            data['stats']['misses'] += 1
+            return Snapshot(key, family)
+        entry['users'][param._vm_name] = os.getpid()
+        entry['last_used'] = time()
+        data['stats']['hits'] += 1
+        log.info('Snapshot %s for VM %s', key, param._vm_name)
+        return Snapshot(key, family, dict(entry))
+
+
+def _flatten(src, dest):
+    # qcow2 overlay -> standalone image
+    check_call([settings.OSV_QEMU_IMG, 'convert', '-q', '-O', 'qcow2', src, dest])
+
+
+def add(snap, vm_name, state_file, image, backing_file, uuid, ip, leases):
+    """
+    Store VM state saved by libvirt to state_file, and VM image (flattened if it is overlay of backing_file),
+    as snapshot snap. Both files are moved. VM vm_name is registered as user, snap.entry is set.
+    """
+    log = logging.getLogger(__name__)
+    image_tmp = '%s.%d.tmp' % (snap.image_path, os.getpid())
+    try:
+        if backing_file:
+            _flatten(image, image_tmp)
+            os.remove(image)
+        else:
+            shutil.move(image, image_tmp)
+        os.rename(state_file, snap.state_path)
+        os.rename(image_tmp, snap.image_path)
+    except:
+        for path in [state_file, image_tmp]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    size = os.path.getsize(snap.state_path) + os.path.getsize(snap.image_path)
+    log.info('Saved snapshot %s of VM %s (%d bytes)', snap.key, vm_name, size)
+    entry = {'family': snap.family, 'uuid': uuid, 'ip': ip, 'leases': leases, 'size': size,
+             'created': time(), 'last_used': time(), 'users': {vm_name: os.getpid()}}
+    with _index() as state:
+        data = _load(state)
+        data['entries'][snap.key] = entry
+        data['stats']['saves'] += 1
+        _evict(data)
+    snap.entry = entry
+
+
+def discard(snap):
+    """
+    Restore from snap failed, do not use it any more. Files are removed when it has no users.
+    """
+    with _index() as state:
+        data = _load(state)
+        entry = data['entries'].get(snap.key)
+        if entry:
+            entry['failed'] = True
+        data['stats']['failures'] += 1
+        _evict(data)
+
+
+def release(key, vm_name):
+    with _index() as state:
+        data = _load(state)
+        entry = data['entries'].get(key)
+        if entry:
+            entry['users'].pop(vm_name, None)
+        _evict(data)
+
+
+def _evict(data):
+    """
+    Remove failed snapshots, and least recently used ones until all fit into OSV_SNAPSHOT_SIZE.
+    Snapshots with users are not removed.
+    """
+    log = logging.getLogger(__name__)
+    budget = settings.OSV_SNAPSHOT_SIZE * 1024 * 1024
+    total = sum([entry['size'] for entry in data['entries'].values()])
+    if total > budget:
+        _expire_users(data)
+    for key, entry in sorted(data['entries'].items(), key=lambda kv: (not kv[1].get('failed'), kv[1]['last_used'])):
+        if total <= budget and not entry.get('failed'):
+            break
+        if entry['users']:
+            continue
+        log.info('Remove snapshot %s (%d bytes)', key, entry['size'])
+        for path in [Snapshot(key).state_path, Snapshot(key).image_path]:
+            try:
+                os.remove(path)
+            except OSError as ex:
+                log.info('Snapshot file %s remove failed: %s', path, ex)
+        del data['entries'][key]
+        if not entry.get('failed'):
+            data['stats']['evictions'] += 1
+        total -= entry['size']
+
+
+def stats():
+    """
+    Return dict with hits, misses, saves, failures (restore failed), evictions, entries, bytes and budget (bytes).
+    """
+    with _index() as state:
+        data = _load(state)
+        result = dict(data['stats'])
+        result['entries'] = len(data['entries'])
+        result['bytes'] = sum([entry['size'] for entry in data['entries'].values()])
+    result['budget'] = settings.OSV_SNAPSHOT_SIZE * 1024 * 1024
+    return result
+
+##
@@ -0,0 +1,67 @@
+__author__ = 'justin_cinkelj'
+'''
+JSON state shared by all processes on one host.
+'''
+
+import os
+import os.path
+import errno
+import fcntl
+import simplejson
+
+
+class StateFile:
+    """
+    JSON file, read and modified under exclusive lock:
+
+        with StateFile(path) as state:
+            state.data['key'] = value
+
+    Lock is flock on path + '.lock', so it is released if process dies.
+    Modified data is written to a temporary file and renamed, so readers never see partial file.
+    If the with block raises, nothing is written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self._lock_fd = None
+        self._orig = None
+
+    def __enter__(self):
+        self._lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0666)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        self._orig = ''
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                self._orig = fin.read()
+        self.data = simplejson.loads(self._orig) if self._orig else {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                content = simplejson.dumps(self.data, sort_keys=True)
+                if content != self._orig:
+                    tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+                    with open(tmp_path, 'w') as fout:
+                        fout.write(content)
+                    os.rename(tmp_path, self.path)
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        return False
+
+
+def pid_alive(pid):
+    """
+    Return True if process pid exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        # EPERM - process exists, but is owned by another user
+        return ex.errno == errno.EPERM
+    return True
+
+##
@@ -0,0 +1,222 @@
+__author__ = 'justin_cinkelj'
+'''
+Launch phase tracing.
+
+A Trace times phases of one launch (image copy, imgedit, libvirt start, wait for IP, ...)
+and appends one JSON record per launch to OSV_TRACE_FILE. osv_trace.py aggregates the
+records into percentile tables per phase.
+
+With OSV_TRACE = False, begin() returns NULL trace, whose methods do nothing.
+
+    tr = trace.begin('lin_proxy')
+    with tr.phase('admit'):
+        ...
+    tr.finish()
+'''
+
+import os
+import os.path
+import logging
+from time import time
+import simplejson
+
+import settings
+
+
+def trace_path():
+    return settings.OSV_TRACE_FILE or os.path.join(settings.OSV_WORK_DIR, 'trace.jsonl')
+
+
+class _Phase:
+    def __init__(self, trace, name):
+        self._trace = trace
+        self._name = name
+        self._t0 = 0
+
+    def __enter__(self):
+        self._t0 = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._trace.add(self._name, self._t0, time() - self._t0)
+
+
+class Trace:
+    """
+    Phase timings of one launch. Phase with same name can be added more than once,
+    report sums them up.
+    """
+    enabled = True
+
+    def __init__(self, name, **attrs):
+        from uuid import uuid4
+        self._t0 = time()
+        self._finished = False
+        self.record = {'name': name, 'id': str(uuid4()), 'pid': os.getpid(), 'start': self._t0, 'phases': []}
+        self.record.update(attrs)
+
+    def set(self, **attrs):
+        """
+        Add attributes (vm name, image, ...) to record.
+        """
+        self.record.update(attrs)
+
+    def phase(self, name):
+        """
+        Return context manager, which adds phase name with duration of with-block.
+        """
+        return _Phase(self, name)
+
+    def add(self, name, start, seconds):
+        """
+        Add phase name, started at start (time()), lasting seconds.
+        """
+        self.record['phases'].append({'name': name, 'start': round(start - self._t0, 6),
+                                      'seconds': round(seconds, 6)})
+
+    def finish(self, status='ok', **attrs):
+        """
+        Append record to trace file. Only first call writes, so both owner and error path can call it.
+        """
+        log = logging.getLogger(__name__)
+        if self._finished:
+            return
+        self._finished = True
+        self.record.update(attrs)
+        self.record['status'] = status
+        self.record['total'] = round(time() - self._t0, 6)
+        line = simplejson.dumps(self.record) + '\n'
+        try:
+            # single write with O_APPEND, records of concurrent processes are not interleaved
+            fd = os.open(trace_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as ex:
+            log.info('Trace record not written to %s: %s', trace_path(), ex)
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+class _NullTrace:
+    enabled = False
+    record = None
+
+    def set(self, **attrs):
+        pass
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def add(self, name, start, seconds):
+        pass
+
+    def finish(self, status='ok', **attrs):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+NULL = _NullTrace()
+
+
+def begin(name, **attrs):
+    """
+    Start tracing a launch. Return Trace, or NULL if tracing is disabled.
+    """
+    if not settings.OSV_TRACE:
+        return NULL
+    return Trace(name, **attrs)
+
+
+def load(path=None, name=None, since=0):
+    """
+    Return list of records from trace file, optionally only records with given name,
+    started after since (time()). Broken lines (e.g. disk full) are skipped.
+    """
+    log = logging.getLogger(__name__)
+    records = []
+    with open(path or trace_path()) as fin:
+        for line in fin:
+            try:
+                rec = simplejson.loads(line)
+            except ValueError:
+                log.info('Skip broken trace record %r', line[:80])
+                continue
+            if name and rec.get('name') != name:
+                continue
+            if rec.get('start', 0) < since:
+                continue
+            records.append(rec)
+    return records
+
+
+def percentile(values, pct):
+    """
+    pct-th percentile of values, linear interpolation between closest ranks.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * pct / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def phase_times(records):
+    """
+    Return list of (phase name, list of per-launch seconds), phases in order of first appearance.
+    Last entry is 'total', the whole launch.
+    """
+    names = []
+    times = {}
+    for rec in records:
+        per_launch = {}
+        for ph in rec['phases']:
+            if ph['name'] not in per_launch:
+                per_launch[ph['name']] = 0.0
+                if ph['name'] not in times:
+                    names.append(ph['name'])
+                    times[ph['name']] = []
+            per_launch[ph['name']] += ph['seconds']
+        for name, seconds in per_launch.items():
+            times[name].append(seconds)
+    result = [(name, times[name]) for name in names]
+    result.append(('total', [rec['total'] for rec in records]))
+    return result
+
+
+def report(records, percentiles=(50, 90, 99)):
+    """
+    Return report text - for each phase count, mean, percentiles and max in seconds,
+    and share of mean total launch time.
+    """
+    header = '%-20s %6s %9s' % ('phase', 'count', 'mean[s]')
+    for pct in percentiles:
+        header += ' %9s' % ('p%g[s]' % pct)
+    header += ' %9s %6s' % ('max[s]', 'share')
+    lines = [header]
+    rows = phase_times(records)
+    total_mean = sum(rows[-1][1]) / len(rows[-1][1]) if rows[-1][1] else 0.0
+    for name, values in rows:
+        if not values:
+            continue
+        mean = sum(values) / len(values)
+        line = '%-20s %6d %9.4f' % (name, len(values), mean)
+        for pct in percentiles:
+            line += ' %9.4f' % percentile(values, pct)
+        share = 100.0 * mean * len(values) / len(records) / total_mean if total_mean else 0.0
+        line += ' %9.4f %5.1f%%' % (max(values), share)
+        lines.append(line)
+    failed = len([rec for rec in records if rec.get('status') != 'ok'])
+    lines.append('%d launches, %d failed' % (len(records), failed))
+    return '\n'.join(lines)
+
+##
@@ -2,29 +2,80 @@ __author__ = 'justin_cinkelj'
 
 import logging
 import os
-import math
-from uuid import uuid4
+import errno
 import settings
+from console import ConsoleWatcher, ConsoleScanner, ConsoleStream, STREAM, _select, sendfile, write_all
+import connection
+import events
+import placement
+import lease
+import imagecache
+import snapshot
+import trace
+import ready
 from subprocess import Popen, check_call
-from time import sleep
+from time import sleep, time
 from random import randint
 import pipes
 import shutil
 import sys
+import threading
 import libvirt
-from jinja2 import Environment, PackageLoader
+import ipaddress
 
 
 # for '192.168.1.2/24' return '192.168.1.2' and '255.255.255.0'
 def cidr_to_ip_mask(cidr):
-    ip, bits = cidr.split('/')
-    n1 = int(bits)
-    n0 = 32 - n1
-    ss = '1' * n1 + '0' * n0
-    nm = [ss[-32:-24], ss[-24:-16], ss[-16:-8], ss[-8:]]  # reversed order, nm[0] is highest byte
-    nm2 = [int(nm_tmp, 2) for nm_tmp in nm]
-    netmask = '%d.%d.%d.%d' % (nm2[0], nm2[1], nm2[2], nm2[3])
-    return ip, netmask
+    iface = ipaddress.ip_interface(unicode(cidr))
+    return str(iface.ip), str(iface.netmask)
+
+
+# ideal line == '/# '
+# but 'random: device unblocked.' might be there too.
+# or 'random' garbage can be prepend ('ESC[6n/# ')
+CMD_PROMPT_PATTERN = r'^/# |/# $'
+# Is IP assigned ? Search for 'eth0: $IP'
+# only in verbose mode - [I/246 dhcp]: Configuring eth0: ip 192.168.122.37 subnet mask 255.255.255.0 gateway 192.168.122.1 MTU 1500
+# there is also: 'eth0: ethernet address: 52:54:00:12:34:56', which is ignored
+IP_PATTERN = r'^eth0: (\d+\.\d+\.\d+\.\d+)'
+
+
+_domain_template = None
+_domain_template_lock = threading.Lock()
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../templates')
+
+
+def domain_template():
+    """
+    Return libvirt domain XML template. Template is loaded and compiled only once.
+    """
+    global _domain_template
+    with _domain_template_lock:
+        if _domain_template is None:
+            # jinja2 import is slow, lin_proxy with VM claimed from pool does not need it
+            from jinja2 import Environment, FileSystemLoader
+            # templates dir is next to lin_proxy.py, but lin_proxy (and its conf.settings) is not imported
+            tmpl_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+            _domain_template = tmpl_env.get_template('osv-libvirt.template.xml')
+    return _domain_template
+
+
+def prefetch_domain_template():
+    """
+    Load domain XML template in background thread, so that jinja2 import and template compile
+    are done while VM image is edited, not after it.
+    """
+    if _domain_template is None:
+        th = threading.Thread(target=domain_template, name='domain-template')
+        th.daemon = True
+        th.start()
+
+
+# Create thin qcow2 image, all unmodified data is read from backing_file.
+# backing_file is only read, so many VMs can share it.
+def create_image_overlay(backing_file, overlay):
+    cmd = [settings.OSV_QEMU_IMG, 'create', '-q', '-f', 'qcow2', '-b', backing_file, '-F', 'qcow2', overlay]
+    check_call(cmd)
 
 
 class VMParam:
@@ -32,25 +83,33 @@ class VMParam:
     NET_DHCP = 'dhcp'
     NET_NONE = 'net-none'
 
+    IMAGE_COPY = 'copy'  # full copy of original image
+    IMAGE_OVERLAY = 'overlay'  # thin qcow2 overlay, original image is read-only backing file
+
     '''
-    Save parameters. Also create copy of VM image for this particular VM.
+    Save parameters. Also create copy (or qcow2 overlay) of VM image for this particular VM.
     '''
     def __init__(self,
                  command='',
                  image='',
                  use_image_copy=False,
+                 image_copy_mode='',  # IMAGE_COPY or IMAGE_OVERLAY, default is settings.OSV_IMAGE_COPY_MODE
                  cpus=1,
                  memory=512,
 
                  networking=True,
-                 net_ip='',
-                 net_mac='',  # '52:54:00:12:34:56' is default in run.py
+                 net_ip='',  # 'ip/bits', or 'lease' - static IP from osv.lease
+                 net_mac='',  # '52:54:00:12:34:56' is default in run.py, 'rand', or 'lease' - MAC from osv.lease
                  net_gw='',
                  net_dns='',
 
                  gdb_port=0,
                  verbose=False,
-                 debug=False
+                 debug=False,
+                 transient=None,  # transient libvirt domain, default is settings.OSV_TRANSIENT_DOMAIN
+                 pin_cpus=None,  # pin vCPUs and memory to host cpus/NUMA nodes, default is settings.OSV_PIN_CPUS
+                 image_cache=None,  # with use_image_copy, use osv.imagecache, default is settings.OSV_IMAGE_CACHE
+                 snapshot=None  # with use_image_copy, restore VM from osv.snapshot, default is settings.OSV_SNAPSHOT
                  ):
         log = logging.getLogger(__name__)
         self._vm_name = 'osv-%09d' % randint(0, 1e9)
@@ -60,6 +119,8 @@ class VMParam:
         self._memory = memory
         self._debug = debug
         self._verbose = verbose
+        self._transient = settings.OSV_TRANSIENT_DOMAIN if transient is None else transient
+        self._pin_cpus = settings.OSV_PIN_CPUS if pin_cpus is None else pin_cpus
         # image relative to OSV_SRC, or abs path
         if image:
             if os.path.isabs(image):
@@ -72,17 +133,31 @@ class VMParam:
             self._image_orig = os.path.abspath(os.path.join(settings.OSV_SRC, image_rel_path))
         # self._image_orig now contains abs path to image
         self._use_image_copy = use_image_copy
+        self._image_copy_mode = image_copy_mode or settings.OSV_IMAGE_COPY_MODE
+        self._image_backing_file = ''  # set only for IMAGE_OVERLAY, or overlay of cached image
+        self._image_cache = use_image_copy and (settings.OSV_IMAGE_CACHE if image_cache is None else image_cache)
+        self._image_cache_key = ''  # osv.imagecache key of backing/cloned image
+        # saved VM state does not fit VMs with shared image, pinned cpus or gdb
+        self._snapshot = use_image_copy and not self._pin_cpus and not gdb_port and \
+            (settings.OSV_SNAPSHOT if snapshot is None else snapshot)
         if self._use_image_copy:
             # Put image to directory owned by current user.
             # Image will be later owned by root, and we still have to remove it.
             self._in_use_image = '%s/%s-usr.img' % (settings.OSV_WORK_DIR, self._vm_name)
-            log.info('Copy image %s -> %s', self._image_orig, self._in_use_image)
-            shutil.copy(self._image_orig, self._in_use_image)
+            if self._image_cache or self._snapshot:
+                # image is taken from cache or snapshot (or copied) by VM.edit_image, see use_cached_image
+                pass
+            else:
+                self.copy_image()
         else:
             self._in_use_image = self._image_orig
 
         self._gdb_port = gdb_port
 
+        self._leases = []  # (kind, index) of osv.lease leases
+        if net_ip == 'lease':
+            net_ip, index = lease.acquire_ip(self._vm_name)
+            self._leases.append((lease.IP, index))
         self._net_ip = net_ip
         self._net_gw = net_gw
         self._net_dns = net_dns
@@ -93,7 +168,10 @@ class VMParam:
         else:
             self._net_mode = VMParam.NET_NONE
 
-        if net_mac == 'rand':
+        if net_mac == 'lease':
+            self._net_mac, index = lease.acquire_mac(self._vm_name)
+            self._leases.append((lease.MAC, index))
+        elif net_mac == 'rand':
             self._net_mac = '52:54:00:%02x:%02x:%02x' % (randint(0,255), randint(0,255), randint(0,255))
         elif net_mac:
             self._net_mac = net_mac
@@ -102,17 +180,91 @@ class VMParam:
             self._net_mac = ''
         log.info('VM MAC %s', self._net_mac)
 
+    def copy_image(self):
+        log = logging.getLogger(__name__)
+        if self._image_copy_mode == VMParam.IMAGE_OVERLAY:
+            log.info('Create image overlay %s -> %s', self._image_orig, self._in_use_image)
+            create_image_overlay(self._image_orig, self._in_use_image)
+            self._image_backing_file = self._image_orig
+        else:
+            log.info('Copy image %s -> %s', self._image_orig, self._in_use_image)
+            shutil.copy(self._image_orig, self._in_use_image)
+
     def remove_image_copy(self):
         log = logging.getLogger(__name__)
         if self._use_image_copy:
             if self._in_use_image != self._image_orig:
+                # for IMAGE_OVERLAY only the overlay is removed, backing file is original image
                 log.info("Remove image copy %s", self._in_use_image)
                 # image file is now owned by root, or libvirt or whoever user
                 # os.remove works if we own directory
                 try:
                     os.remove(self._in_use_image)
                 except Exception as ex:
-                    log.info('Image %s remove failed (msg: %s)', self._in_use_image, ex.get_error_message())
+                    log.info('Image %s remove failed (msg: %s)', self._in_use_image, ex)
+        if self._image_cache_key:
+            imagecache.release(self._image_cache_key, self._vm_name)
+            self._image_cache_key = ''
+
+    def use_cached_image(self, configure):
+        """
+        Make _in_use_image a clone (or overlay) of cached image configured with _full_command_line.
+        configure(path) runs imgedit.py on a cache miss. Return True on cache hit.
+        """
+        log = logging.getLogger(__name__)
+        path, key, hit = imagecache.acquire(self._image_orig, self._full_command_line, self._vm_name, configure)
+        self._image_cache_key = key
+        try:
+            self.use_base_image(path)
+        except:
+            self.remove_image_copy()
+            raise
+        return hit
+
+    def use_base_image(self, path):
+        """
+        Make _in_use_image a reflink clone of read-only image path, or a qcow2 overlay backed by it.
+        """
+        log = logging.getLogger(__name__)
+        if imagecache.clone(path, self._in_use_image):
+            log.info('Clone image %s -> %s', path, self._in_use_image)
+        else:
+            log.info('Create overlay of image %s -> %s', path, self._in_use_image)
+            create_image_overlay(path, self._in_use_image)
+            self._image_backing_file = path
+
+    def adopt_leases(self, leases):
+        """
+        Replace leased IP/MAC by addresses with given lease indexes {kind: index} (e.g. those saved in
+        osv.snapshot). Return False, and keep current leases, if some of them is leased by someone else.
+        """
+        log = logging.getLogger(__name__)
+        acquired = []
+        try:
+            for kind, index in sorted(leases.items()):
+                if kind == lease.IP:
+                    address, index = lease.acquire_ip(self._vm_name, index)
+                else:
+                    address, index = lease.acquire_mac(self._vm_name, index)
+                acquired.append((kind, index, address))
+        except lease.LeaseError as ex:
+            log.info('VM %s cannot adopt leases %s: %s', self._vm_name, leases, ex)
+            for kind, index, address in acquired:
+                lease.release(kind, index, self._vm_name)
+            return False
+        self.release_leases()
+        for kind, index, address in acquired:
+            if kind == lease.IP:
+                self._net_ip = address
+            else:
+                self._net_mac = address
+            self._leases.append((kind, index))
+        return True
+
+    def release_leases(self):
+        for kind, index in self._leases:
+            lease.release(kind, index, self._vm_name)
+        self._leases = []
 
     '''
     Build command for run.py.
@@ -178,19 +330,43 @@ class VM:
     """
     Create new VM.
     net_ip is in CIDR notation 'ip/bits'
+    tracer is osv.trace.Trace for launch phases. By default VM traces itself, record is written by terminate.
+    restore_hook(vm) is called by wait_up after VM was restored from osv.snapshot (e.g. to push
+    per-VM configuration which is not part of saved state).
     """
-    def __init__(self, **kwargs):
-        self._param = VMParam(**kwargs)
+    def __init__(self, tracer=None, restore_hook=None, **kwargs):
+        self._own_trace = tracer is None
+        self._trace = trace.begin('vm') if tracer is None else tracer
+        with self._trace.phase('image_copy'):
+            self._param = VMParam(**kwargs)
+        self._trace.set(vm=self._param._vm_name)
 
         # other vars
         self._child_cmdline_up = False
         self._ip = ''
+        self._api_port = settings.OSV_API_PORT
         self._api_up = False  # set by first API call
+        self._http_session = None  # keep-alive session for REST api, see api.http_session()
+        self._aio_pool = None  # keep-alive connections for async REST api, see aio.connection_pool()
 
         # libvirt
         self._vm = None
         self._console_log = ''
         self._console_log_fd = None
+        self._sendfile_ok = True  # False if forward_std output does not support sendfile
+        self._console_mode = settings.OSV_CONSOLE_MODE
+        self._console_stream = None  # console.ConsoleStream, in console mode STREAM
+        self._console_watcher = None
+        self._console_scanner = ConsoleScanner()
+        self._state = None  # events.DomainState, if libvirt lifecycle events are used
+        self._placement = None  # placement.Placement, if vCPUs are pinned
+        self._snapshot = None  # snapshot.Snapshot VM is restored from, or will be saved to
+        self._save_pending = False  # booted VM is saved to self._snapshot by wait_up
+        self._restored = False  # VM runs from saved state, not booted
+        self._restore_hook = restore_hook
+        self._restore_hook_pending = False
+        self._console_scanner.add_matcher('cmd_prompt', CMD_PROMPT_PATTERN, self._on_cmd_prompt, once=True, partial=True)
+        self._console_scanner.add_matcher('ip', IP_PATTERN, self._on_ip, once=True)
 
     def _log_name(self):
         if self._vm:
@@ -201,31 +377,22 @@ class VM:
 
     @classmethod
     def connect_to_existing(cls, ip, name=''):
-        vm = VM()
+        vm = VM(tracer=trace.NULL)
         vm._ip = ip.split('/')[0]  # ip with or without netmask
         if(name):
-            conn = VM._libvirt_conn()
             #conn = libvirt.open("qemu+ssh://root@192.168.122.11/system")
-            vm._vm = conn.lookupByName(name)
+            vm._vm = connection.call(lambda conn: conn.lookupByName(name))
+            vm._param._transient = not vm._vm.isPersistent()
+            vm._watch_state(events.STARTED if vm._is_active() else events.STOPPED)
         return vm
 
     @classmethod
     def _libvirt_conn(cls):
-        conn = libvirt.open("qemu:///system")
-        return conn
-
-    # use libvirt to start OSv VM
-    def run(self, wait_up=False):
-        # get full_command_line
-        run_arg = self._param._build_run_command()
-        full_command_line = self._param._full_command_line
-        ## full_command_line = '--verbose ' + full_command_line  # run OSv VM in verbose mode
-        # image edit.
-        cmd = [os.path.join(settings.OSV_SRC, 'scripts/imgedit.py'), 'setargs', self._param._in_use_image, full_command_line]
-        print 'Set cmd: %s' % ' '.join(cmd)
-        check_call(cmd)
+        # shared by all VMs, see osv.connection
+        return connection.get()
 
-        name = str(uuid4())[:8]
+    # override - template params to replace (osv.snapshot renders XML without per-VM values)
+    def _domain_xml(self, **override):
         # what are valid cache/io mode combinations
         #   none + native, not available on all hosts/filesystems (err: file system may not support O_DIRECT)
         #   unsafe + native - rejected by libvirt, err: unsupported configuration: native I/O needs either no disk cache or directsync cache mode, QEMU will fallback to aio=threads
@@ -234,118 +401,459 @@ class VM:
         #image_cache_mode, image_io_mode = 'unsafe', 'threads'  # ok
 
         image_cache_mode, image_io_mode = 'unsafe', 'threads'  # ok
-        self._console_log = '%s/%s-console.log' % (settings.OSV_WORK_DIR, self._param._vm_name)
         vm_param = {'name': self._param._vm_name,
                     'memory': self._param._memory,
                     'vcpu_count': self._param._cpus,
                     'image_file': self._param._in_use_image,
+                    'image_backing_file': self._param._image_backing_file,
                     'image_cache_mode': image_cache_mode,
                     'image_io_mode': image_io_mode,
                     'net_mac': self._param._net_mac,
                     'net_bridge': settings.OSV_BRIDGE,
                     'console_log': self._console_log,
+                    'console_pty': self._console_mode == STREAM,
                     'gdb_port': self._param._gdb_port,
+                    'placement': self._placement.template_param() if self._placement else None,
+                    'uuid': '',
                     }
-        tmpl_env = Environment(loader=PackageLoader('lin_proxy', 'templates'))
-        template = tmpl_env.get_template('osv-libvirt.template.xml')
-        xml = template.render(vm=vm_param)
+        vm_param.update(override)
+        return domain_template().render(vm=vm_param)
+
+    # use libvirt to start OSv VM
+    # Launch is split into stages edit_image and start (see also osv.fleet), run does them all.
+    def run(self, wait_up=False):
+        self.edit_image()
+        self.start()
+        stdout_data = ''
+        if wait_up:
+            stdout_data = self.wait_up()
+        return stdout_data
+
+    # write command line to VM image
+    def edit_image(self):
+        prefetch_domain_template()
+        # get full_command_line
+        run_arg = self._param._build_run_command()
+        if self._param._snapshot and self._runs_cli():
+            # VM saved at cli.so prompt is restored instead of booted, its image is already configured
+            with self._trace.phase('snapshot'):
+                self._snapshot = snapshot.find(self)
+                if self._snapshot and self._snapshot.entry:
+                    # MAC/IP might be taken over from snapshot
+                    self._param._build_run_command()
+                    try:
+                        self._param.use_base_image(self._snapshot.image_path)
+                    except:
+                        snapshot.release(self._snapshot.key, self._param._vm_name)
+                        self._snapshot = None
+                        raise
+                    self._trace.set(snapshot='restore')
+                    return
+                self._save_pending = self._snapshot is not None
+        full_command_line = self._param._full_command_line
+        ## full_command_line = '--verbose ' + full_command_line  # run OSv VM in verbose mode
+        if self._param._snapshot and not self._param._image_cache:
+            # copy was deferred until it is known that VM is not restored
+            with self._trace.phase('image_copy'):
+                self._param.copy_image()
+        # image edit.
+        with self._trace.phase('imgedit'):
+            if self._param._image_cache:
+                hit = self._param.use_cached_image(lambda image: self._imgedit(image, full_command_line))
+                self._trace.set(image_cache='hit' if hit else 'miss')
+            else:
+                self._imgedit(self._param._in_use_image, full_command_line)
+
+    def _imgedit(self, image, full_command_line):
+        cmd = [os.path.join(settings.OSV_SRC, 'scripts/imgedit.py'), 'setargs', image, full_command_line]
+        print 'Set cmd: %s' % ' '.join(cmd)
+        check_call(cmd)
+
+    # define and start libvirt domain
+    def start(self):
+        log = logging.getLogger(__name__)
+        self._console_log = '%s/%s-console.log' % (settings.OSV_WORK_DIR, self._param._vm_name)
+        if self._param._pin_cpus:
+            self._placement = placement.reserve(self._param._vm_name, self._param._cpus, self._param._memory)
+        if self._snapshot and self._snapshot.entry:
+            try:
+                self._restore()
+                return
+            except libvirt.libvirtError as ex:
+                # e.g. hypervisor was upgraded, VM is booted from the same (configured) image
+                log.warning('VM %s restore from snapshot %s failed, boot it: %s', self._param._vm_name,
+                            self._snapshot.key, ex.get_error_message())
+                snapshot.discard(self._snapshot)
+                self._trace.set(snapshot='failed')
+                self._unwatch_state()
+                self._vm = None
+        xml = self._domain_xml()
         #print xml
 
         # make console_log file, so that we have permission to read it.
-        open(self._console_log, 'w').close()
-        conn = VM._libvirt_conn()
-        self._vm = conn.defineXML(xml)
-        self._vm.create()  # start vm
-        self._console_log_fd = open(self._console_log)
+        if self._console_mode != STREAM or settings.OSV_CONSOLE_CAPTURE:
+            open(self._console_log, 'w').close()
+        # watch before start, so that no event is missed
+        self._watch_state(None)
+        # console stream gets only output written after it is opened - open it while VM is paused
+        flags = libvirt.VIR_DOMAIN_START_PAUSED if self._console_mode == STREAM else 0
+        try:
+            with self._trace.phase('libvirt_start'):
+                if self._param._transient:
+                    # define + start in one call, domain is gone after it stops
+                    self._vm = connection.call(lambda conn: conn.createXML(xml, flags))
+                else:
+                    self._vm = connection.call(lambda conn: conn.defineXML(xml))
+                    self._vm.createWithFlags(flags)  # start vm
+                self._open_console()
+                if flags:
+                    self._vm.resume()
+        except libvirt.libvirtError:
+            if self._vm and flags:
+                # console stream was not opened, do not leave paused VM behind
+                try:
+                    self._vm.destroy()
+                except libvirt.libvirtError as ex:
+                    log.info('VM %s destroy failed: %s', self._log_name(), ex.get_error_message())
+            self._release_placement()
+            raise
 
         if self._param._net_mode == VMParam.NET_STATIC:
             self._ip = self._param._net_ip.split('/')[0]
-        stdout_data = ''
-        if wait_up:
-            stdout_data = self.wait_up()
-        return stdout_data
+
+    def _restore(self):
+        """
+        Start VM from state saved in self._snapshot, instead of booting it.
+        """
+        log = logging.getLogger(__name__)
+        snap = self._snapshot
+        xml = self._domain_xml(uuid=snap.entry['uuid'])
+        if self._console_mode != STREAM or settings.OSV_CONSOLE_CAPTURE:
+            open(self._console_log, 'w').close()
+        self._watch_state(None)
+        # as in start, console stream is opened before VM writes anything
+        flags = libvirt.VIR_DOMAIN_SAVE_PAUSED if self._console_mode == STREAM else 0
+        try:
+            with self._trace.phase('restore'):
+                if not self._param._transient:
+                    # restored domain is persistent if it is defined
+                    connection.call(lambda conn: conn.defineXML(xml))
+                connection.call(lambda conn: conn.restoreFlags(snap.state_path, xml, flags))
+                self._vm = connection.call(lambda conn: conn.lookupByName(self._param._vm_name))
+                self._open_console()
+                if flags:
+                    self._vm.resume()
+        except libvirt.libvirtError:
+            self._close_console()
+            if self._vm and self._is_active():
+                try:
+                    self._vm.destroy()
+                except libvirt.libvirtError as ex:
+                    log.info('VM %s destroy failed: %s', self._log_name(), ex.get_error_message())
+            raise
+        log.info('VM %s restored from snapshot %s', self._log_name(), snap.key)
+        # VM is at cli.so prompt, with network configured - none of that is printed to console again
+        self._ip = snap.entry['ip']
+        self._child_cmdline_up = True
+        self._drop_boot_matchers()
+        self._restored = True
+        self._restore_hook_pending = True
+
+    def _save_snapshot(self):
+        """
+        Save booted VM to self._snapshot, and restore it right away. VM image is moved to snapshot,
+        VM continues with a clone (or overlay) of it, as later restored VMs do.
+        """
+        log = logging.getLogger(__name__)
+        snap = self._snapshot
+        param = self._param
+        state_file = '%s.%d.tmp' % (snap.state_path, os.getpid())
+        with self._trace.phase('snapshot_save'):
+            uuid = self._vm.UUIDString()
+            self._close_console()
+            # keep-alive connections are not reused across save
+            if self._http_session:
+                self._http_session.close()
+                self._http_session = None
+            try:
+                self._vm.save(state_file)
+            except libvirt.libvirtError as ex:
+                log.warning('VM %s save to snapshot %s failed: %s', self._log_name(), snap.key, ex.get_error_message())
+                self._snapshot = None
+                if not self._is_active():
+                    raise
+                self._open_console(skip_existing=True)
+                return
+            self._unwatch_state()
+            snapshot.add(snap, param._vm_name, state_file, param._in_use_image, param._image_backing_file,
+                         uuid, self._ip, dict(param._leases))
+            # cached image is not backing file of VM image any more
+            param._image_backing_file = ''
+            if param._image_cache_key:
+                imagecache.release(param._image_cache_key, param._vm_name)
+                param._image_cache_key = ''
+            param.use_base_image(snap.image_path)
+        self._restore()
+        self._trace.set(snapshot='save')
+
+    def _open_console(self, skip_existing=False):
+        """
+        Open console log for reading. With skip_existing, already written data is not returned by read_std.
+        In console mode STREAM, console stream is opened instead - it returns only data written after it is opened.
+        """
+        if self._console_mode == STREAM:
+            capture = self._console_log if settings.OSV_CONSOLE_CAPTURE else None
+            self._console_stream = ConsoleStream(connection.get(), self._vm, settings.OSV_CONSOLE_BUFFER, capture)
+            return
+        # watch before first read, so that no append is missed
+        self._console_watcher = ConsoleWatcher(self._console_log)
+        self._console_log_fd = open(self._console_log)
+        if skip_existing:
+            self._console_log_fd.seek(0, os.SEEK_END)
+
+    def _close_console(self):
+        if self._console_stream:
+            self._console_stream.close()
+            self._console_stream = None
+        if self._console_log_fd:
+            self._console_log_fd.close()
+            self._console_log_fd = None
+        if self._console_watcher:
+            self._console_watcher.close()
+            self._console_watcher = None
+
+    def wait_console(self, timeout, poll_interval=0.1, wake_fds=()):
+        """
+        Wait until new data is written to console, VM state changes, one of wake_fds is readable,
+        or timeout expires. If file change notification is not available, console is polled with poll_interval.
+        """
+        wake_fds = list(wake_fds)
+        if self._state:
+            wake_fds.append(self._state.fileno())
+        if self._console_stream:
+            if not self._console_stream.pending():
+                _select(wake_fds + [self._console_stream.fileno()], timeout)
+            ret = True
+        elif self._console_watcher:
+            ret = self._console_watcher.wait(timeout, poll_interval, wake_fds)
+        elif wake_fds:
+            _select(wake_fds, min(timeout, poll_interval))
+            ret = True
+        else:
+            sleep(min(timeout, poll_interval))
+            ret = True
+        if self._state:
+            self._state.drain()
+        return ret
+
+    def _is_active(self):
+        try:
+            return self._vm.isActive()
+        except libvirt.libvirtError as ex:
+            # transient domain is gone after it stops
+            if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                return False
+            raise
+
+    def _watch_state(self, state):
+        if settings.OSV_LIBVIRT_EVENTS:
+            self._state = events.watch(self._vm.name() if self._vm else self._param._vm_name, state)
+
+    def _unwatch_state(self):
+        if self._state:
+            events.unwatch(self._vm.name() if self._vm else self._param._vm_name)
+            self._state = None
+
+    def _use_events(self):
+        return self._state is not None and events.event_loop_running()
+
+    def _wait_down(self, Td, Td2):
+        """
+        Wait until VM is not active any more. Return True if VM is down.
+        """
+        log = logging.getLogger(__name__)
+        if self._use_events():
+            self._state.wait([events.STOPPED, events.CRASHED], Td)
+            # event could be lost (e.g. reconnect), so check anyway
+            return not self._is_active()
+        deadline = time() + Td
+        while self._is_active():
+            if time() >= deadline:
+                return False
+            log.info('VM %s still alive', self._vm.name())
+            sleep(Td2)
+        return True
 
     def is_up(self):
         """
         Is VM still up, or did it already exit (kill to qemu, main app terminated)?
         """
         if self._vm:
-            return self._vm.isActive()
+            return self._is_active()
         return False
 
     def terminate(self):
+        with self._trace.phase('terminate'):
+            self._terminate()
+        if self._own_trace:
+            self._trace.finish()
+
+    def _terminate(self):
         log = logging.getLogger(__name__)
         if self._vm:
             log.info('Terminating libvirt vm %s', self._vm.name())
-            if not self._vm.isActive():
+            if not self._is_active():
                 # Invalid param, run.py reported error.
                 # Or normal termintaino of app started via command.
                 log.info('VM %s already terminated', self._vm.name())
             else:
                 self.os_api().shutdown()
                 # check
-                ii = 10.0
-                while ii>0:
-                    if not self._vm.isActive():
-                        log.info('VM %s terminated', self._vm.name())
-                        break
-                    else:
-                        # poll_ret is None
-                        log.info('VM %s still alive', self._vm.name())
-                        sleep(0.5)
-                        ii -= 0.5
-                return
+                if self._wait_down(10.0, 0.5):
+                    log.info('VM %s terminated', self._vm.name())
+                else:
+                    log.info('VM %s still alive, destroy it', self._vm.name())
             try:
-                if self._vm.isActive():
+                if self._is_active():
                     self._vm.destroy()
                 sys.stdout.flush()
             except libvirt.libvirtError as ex:
                 log.info('VM %s destroy failed: %s', self._log_name(), ex.get_error_message())
             try:
-                self._vm.undefine()
+                if not self._param._transient:
+                    self._vm.undefine()
                 sys.stdout.flush()
             except libvirt.libvirtError as ex:
                 log.info('VM %s destroy/undefine failed: %s', self._log_name(), ex.get_error_message())
+            self._unwatch_state()
             self._vm = None
         sys.stdout.flush()
-        if self._console_log_fd:
-            self._console_log_fd.close()
-            self._console_log_fd = None
+        if self._http_session:
+            self._http_session.close()
+            self._http_session = None
+        if self._aio_pool:
+            self._aio_pool.close()
+            self._aio_pool = None
+        self._release_placement()
+        self._close_console()
         self._param.remove_image_copy()
+        if self._snapshot:
+            # after VM image (clone or overlay of snapshot image) is removed
+            snapshot.release(self._snapshot.key, self._param._vm_name)
+            self._snapshot = None
+        self._param.release_leases()
         # the console log file is left
 
+    def _release_placement(self):
+        if self._placement:
+            placement.release(self._param._vm_name)
+            self._placement = None
+
+    def _on_cmd_prompt(self, match):
+        log = logging.getLogger(__name__)
+        log.info('child %s cmd_prompt is up', self._log_name())
+        self._child_cmdline_up = True
+
+    def _on_ip(self, match):
+        log = logging.getLogger(__name__)
+        if not self._ip:
+            self._ip = match.group(1)
+            log.info('child %s IP via DHCP, %s', self._log_name(), self._ip)
+
+    def add_console_matcher(self, name, pattern, callback, once=False):
+        """
+        Call callback(match) for each console line matching regex pattern (e.g. app finished marker,
+        error signatures). Lines are matched as console is read by read_std.
+        """
+        self._console_scanner.add_matcher(name, pattern, callback, once)
+
+    def remove_console_matcher(self, name):
+        self._console_scanner.remove_matcher(name)
+
+    def _drop_boot_matchers(self):
+        # IP and cmd prompt matchers are not needed once IP is known (static IP is never printed) and prompt
+        # was seen (or is never shown) - with no matcher left, forward_std uses sendfile
+        if self._ip:
+            self.remove_console_matcher('ip')
+        if self._child_cmdline_up or not self._runs_cli():
+            self.remove_console_matcher('cmd_prompt')
+
     # read stdout, stderr
-    # update child_cmdline_up when cmd prompt found
+    # update child_cmdline_up when cmd prompt found, and _ip when DHCP IP is found
     def read_std(self):
-        log = logging.getLogger(__name__)
+        if self._console_stream:
+            out = self._console_stream.read()
+            self._console_scanner.feed(out)
+            return out
         if not self._console_log_fd:
             return ''
+        # clear stdio EOF flag (seek does it), else glibc >= 2.28 does not return data appended after EOF was hit
+        self._console_log_fd.seek(0, os.SEEK_CUR)
         out = self._console_log_fd.read()
-        if not self._child_cmdline_up or not self._ip:
-            for cur_line in out.split('\r\n'):
-                if not self._child_cmdline_up:
-                    '''
-                    ideal line == '/# '
-                    but 'random: device unblocked.' might be there too.
-                    or 'random' garbage can be prepend ('ESC[6n/# ')
-                    '''
-                    if cur_line[:3] =='/# ' or cur_line[-3:] == '/# ':
-                        log.info('child %s cmd_prompt is up', self._log_name())
-                        self._child_cmdline_up = True
-                if not self._ip:
-                    # Is IP assigned ? Search for 'eth0: $IP'
-                    # only in verbose mode - [I/246 dhcp]: Configuring eth0: ip 192.168.122.37 subnet mask 255.255.255.0 gateway 192.168.122.1 MTU 1500
-                    # there is also: 'eth0: ethernet address: 52:54:00:12:34:56'
-                    ss = 'eth0: '
-                    ss_ignore = 'eth0: ethernet address:'
-                    if 0 == cur_line.find(ss_ignore):
-                        log.debug('child %s eth0 ignore line, %s', self._log_name(), cur_line)
-                    elif 0 == cur_line.find(ss):
-                        log.debug('child %s eth0 IP found, %s', self._log_name(), cur_line)
-                        self._ip = cur_line.split(' ')[1]
-                        log.info('child %s IP via DHCP, %s', self._log_name(), self._ip)
+        self._console_scanner.feed(out)
         return out
 
+    def forward_std(self, out_fd=None):
+        """
+        Move console output appended since last read to file descriptor out_fd (None - discard it),
+        in chunks of at most OSV_CONSOLE_CHUNK bytes. Return number of bytes moved.
+        Console matchers (IP, cmd prompt, app exit marker) see the chunks as with read_std. Once no matcher
+        is left, bytes are copied in kernel by sendfile(2), and never read into python.
+        """
+        self._drop_boot_matchers()
+        if self._console_stream:
+            return self._forward_stream(out_fd)
+        if not self._console_log_fd:
+            return 0
+        fin = self._console_log_fd
+        # as in read_std, also drops stdio read buffer, so tell() is the real offset
+        fin.seek(0, os.SEEK_CUR)
+        pos = start = fin.tell()
+        end = os.fstat(fin.fileno()).st_size
+        chunk = settings.OSV_CONSOLE_CHUNK
+        while pos < end:
+            count = min(end - pos, chunk)
+            if not self._console_scanner.has_matchers():
+                if out_fd is None:
+                    self._console_scanner.skip()
+                    pos = end
+                    break
+                if self._sendfile_ok:
+                    try:
+                        pos += sendfile(out_fd, fin.fileno(), pos, count)
+                        self._console_scanner.skip()
+                        continue
+                    except OSError as ex:
+                        if ex.errno not in [errno.EINVAL, errno.ENOSYS]:
+                            raise
+                        # e.g. stdout opened with O_APPEND
+                        self._sendfile_ok = False
+            fin.seek(pos)
+            data = fin.read(count)
+            if not data:
+                break
+            self._console_scanner.feed(data)
+            if out_fd is not None:
+                write_all(out_fd, data)
+            pos += len(data)
+        fin.seek(pos)
+        return pos - start
+
+    def _forward_stream(self, out_fd):
+        # data is in memory already, it only has to be scanned and written in bounded chunks
+        total = 0
+        while True:
+            data = self._console_stream.read(settings.OSV_CONSOLE_CHUNK)
+            if not data:
+                return total
+            self._console_scanner.feed(data)
+            if out_fd is not None:
+                write_all(out_fd, data)
+            total += len(data)
+
+    def _runs_cli(self):
+        return not self._param._command or self._param._command.find(settings.OSV_CLI_APP) != -1
+
     """
     Function will eat stdout/err (file pos could be reset to orig value, but it was not really needed so far).
     It is meaningful only for default cli.so app.
@@ -356,68 +864,56 @@ class VM:
     """
     def wait_cmd_prompt(self, Td = 5, Td2 = 0.1):
         log = logging.getLogger(__name__)
-        stdout_data = ''
-        if self._param._command and self._param._command.find(settings.OSV_CLI_APP) == -1:
+        if not self._runs_cli():
             log.debug('child %s cmd_prompt shows up only with cli.so app', self._log_name())
-            return False, stdout_data
-        if self._child_cmdline_up:
-            return True, stdout_data
-
-        iimax = math.ceil(float(Td) / Td2)
-        ii = 0
-        while ii < iimax:
-            stdout_data2 = self.read_std()
-            stdout_data += stdout_data2
-            if self._child_cmdline_up:
-                return True, stdout_data
-            log.debug('child %s cmd_prompt not up yet', self._log_name())
-            sleep(Td2)
-            ii += 1
-        return False, stdout_data
+            return False, ''
+        return self._wait_probes([ready.CMD_PROMPT], Td, Td2)
 
     """
     Wait on VM to get IP from DHCP.
     If static IP configuration is used, return success immediately.
     """
     def wait_ip(self, Td = 5, Td2 = 0.1):
-        log = logging.getLogger(__name__)
-        stdout_data = ''
-        if self._ip:
-            # DHCP IP already found, or static IP set in .run())
-            return True, stdout_data
-
-        iimax = math.ceil(float(Td) / Td2)
-        ii = 0
-        while ii < iimax:
-            stdout_data2 = self.read_std()
-            stdout_data += stdout_data2
-            if self._ip:
-                return True, stdout_data
-            log.debug('child %s ip not up yet', self._log_name())
-            sleep(Td2)
-            ii += 1
-        return False, stdout_data
+        return self._wait_probes([ready.IP], Td, Td2)
 
-    """
-    Wait on VM to be fully up and operational.
-    """
-    def wait_up(self, Td = 5, Td2 = 0.1):
+    # return (True if probes are done, console output), Td2 is poll interval, see ready.wait_ready
+    def _wait_probes(self, probes, Td, Td2):
         log = logging.getLogger(__name__)
-        stdout_data = ''
-        if self._vm:
-            iimax = math.ceil(float(Td) / Td2)
-            ii = 0
-            while ii < iimax:
-                if self._vm.isActive():
-                    break
-                log.debug('child %s ip not up yet', self._log_name())
-                sleep(Td2)
-                ii += 1
-            ip_found, stdout_data2 = self.wait_ip(Td, Td2)
-            stdout_data += stdout_data2
-            cmd_found, stdout_data2 = self.wait_cmd_prompt(Td, Td2)
-            stdout_data += stdout_data2
-        return stdout_data
+        try:
+            return True, ready.wait_ready(self, probes, Td, Td2)
+        except ready.ReadyError as ex:
+            log.info('child %s: %s', self._log_name(), ex)
+            return False, ex.output
+
+    def wait_up(self, timeout=None, poll_interval=0.1, api=False):
+        """
+        Wait on VM to be fully up and operational - domain is active, IP is known, cli.so prompt is shown
+        (if VM runs cli.so) and, with api=True, REST api answers. Conditions are checked concurrently,
+        with one overall timeout (default OSV_READY_TIMEOUT seconds).
+        With osv.snapshot, booted VM is saved now (restored VM has nothing to wait for but api), and
+        restore_hook is called for restored VM.
+        Return console output read while waiting. Raises ready.ReadyTimeout, or ready.VMStopped if VM
+        stops while booting.
+        """
+        if not self._vm:
+            return ''
+        probes = [ready.ACTIVE, ready.IP]
+        if self._runs_cli():
+            probes.append(ready.CMD_PROMPT)
+        if api and not self._api_up:
+            probes.append(ready.API)
+        with self._trace.phase('wait_up'):
+            output = ready.wait_ready(self, probes, timeout or settings.OSV_READY_TIMEOUT, poll_interval)
+        self._drop_boot_matchers()
+        if self._save_pending:
+            self._save_pending = False
+            self._save_snapshot()
+        if self._restore_hook_pending:
+            self._restore_hook_pending = False
+            if self._restore_hook:
+                with self._trace.phase('restore_hook'):
+                    self._restore_hook(self)
+        return output
 
     def app_api(self, name):
         # circular dependency import
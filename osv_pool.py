@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Keep a pool of pre-booted OSv VMs on this host.
+lin_proxy.py claims a ready VM from the pool instead of booting a new one,
+and hands it back for destruction when done. Pool is refilled in background.
+'''
+
+import sys
+import signal
+import logging
+import argparse
+
+from osv.pool import VMPool
+import conf.settings as settings
+from lin_proxy import setup_logging, make_work_dir, default_vm_size, vm_kwargs
+
+
+def parse_args():
+    cpus, memory = default_vm_size()
+    parser = argparse.ArgumentParser(description='Pool of pre-booted OSv VMs for lin_proxy.py')
+    parser.add_argument('--size', type=int, default=settings.POOL_SIZE, help='number of ready VMs')
+    parser.add_argument('--cpus', type=int, default=cpus, help='VM cpus, lin_proxy claims only matching VMs')
+    parser.add_argument('--memory', type=int, default=memory, help='VM memory in MB, lin_proxy claims only matching VMs')
+    parser.add_argument('--image', default=settings.OSV_SRC + '/build/debug/usr.img')
+    parser.add_argument('--boot-parallel', type=int, default=2, help='max number of VMs booted at once')
+    parser.add_argument('--interval', type=float, default=1.0, help='refill check interval in seconds')
+    return parser.parse_args()
+
+
+def main():
+    log = logging.getLogger(__name__)
+    args = parse_args()
+    make_work_dir()
+    pool = VMPool(args.size, lambda: vm_kwargs(args.image, args.cpus, args.memory), args.boot_parallel)
+    # SIGTERM - run finally block, to destroy ready VMs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info('Pool size %d, VM cpus %d, memory %d', args.size, args.cpus, args.memory)
+    try:
+        pool.serve(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info('Pool shutdown')
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    setup_logging(settings.POOL_LOG_FILE)
+    logger = logging.getLogger(__name__)
+    logger.info('Start /*--------------------------------*/')
+    main()
+    logger.info('Done /*--------------------------------*/')
+
+##
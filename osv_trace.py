@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+'''
+Report where launch time goes. Reads launch records written with OSV_TRACE = True
+(see osv.trace), prints percentiles of each launch phase.
+
+    ./osv_trace.py --name lin_proxy --last-hours 24
+'''
+
+import sys
+import argparse
+from time import time
+
+import osv.trace
+import conf.settings as settings  # applies local_settings (OSV_WORK_DIR, OSV_TRACE_FILE)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Launch phase latency report')
+    parser.add_argument('--file', default=osv.trace.trace_path(), help='trace file (default %(default)s)')
+    parser.add_argument('--name', default='', help='only records of lin_proxy, pool or vm launches')
+    parser.add_argument('--last-hours', type=float, default=0, help='only launches in last hours, 0 for all')
+    parser.add_argument('--percentiles', default='50,90,99', help='comma separated percentiles')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    since = time() - args.last_hours * 3600 if args.last_hours else 0
+    records = osv.trace.load(args.file, args.name, since)
+    if not records:
+        print 'No launch records in %s' % args.file
+        return 1
+    print osv.trace.report(records, [float(pct) for pct in args.percentiles.split(',')])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+##
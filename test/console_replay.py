@@ -0,0 +1,70 @@
+'''
+Replay recorded OSv console output into a console log file, as a booting VM would write it.
+Used by test.fake_libvirt domains, and to test console readers without a VM.
+'''
+
+import os.path
+import threading
+
+BOOT_LOG = os.path.join(os.path.dirname(__file__), 'data/osv-boot-console.log')
+
+
+def boot_capture():
+    """
+    Return recorded OSv boot console output (ends with cli.so prompt).
+    """
+    with open(BOOT_LOG) as fin:
+        return fin.read()
+
+
+class ConsoleReplay:
+    """
+    Append capture to file path line by line, lines are spread evenly over duration seconds.
+    With duration 0, whole capture is written at once.
+    If write is given, it is called with the data instead (e.g. pty console of test.fake_libvirt).
+    """
+    def __init__(self, path, capture, duration=0.0, write=None):
+        self.path = path
+        self._write = write
+        self._lines = capture.splitlines(True)
+        self._duration = duration
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='console-replay')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def wait(self, timeout=None):
+        """
+        Wait until whole capture is written.
+        """
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        if self._write:
+            self._replay(self._write, lambda: None)
+            return
+        with open(self.path, 'a') as fout:
+            self._replay(fout.write, fout.flush)
+
+    def _replay(self, write, flush):
+        if not self._duration:
+            write(''.join(self._lines))
+            return
+        delay = self._duration / len(self._lines)
+        for line in self._lines:
+            if self._stop.wait(delay):
+                return
+            write(line)
+            flush()
+
+##
@@ -0,0 +1,456 @@
+'''
+In-process fake of the libvirt python bindings, only the subset used by osv.
+Domains run nothing; a started domain replays recorded OSv boot console output into its
+console log file (see test.console_replay), or into its console stream if it has a pty console
+(output is dropped while no stream is open, as with qemu). It is stopped by destroy() or shutdown().
+save() writes domain XML to the state file, restoreFlags() starts domain from it without replaying boot,
+with libvirt checks of UUID/MAC/size of the restored domain.
+Lifecycle and stream events are delivered by virEventRunDefaultImpl, as with real libvirt.
+
+Used to benchmark osv without KVM, libvirtd and libvirt-python (see bench.suite).
+Install it before osv is imported:
+    from test import fake_libvirt
+    fake_libvirt.install()
+'''
+
+import sys
+import __builtin__
+import threading
+from time import sleep
+import Queue
+from collections import deque
+import xml.etree.ElementTree as ElementTree
+from test.console_replay import ConsoleReplay, boot_capture
+
+VIR_ERR_OPERATION_INVALID = 55
+VIR_ERR_CONFIG_UNSUPPORTED = 67
+VIR_ERR_NO_DOMAIN = 42
+VIR_CONNECT_LIST_DOMAINS_ACTIVE = 1
+VIR_CONNECT_LIST_DOMAINS_INACTIVE = 2
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_DEFINED = 0
+VIR_DOMAIN_EVENT_UNDEFINED = 1
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_STOPPED = 5
+VIR_DOMAIN_EVENT_SHUTDOWN = 6
+VIR_DOMAIN_EVENT_CRASHED = 8
+VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN = 0
+VIR_DOMAIN_EVENT_STOPPED_DESTROYED = 1
+VIR_DOMAIN_EVENT_STOPPED_CRASHED = 2
+VIR_DOMAIN_EVENT_STOPPED_SAVED = 4
+VIR_DOMAIN_EVENT_STARTED_BOOTED = 0
+VIR_DOMAIN_EVENT_STARTED_RESTORED = 2
+VIR_DOMAIN_CONSOLE_FORCE = 1
+VIR_DOMAIN_START_PAUSED = 1
+VIR_DOMAIN_SAVE_PAUSED = 4
+VIR_STREAM_NONBLOCK = 1
+VIR_STREAM_EVENT_READABLE = 1
+VIR_STREAM_EVENT_WRITABLE = 2
+VIR_STREAM_EVENT_ERROR = 4
+VIR_STREAM_EVENT_HANGUP = 8
+
+# what started domain writes to console, how long "boot" and restore from saved state take
+boot_console = None  # default is test.console_replay.boot_capture()
+boot_seconds = 0.0
+restore_seconds = 0.0
+hypervisor_version = 2011000
+
+_events = Queue.Queue()
+
+
+class libvirtError(Exception):
+    def __init__(self, message, code=0):
+        Exception.__init__(self, message)
+        self._code = code
+
+    def get_error_code(self):
+        return self._code
+
+    def get_error_message(self):
+        return self.args[0]
+
+
+def virEventRegisterDefaultImpl():
+    return 0
+
+
+def virEventRunDefaultImpl():
+    # blocks until next event, as libvirt does (get with timeout polls, and fails at interpreter shutdown)
+    callback, args = _events.get()
+    callback(*args)
+    return 0
+
+
+class virStream:
+    """
+    Non-blocking console stream, only receiving side.
+    """
+    def __init__(self, conn, flags):
+        self._lock = threading.Lock()
+        self._data = deque()
+        self._hangup = False
+        self._callback = None
+        self._events = 0
+        self._dom = None
+
+    def _schedule(self):
+        # with self._lock held
+        if self._callback and (self._data or self._hangup):
+            _events.put((self._dispatch, ()))
+
+    def _dispatch(self):
+        with self._lock:
+            if not self._callback:
+                return
+            events = 0
+            if self._data and self._events & VIR_STREAM_EVENT_READABLE:
+                events |= VIR_STREAM_EVENT_READABLE
+            if self._hangup:
+                events |= VIR_STREAM_EVENT_HANGUP
+            callback, opaque = self._callback
+        if events:
+            callback(self, events, opaque)
+
+    def _push(self, data):
+        with self._lock:
+            self._data.append(data)
+            self._schedule()
+
+    def _close(self):
+        with self._lock:
+            self._hangup = True
+            self._schedule()
+
+    def recv(self, nbytes):
+        with self._lock:
+            if not self._data:
+                return '' if self._hangup else -2
+            data = self._data.popleft()
+            if len(data) > nbytes:
+                self._data.appendleft(data[nbytes:])
+                data = data[:nbytes]
+            return data
+
+    def eventAddCallback(self, events, cb, opaque):
+        with self._lock:
+            self._callback = (cb, opaque)
+            self._events = events
+            self._schedule()
+        return 0
+
+    def eventUpdateCallback(self, events):
+        with self._lock:
+            self._events = events
+            self._schedule()
+        return 0
+
+    def eventRemoveCallback(self):
+        with self._lock:
+            self._callback = None
+        return 0
+
+    def abort(self):
+        if self._dom:
+            self._dom._detach(self)
+        return 0
+
+    finish = abort
+
+
+class virDomain:
+    def __init__(self, conn, xml, persistent):
+        self._conn = conn
+        self._uuid = None
+        self._define(xml)
+        self._stream = None
+        self._persistent = persistent
+        self._active = False
+        self._gone = False
+        self._replay = None
+        self._restored = False
+
+    def _check(self):
+        if self._gone:
+            raise libvirtError('Domain not found: no domain with matching name \'%s\'' % self._name,
+                               VIR_ERR_NO_DOMAIN)
+
+    def _define(self, xml):
+        root = ElementTree.fromstring(xml)
+        self._xml = xml
+        self._name = root.findtext('name')
+        self._uuid = root.findtext('uuid') or self._uuid or _new_uuid()
+        source = root.find('devices/console/source')
+        self._console_log = source.get('path') if source is not None else ''
+        self._pty = root.find('devices/console').get('type') == 'pty'
+
+    def name(self):
+        return self._name
+
+    def UUIDString(self):
+        return self._uuid
+
+    def isActive(self):
+        self._check()
+        return 1 if self._active else 0
+
+    def isPersistent(self):
+        self._check()
+        return 1 if self._persistent else 0
+
+    def create(self):
+        return self.createWithFlags(0)
+
+    def createWithFlags(self, flags):
+        self._check()
+        if self._active:
+            raise libvirtError('Requested operation is not valid: domain is already running',
+                               VIR_ERR_OPERATION_INVALID)
+        self._active = True
+        self._restored = False
+        if not flags & VIR_DOMAIN_START_PAUSED:
+            self._boot()
+        self._conn._emit(self, VIR_DOMAIN_EVENT_STARTED, VIR_DOMAIN_EVENT_STARTED_BOOTED)
+        return 0
+
+    def resume(self):
+        self._check()
+        # restored guest continues where it was saved, nothing is printed
+        if not self._replay and not self._restored:
+            self._boot()
+        return 0
+
+    def _boot(self):
+        capture = boot_capture() if boot_console is None else boot_console
+        if self._pty:
+            self._replay = ConsoleReplay(None, capture, boot_seconds, write=self._console_write).start()
+        elif self._console_log:
+            self._replay = ConsoleReplay(self._console_log, capture, boot_seconds).start()
+
+    def _stop(self, detail):
+        self._check()
+        if not self._active:
+            raise libvirtError('Requested operation is not valid: domain is not running',
+                               VIR_ERR_OPERATION_INVALID)
+        if self._replay:
+            self._replay.stop()
+            self._replay = None
+        self._active = False
+        if self._stream:
+            self._stream._close()
+            self._stream = None
+        if not self._persistent:
+            self._conn._remove(self)
+        self._conn._emit(self, VIR_DOMAIN_EVENT_STOPPED, detail)
+
+    def _console_write(self, data):
+        stream = self._stream
+        if stream:
+            stream._push(data)
+
+    def _detach(self, stream):
+        if self._stream is stream:
+            self._stream = None
+
+    def openConsole(self, dev_name, stream, flags):
+        self._check()
+        if not self._active or not self._pty:
+            raise libvirtError('Requested operation is not valid: domain is not running or has no pty console',
+                               VIR_ERR_OPERATION_INVALID)
+        if self._stream:
+            if not flags & VIR_DOMAIN_CONSOLE_FORCE:
+                raise libvirtError('operation failed: Active console session exists for this domain',
+                                   VIR_ERR_OPERATION_INVALID)
+            self._stream._close()
+        stream._dom = self
+        self._stream = stream
+        return 0
+
+    def destroy(self):
+        self._stop(VIR_DOMAIN_EVENT_STOPPED_DESTROYED)
+        return 0
+
+    def save(self, to):
+        self._check()
+        if not self._active:
+            raise libvirtError('Requested operation is not valid: domain is not running', VIR_ERR_OPERATION_INVALID)
+        import simplejson
+        with __builtin__.open(to, 'w') as fout:
+            simplejson.dump({'xml': self._xml, 'uuid': self._uuid}, fout)
+        self._stop(VIR_DOMAIN_EVENT_STOPPED_SAVED)
+        return 0
+
+    def shutdown(self):
+        """
+        Guest powered off (as after OSv /os/shutdown).
+        """
+        self._conn._emit(self, VIR_DOMAIN_EVENT_SHUTDOWN, 0)
+        self._stop(VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
+        return 0
+
+    def undefine(self):
+        self._check()
+        if not self._persistent:
+            raise libvirtError('Requested operation is not valid: cannot undefine transient domain',
+                               VIR_ERR_OPERATION_INVALID)
+        if not self._active:
+            self._conn._remove(self)
+        self._persistent = False
+        return 0
+
+
+class virConnect:
+    def __init__(self, uri):
+        self._uri = uri
+        self._closed = False
+        self._domains = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def isAlive(self):
+        return 0 if self._closed else 1
+
+    def close(self):
+        self._closed = True
+        return 0
+
+    def _add(self, dom):
+        with self._lock:
+            if dom.name() in self._domains:
+                raise libvirtError('operation failed: domain \'%s\' already exists' % dom.name(),
+                                   VIR_ERR_OPERATION_INVALID)
+            self._domains[dom.name()] = dom
+
+    def _remove(self, dom):
+        with self._lock:
+            self._domains.pop(dom.name(), None)
+        dom._gone = True
+
+    def _emit(self, dom, event, detail):
+        for callback, opaque in self._callbacks:
+            _events.put((callback, (self, dom, event, detail, opaque)))
+
+    def newStream(self, flags=0):
+        return virStream(self, flags)
+
+    def getVersion(self):
+        return hypervisor_version
+
+    def restoreFlags(self, frm, dxml=None, flags=0):
+        import simplejson
+        with __builtin__.open(frm) as fin:
+            saved = simplejson.load(fin)
+        xml = dxml or saved['xml']
+        _check_abi(saved['xml'], xml)
+        root = ElementTree.fromstring(xml)
+        if root.findtext('uuid', saved['uuid']) != saved['uuid']:
+            raise libvirtError('unsupported configuration: Target domain uuid %s does not match source %s' %
+                               (root.findtext('uuid'), saved['uuid']), VIR_ERR_CONFIG_UNSUPPORTED)
+        with self._lock:
+            dom = self._domains.get(root.findtext('name'))
+            if [other for other in self._domains.values() if other._uuid == saved['uuid'] and other is not dom]:
+                raise libvirtError('operation failed: domain with uuid %s already exists' % saved['uuid'],
+                                   VIR_ERR_OPERATION_INVALID)
+        if dom is None:
+            dom = virDomain(self, xml, False)
+            self._add(dom)
+        elif dom._active:
+            raise libvirtError('Requested operation is not valid: domain is already running',
+                               VIR_ERR_OPERATION_INVALID)
+        else:
+            # persistent domain gets console path etc. of restored XML
+            dom._define(xml)
+        dom._uuid = saved['uuid']
+        sleep(restore_seconds)
+        dom._active = True
+        dom._restored = True
+        self._emit(dom, VIR_DOMAIN_EVENT_STARTED, VIR_DOMAIN_EVENT_STARTED_RESTORED)
+        return 0
+
+    def createXML(self, xml, flags=0):
+        dom = virDomain(self, xml, False)
+        self._add(dom)
+        dom.createWithFlags(flags)
+        return dom
+
+    def defineXML(self, xml):
+        root = ElementTree.fromstring(xml)
+        with self._lock:
+            dom = self._domains.get(root.findtext('name'))
+        if dom is not None and not dom._active:
+            # redefine inactive domain
+            dom._define(xml)
+            dom._persistent = True
+            return dom
+        dom = virDomain(self, xml, True)
+        self._add(dom)
+        return dom
+
+    def lookupByName(self, name):
+        with self._lock:
+            dom = self._domains.get(name)
+        if dom is None:
+            raise libvirtError('Domain not found: no domain with matching name \'%s\'' % name, VIR_ERR_NO_DOMAIN)
+        return dom
+
+    def listAllDomains(self, flags=0):
+        with self._lock:
+            domains = self._domains.values()
+        if flags & VIR_CONNECT_LIST_DOMAINS_ACTIVE:
+            domains = [dom for dom in domains if dom._active]
+        elif flags & VIR_CONNECT_LIST_DOMAINS_INACTIVE:
+            domains = [dom for dom in domains if not dom._active]
+        return domains
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        self._callbacks.append((cb, opaque))
+        return len(self._callbacks) - 1
+
+
+def _new_uuid():
+    # uuid and simplejson are imported when used, bench.startup sees only modules imported by osv
+    import uuid
+    return str(uuid.uuid4())
+
+
+def _check_abi(saved_xml, xml):
+    # guest visible config must be the same as in saved domain
+    saved, new = ElementTree.fromstring(saved_xml), ElementTree.fromstring(xml)
+    for path, attr in [('memory', None), ('vcpu', None), ('devices/interface/mac', 'address')]:
+        saved_value, new_value = [(root.find(path).get(attr) if attr else root.findtext(path))
+                                  if root.find(path) is not None else None for root in [saved, new]]
+        if saved_value != new_value:
+            raise libvirtError('unsupported configuration: Target domain %s %s does not match source %s' %
+                               (path, new_value, saved_value), VIR_ERR_CONFIG_UNSUPPORTED)
+
+
+def open(name=None):
+    return virConnect(name)
+
+
+_loop_thread = None
+
+
+def start_event_loop():
+    """
+    Deliver events in background thread. Needed only if fake objects are used directly,
+    with install() osv.events runs the loop.
+    """
+    global _loop_thread
+    if _loop_thread is None:
+        def run():
+            while True:
+                virEventRunDefaultImpl()
+        _loop_thread = threading.Thread(target=run, name='fake-libvirt-events')
+        _loop_thread.daemon = True
+        _loop_thread.start()
+
+
+def install():
+    """
+    Make 'import libvirt' return this module. Must be called before osv is imported.
+    """
+    if 'osv' in sys.modules and sys.modules.get('libvirt') is not sys.modules[__name__]:
+        raise RuntimeError('osv is already imported with real libvirt')
+    sys.modules['libvirt'] = sys.modules[__name__]
+
+##
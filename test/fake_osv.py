@@ -0,0 +1,218 @@
+'''
+In-process HTTP server with (a subset of) OSv REST api.
+Used to test and benchmark osv.api without a real OSv VM.
+'''
+
+from __future__ import absolute_import
+import os
+import os.path
+import threading
+import socket
+from time import sleep
+from urlparse import urlparse, parse_qs
+from urllib import unquote
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import simplejson
+from osv import VM
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.connections = set()
+        self.handler_threads = []
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    # close keep-alive connections, so that handler threads exit
+    def close_connections(self):
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, as OSv httpserver
+    protocol_version = 'HTTP/1.1'
+    # send reply in one segment, else Nagle + delayed ACK adds 40 ms per request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+        self.server.connections.discard(self.request)
+
+    def _reply(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        osv = self.server.osv
+        url = urlparse(self.path)
+        params = dict([(kk, vv[0]) for kk, vv in parse_qs(url.query).items()])
+        length = int(self.headers.getheader('Content-Length') or 0)
+        data = self.rfile.read(length) if length else ''
+        if osv.latency:
+            sleep(osv.latency)
+        with osv.lock:
+            osv.request_count += 1
+            code, body = osv.handle(method, url.path, params, data)
+        self._reply(code, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeOsv:
+    """
+    Fake OSv VM REST api (/env, /app, /os, /file), listening on 127.0.0.1 and random port.
+    latency - seconds added to each request (simulate guest response time).
+    file_root - host directory served as VM filesystem by /file api.
+    on_shutdown - called on /os/shutdown and /os/poweroff (e.g. to stop test.fake_libvirt domain).
+    """
+    def __init__(self, latency=0.0, file_root=None):
+        self.latency = latency
+        self.file_root = file_root
+        self.on_shutdown = None
+        self.env = {'OSV_VERSION': 'v0.24-fake'}
+        self.apps = []
+        self.threads = {}  # tid: app command, app thread is listed until finish_app(tid)
+        self._next_tid = 100
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self._server = _HTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.osv = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._server.close_connections()
+        self._thread.join()
+
+    def finish_app(self, tid):
+        """
+        App thread tid exits.
+        """
+        with self.lock:
+            del self.threads[tid]
+
+    def vm(self):
+        """
+        Return VM object connected to this fake api.
+        """
+        vm = VM()
+        vm._ip = '127.0.0.1'
+        vm._api_port = self.port
+        return vm
+
+    # return http code, body
+    def handle(self, method, path, params, data):
+        if path == '/os/uptime' and method == 'GET':
+            return 200, '1'
+        if path in ['/os/shutdown', '/os/poweroff'] and method == 'POST':
+            if self.on_shutdown:
+                self.on_shutdown()
+            return 200, ''
+        if path == '/env/' and method == 'GET':
+            return 200, simplejson.dumps(['%s=%s' % (kk, vv) for kk, vv in self.env.items()])
+        if path.startswith('/env/'):
+            name = path[len('/env/'):]
+            if method == 'GET':
+                if name not in self.env:
+                    return 400, 'no such variable'
+                return 200, '"%s"' % self.env[name]
+            if method == 'POST':
+                if not params.get('val'):
+                    return 400, 'missing val'
+                self.env[name] = params['val']
+                return 200, ''
+            if method == 'DELETE':
+                self.env.pop(name, None)
+                return 200, ''
+        if path.startswith('/file/') and self.file_root:
+            return self._handle_file(method, unquote(path[len('/file/'):]), params, data)
+        if path == '/os/threads' and method == 'GET':
+            threads = [{'id': tid, 'name': command[:15]} for tid, command in self.threads.items()]
+            return 200, simplejson.dumps({'time_ms': 1, 'list': threads})
+        if path == '/app/' and method == 'PUT':
+            self.apps.append(params['command'])
+            tid = self._next_tid
+            self._next_tid += 1
+            self.threads[tid] = params['command']
+            return 200, str(tid)
+        return 404, 'not found'
+
+    def _host_path(self, vm_path):
+        return os.path.join(self.file_root, vm_path.lstrip('/'))
+
+    def _handle_file(self, method, vm_path, params, data):
+        host_path = self._host_path(vm_path)
+        op = params.get('op')
+        if method == 'GET' and op == 'LISTSTATUS':
+            if not os.path.isdir(host_path):
+                return 404, 'no such dir'
+            entries = []
+            for name in ['.', '..'] + sorted(os.listdir(host_path)):
+                entry_path = os.path.join(host_path, name)
+                if os.path.isdir(entry_path):
+                    entries.append({'pathSuffix': name, 'type': 'DIRECTORY', 'length': 0})
+                else:
+                    entries.append({'pathSuffix': name, 'type': 'FILE', 'length': os.path.getsize(entry_path)})
+            return 200, simplejson.dumps(entries)
+        if method == 'GET' and op == 'GET':
+            if not os.path.isfile(host_path):
+                return 404, 'no such file'
+            with open(host_path, 'rb') as fin:
+                return 200, fin.read()
+        if method == 'POST':
+            # multipart/form-data, one file part
+            delimiter = data[:data.index('\r\n')]
+            content_start = data.index('\r\n\r\n') + 4
+            content_end = data.rindex('\r\n' + delimiter + '--')
+            if not os.path.isdir(os.path.dirname(host_path)):
+                return 400, 'no parent dir'
+            with open(host_path, 'wb') as fout:
+                fout.write(data[content_start:content_end])
+            return 200, ''
+        if method == 'PUT' and op == 'MKDIRS':
+            if not os.path.isdir(host_path):
+                os.makedirs(host_path)
+            return 200, ''
+        return 400, 'unsupported file op'
+
+##
@@ -0,0 +1,230 @@
+__author__ = 'justin_cinkelj'
+
+import unittest
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+from time import time
+import requests.exceptions
+from osv import aio
+from osv import settings
+from osv.ready import ReadyTimeout
+from osv.api import ApiBatchError, ApiResponseError
+from test.fake_osv import FakeOsv
+
+
+class TestLoop(unittest.TestCase):
+    def test_return_value(self):
+        def add(aa, bb):
+            yield aio.sleep(0)
+            raise aio.Return(aa + bb)
+
+        def outer():
+            xx = yield add(1, 2)
+            yy = yield add(xx, 3)
+            raise aio.Return(yy)
+        self.assertEqual(6, aio.run(outer()))
+
+    def test_sleep_concurrent(self):
+        def sleeper(tt, out):
+            yield aio.sleep(tt)
+            out.append(tt)
+
+        out = []
+        t0 = time()
+        aio.run(aio.wait_all([aio.spawn(sleeper(tt, out)) for tt in [0.3, 0.1, 0.2]]))
+        self.assertEqual([0.1, 0.2, 0.3], out)
+        self.assertLess(time() - t0, 0.5)
+
+    def test_exception(self):
+        def fail():
+            yield aio.sleep(0)
+            raise ValueError('bad')
+
+        def catch():
+            try:
+                yield fail()
+            except ValueError as ex:
+                raise aio.Return(str(ex))
+        self.assertEqual('bad', aio.run(catch()))
+        tasks = [aio.spawn(fail()), aio.spawn(catch())]
+        self.assertRaises(ValueError, aio.run, aio.wait_all(tasks))
+        self.assertTrue(tasks[1].done)
+
+    def test_run_parallel(self):
+        running = [0, 0]  # current, max
+
+        def job(item):
+            running[0] += 1
+            running[1] = max(running)
+            yield aio.sleep(0.01)
+            running[0] -= 1
+            if item == 3:
+                raise ValueError(item)
+        errors = aio.run(aio.run_parallel(job, range(10), 4))
+        self.assertEqual([3], errors.keys())
+        self.assertEqual(4, running[1])
+
+
+class TestAioApi(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOsv().start()
+        self.vm = self.fake.vm()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_env(self):
+        env = dict([('var%d' % ii, 'val%d' % ii) for ii in range(50)])
+        aio.run(aio.EnvAll(self.vm).set_many(env, workers=4))
+        for name, value in env.items():
+            self.assertEqual(value, self.fake.env[name])
+        self.assertEqual('val7', aio.run(aio.Env(self.vm, 'var7').get()))
+        all_env = aio.run(aio.EnvAll(self.vm).get())
+        self.assertEqual('val7', all_env['var7'])
+        aio.run(aio.EnvAll(self.vm).delete_many(env.keys(), workers=4))
+        self.assertNotIn('var7', self.fake.env)
+        # requests reuse up to 4 keep-alive connections
+        stats = aio.http_stats(self.vm)
+        self.assertLessEqual(stats['new_connections'], 4)
+        self.assertEqual(stats['requests'], stats['new_connections'] + stats['reused_connections'])
+
+    def test_env_set_many_error(self):
+        with self.assertRaises(ApiBatchError) as cm:
+            aio.run(aio.EnvAll(self.vm).set_many({'good': 'x', 'bad': ''}))
+        self.assertEqual(['bad'], cm.exception.errors.keys())
+        self.assertIsInstance(cm.exception.errors['bad'], ApiResponseError)
+
+    def test_app_run(self):
+        aio.run(aio.App(self.vm, '/usr/bin/hello.so').run())
+        self.assertEqual(['/usr/bin/hello.so'], self.fake.apps)
+
+    def test_many_vms(self):
+        fakes = [FakeOsv(latency=0.05).start() for ii in range(20)]
+        try:
+            vms = [fake.vm() for fake in fakes]
+
+            def setup(vm):
+                yield aio.Env(vm, 'RANK').set(str(vms.index(vm)))
+                yield aio.App(vm, '/app.so').run()
+            t0 = time()
+            aio.run(aio.wait_all([aio.spawn(setup(vm)) for vm in vms]))
+            # 20 VMs x 3 requests (wait_up, env, app), in about 3 x latency
+            self.assertLess(time() - t0, 1.0)
+            self.assertEqual('5', fakes[5].env['RANK'])
+            self.assertEqual(['/app.so'], fakes[19].apps)
+        finally:
+            for fake in fakes:
+                fake.stop()
+
+    def test_file(self):
+        root = tempfile.mkdtemp()
+        try:
+            fake = FakeOsv(file_root=root).start()
+            vm = fake.vm()
+            src = os.path.join(root, 'src.bin')
+            data = ''.join([chr(ii % 256) for ii in range(300 * 1000)])
+            open(src, 'wb').write(data)
+            self.assertEqual(len(data), aio.run(aio.File(vm).put_file(src, '/up.bin')))
+            self.assertEqual(data, open(os.path.join(root, 'up.bin'), 'rb').read())
+            self.assertEqual(data, aio.run(aio.File(vm)._get_file('/up.bin')))
+            dest = os.path.join(root, 'down.bin')
+            self.assertEqual(len(data), aio.run(aio.File(vm)._get_file('/up.bin', dest)))
+            self.assertEqual(data, open(dest, 'rb').read())
+            names = [entry['pathSuffix'] for entry in aio.run(aio.File(vm)._list_dir('/'))]
+            self.assertIn('up.bin', names)
+            fake.stop()
+        finally:
+            shutil.rmtree(root)
+
+    def test_get_dir(self):
+        root = tempfile.mkdtemp()
+        try:
+            fake = FakeOsv(file_root=os.path.join(root, 'vm')).start()
+            vm = fake.vm()
+            os.makedirs(os.path.join(root, 'vm/data/sub'))
+            open(os.path.join(root, 'vm/data/a.txt'), 'w').write('aaa')
+            open(os.path.join(root, 'vm/data/sub/b.txt'), 'w').write('bb')
+            dest = os.path.join(root, 'host')
+            stats = aio.run(aio.File(vm).get_dir('/data', dest, workers=2))
+            self.assertEqual((2, 2, 0, 5), (stats['dirs'], stats['files'], stats['skipped'], stats['bytes']))
+            self.assertEqual('aaa', open(os.path.join(dest, 'a.txt')).read())
+            self.assertEqual('bb', open(os.path.join(dest, 'sub/b.txt')).read())
+            self.assertEqual(['b.txt'], os.listdir(os.path.join(dest, 'sub')))
+            # same size files are skipped, changed size is downloaded again
+            open(os.path.join(root, 'vm/data/a.txt'), 'w').write('aaaa')
+            stats = aio.run(aio.File(vm).get_dir('/data', dest, workers=2))
+            self.assertEqual((2, 1, 4), (stats['files'], stats['skipped'], stats['bytes']))
+            self.assertEqual('aaaa', open(os.path.join(dest, 'a.txt')).read())
+            fake.stop()
+        finally:
+            shutil.rmtree(root)
+
+    def test_put_dir(self):
+        root = tempfile.mkdtemp()
+        try:
+            fake = FakeOsv(file_root=os.path.join(root, 'vm')).start()
+            vm = fake.vm()
+            src = os.path.join(root, 'host')
+            os.makedirs(os.path.join(src, 'sub'))
+            open(os.path.join(src, 'a.txt'), 'w').write('aaa')
+            open(os.path.join(src, 'sub/b.txt'), 'w').write('bb')
+            stats = aio.run(aio.File(vm).put_dir(src, '/data', workers=2))
+            self.assertEqual((2, 2, 0, 5), (stats['dirs'], stats['files'], stats['skipped'], stats['bytes']))
+            self.assertEqual('aaa', open(os.path.join(root, 'vm/data/a.txt')).read())
+            self.assertEqual('bb', open(os.path.join(root, 'vm/data/sub/b.txt')).read())
+            open(os.path.join(src, 'sub/b.txt'), 'w').write('bbb')
+            stats = aio.run(aio.File(vm).put_dir(src, '/data', workers=2))
+            self.assertEqual((2, 1, 3), (stats['files'], stats['skipped'], stats['bytes']))
+            self.assertEqual('bbb', open(os.path.join(root, 'vm/data/sub/b.txt')).read())
+            fake.stop()
+        finally:
+            shutil.rmtree(root)
+
+    def test_read_timeout(self):
+        self.fake.latency = 0.5
+        api = aio.Env(self.vm, 'var1')
+        self.vm._api_up = True
+        self.assertRaises(requests.exceptions.ReadTimeout, aio.run, api._request('GET', '/env/', timeout=(1, 0.1)))
+
+    def test_wait_up_timeout(self):
+        # REST api accepts connections, but never answers in time
+        self.fake.latency = 1.0
+        timeout = settings.OSV_API_READY_TIMEOUT
+        settings.OSV_API_READY_TIMEOUT = 0.3
+        try:
+            t0 = time()
+            with self.assertRaises(ReadyTimeout) as cm:
+                aio.run(aio.Env(self.vm, 'var1').get())
+            self.assertLess(time() - t0, 0.8)
+        finally:
+            settings.OSV_API_READY_TIMEOUT = timeout
+        self.assertEqual(['api'], cm.exception.pending)
+        self.assertIn('timed out', cm.exception.errors['api'])
+        self.assertFalse(self.vm._api_up)
+
+    def test_wait_up_ip(self):
+        # IP is not known yet (e.g. DHCP VM still booting)
+        self.vm._ip = None
+
+        def set_ip():
+            yield aio.sleep(0.2)
+            self.vm._ip = '127.0.0.1'
+        aio.spawn(set_ip())
+        t0 = time()
+        aio.run(aio.BaseApi(self.vm).wait_up())
+        self.assertTrue(self.vm._api_up)
+        self.assertAlmostEqual(0.2, time() - t0, delta=0.1)
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.vm._api_port = sock.getsockname()[1]
+        sock.close()
+        self.vm._api_up = True
+        api = aio.Env(self.vm, 'var1')
+        self.assertRaises(requests.exceptions.ConnectionError, aio.run, api.set('x'))
+
+##
@@ -3,12 +3,17 @@ __author__ = 'justin_cinkelj'
 import unittest
 from osv import VM, VMParam
 from osv import EnvAll, Env, App
-from osv.api import env_var_split, ApiResponseError
+from osv.api import File
+from osv.api import env_var_split, ApiResponseError, ApiBatchError, http_stats
+from test.fake_osv import FakeOsv
 
 from osv.settings import OSV_BRIDGE, OSV_CLI_APP, OSV_SRC
 from time import sleep
 import os
 import os.path
+import shutil
+import tempfile
+import filecmp
 
 
 class TestInternal(unittest.TestCase):
@@ -19,6 +24,151 @@ class TestInternal(unittest.TestCase):
         self.assertEqual('ttrt', vv)
 
 
+class TestEnvMany(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOsv().start()
+        self.vm = self.fake.vm()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_set_many(self):
+        env = dict([('var%d' % ii, 'val%d' % ii) for ii in range(50)])
+        EnvAll(self.vm).set_many(env, workers=4)
+        for name, value in env.items():
+            self.assertEqual(value, self.fake.env[name])
+        EnvAll(self.vm).delete_many(env.keys(), workers=4)
+        for name in env.keys():
+            self.assertFalse(name in self.fake.env)
+
+    def test_set_many_error(self):
+        # empty value is rejected
+        try:
+            EnvAll(self.vm).set_many({'var1': 'aa', 'var2': '', 'var3': ''})
+            self.assertTrue(False)
+        except ApiBatchError as ex:
+            self.assertEqual(['var2', 'var3'], sorted(ex.errors.keys()))
+            self.assertEqual(400, ex.errors['var2'].response.status_code)
+        self.assertEqual('aa', self.fake.env['var1'])
+
+
+class TestFileGetDir(unittest.TestCase):
+    def setUp(self):
+        self.vm_root = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        # VM filesystem
+        for dir_name in ['dev', 'proc', 'case/0', 'case/constant/polyMesh', 'case/system']:
+            os.makedirs(os.path.join(self.vm_root, dir_name))
+        open(os.path.join(self.vm_root, 'dev/random'), 'w').write('not downloaded')
+        open(os.path.join(self.vm_root, 'case/0/U'), 'w').write('dimensions [0 1 -1 0 0 0 0];\n')
+        open(os.path.join(self.vm_root, 'case/system/controlDict'), 'w').write('endTime 0.5;\r\n')
+        # binary, larger than a few chunks
+        open(os.path.join(self.vm_root, 'case/constant/polyMesh/points'), 'wb').write(
+            ''.join([chr(ii % 256) for ii in range(3 * File.CHUNK_SIZE + 17)]))
+        for ii in range(50):
+            open(os.path.join(self.vm_root, 'case/0/p%02d' % ii), 'w').write('p' * ii)
+        self.fake = FakeOsv(file_root=self.vm_root).start()
+        self.vm = self.fake.vm()
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.vm_root)
+        shutil.rmtree(self.dest)
+
+    def assertSameTree(self, dir1, dir2):
+        cmp = filecmp.dircmp(dir1, dir2)
+        self.assertEqual([], cmp.left_only + cmp.right_only + cmp.diff_files + cmp.funny_files)
+        for sub_dir in cmp.common_dirs:
+            self.assertSameTree(os.path.join(dir1, sub_dir), os.path.join(dir2, sub_dir))
+
+    def test_get_dir(self):
+        dest = os.path.join(self.dest, 'case')
+        stats = File(self.vm).get_dir('/case', dest, workers=4)
+        self.assertSameTree(os.path.join(self.vm_root, 'case'), dest)
+        self.assertEqual(53, stats['files'])
+        self.assertEqual(0, stats['skipped'])
+        self.assertEqual(5, stats['dirs'])
+        # second download skips all files
+        stats = File(self.vm).get_dir('/case', dest, workers=4)
+        self.assertEqual(53, stats['skipped'])
+        self.assertEqual(0, stats['bytes'])
+        # changed file is downloaded again
+        open(os.path.join(dest, '0/U'), 'w').write('x')
+        stats = File(self.vm).get_dir('/case', dest, workers=4)
+        self.assertEqual(52, stats['skipped'])
+        self.assertSameTree(os.path.join(self.vm_root, 'case'), dest)
+
+    def test_get_root(self):
+        dest = os.path.join(self.dest, 'root')
+        File(self.vm).get_dir('/', dest)
+        # /dev and /proc are only created
+        self.assertEqual([], os.listdir(os.path.join(dest, 'dev')))
+        self.assertEqual([], os.listdir(os.path.join(dest, 'proc')))
+        self.assertSameTree(os.path.join(self.vm_root, 'case'), os.path.join(dest, 'case'))
+
+    def test_get_file(self):
+        content = File(self.vm)._get_file('/case/system/controlDict')
+        self.assertEqual('endTime 0.5;\r\n', content)
+
+    def test_get_file_missing(self):
+        dest = os.path.join(self.dest, 'missing')
+        try:
+            File(self.vm)._get_file('/case/no-such-file', dest)
+            self.assertTrue(False)
+        except ApiResponseError as ex:
+            self.assertEqual(404, ex.response.status_code)
+            # streamed response is closed, connection is not left checked out
+            self.assertTrue(ex.response.raw.closed)
+        self.assertFalse(os.path.exists(dest + '.part'))
+
+    def test_get_dir_error(self):
+        try:
+            File(self.vm).get_dir('/no-such-dir', os.path.join(self.dest, 'xx'))
+            self.assertTrue(False)
+        except ApiBatchError as ex:
+            self.assertEqual(['/no-such-dir'], ex.errors.keys())
+
+
+class TestFilePutDir(unittest.TestCase):
+    def setUp(self):
+        self.vm_root = tempfile.mkdtemp()
+        self.src = tempfile.mkdtemp()
+        for dir_name in ['0', 'constant/polyMesh', 'system', 'empty']:
+            os.makedirs(os.path.join(self.src, dir_name))
+        open(os.path.join(self.src, 'system/controlDict'), 'w').write('endTime 0.5;\r\n')
+        open(os.path.join(self.src, 'constant/polyMesh/points'), 'wb').write(
+            ''.join([chr(ii % 256) for ii in range(3 * File.CHUNK_SIZE + 17)]))
+        for ii in range(50):
+            open(os.path.join(self.src, '0/p%02d' % ii), 'w').write('p' * ii)
+        self.fake = FakeOsv(file_root=self.vm_root).start()
+        self.vm = self.fake.vm()
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.vm_root)
+        shutil.rmtree(self.src)
+
+    def test_put_file(self):
+        src = os.path.join(self.src, 'constant/polyMesh/points')
+        nbytes = File(self.vm).put_file(src, '/points')
+        self.assertEqual(os.path.getsize(src), nbytes)
+        self.assertTrue(filecmp.cmp(src, os.path.join(self.vm_root, 'points'), shallow=False))
+
+    def test_put_dir(self):
+        stats = File(self.vm).put_dir(self.src, '/case/run1', workers=4)
+        self.assertEqual(52, stats['files'])
+        self.assertEqual(0, stats['skipped'])
+        self.assertEqual(6, stats['dirs'])
+        self.assertTrue(os.path.isdir(os.path.join(self.vm_root, 'case/run1/empty')))
+        cmp = filecmp.dircmp(self.src, os.path.join(self.vm_root, 'case/run1'))
+        self.assertEqual([], cmp.left_only + cmp.right_only + cmp.diff_files)
+        # second upload skips all files, changed file is uploaded again
+        open(os.path.join(self.src, 'system/controlDict'), 'w').write('endTime 10.0;\r\n')
+        stats = File(self.vm).put_dir(self.src, '/case/run1', workers=4)
+        self.assertEqual(51, stats['skipped'])
+        self.assertEqual('endTime 10.0;\r\n', open(os.path.join(self.vm_root, 'case/run1/system/controlDict')).read())
+
+
 class TestApi(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -61,6 +211,15 @@ class TestApi(unittest.TestCase):
         except ApiResponseError as ex:
             self.assertEquals(ex.response.status_code, 400)
 
+    def test_http_session(self):
+        # all API objects of VM share one keep-alive connection
+        stats0 = http_stats(self.vm)
+        for ii in range(10):
+            Env(self.vm, 'var_session').set(ii)
+        stats1 = http_stats(self.vm)
+        self.assertEqual(10, stats1['requests'] - stats0['requests'])
+        self.assertEqual(10, stats1['reused_connections'] - stats0['reused_connections'])
+
     def test_app(self):
         # app_cli = App(self.vm, '/bin/cli.so')  # vm.terminate cannot send 'exit' any more
         # app_cli.run()
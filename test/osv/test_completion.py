@@ -0,0 +1,111 @@
+import unittest
+import os.path
+import shutil
+import tempfile
+import threading
+from time import time
+from osv import completion
+from osv.completion import AppCompletion
+from test.fake_osv import FakeOsv
+
+EXIT_PATTERN = r'^app exited with status (-?\d+)'
+
+
+class FakeDomain:
+    def __init__(self):
+        self.active = True
+
+    def name(self):
+        return 'osv-completion'
+
+    def isActive(self):
+        return self.active
+
+
+class TestAppCompletion(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.fake = FakeOsv().start()
+        self.vm = self.fake.vm()
+        self.vm._vm = FakeDomain()
+        self.vm._console_log = os.path.join(self.work_dir, 'console.log')
+        open(self.vm._console_log, 'w').close()
+        self.vm._open_console()
+
+    def tearDown(self):
+        self.vm._close_console()
+        self.fake.stop()
+        shutil.rmtree(self.work_dir)
+
+    def console_write(self, data):
+        with open(self.vm._console_log, 'a') as fout:
+            fout.write(data)
+
+    def later(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_run_returns_tid(self):
+        tid = self.vm.app_api('/usr/lib/app.so').run()
+        self.assertEqual({tid: '/usr/lib/app.so'}, self.fake.threads)
+        self.assertIn(tid, [th['id'] for th in self.vm.os_api().threads()])
+
+    def test_marker(self):
+        tid = self.vm.app_api('/usr/lib/app.so').run()
+        done = AppCompletion(self.vm, tid, poll_interval=5, pattern=EXIT_PATTERN)
+        self.later(0.1, self.console_write, 'hello\napp exited with status 3\n')
+        t0 = time()
+        self.assertTrue(done.wait(timeout=5))
+        # console marker, not the REST poll
+        self.assertLess(time() - t0, 1)
+        self.assertEqual(completion.MARKER, done.reason)
+        self.assertEqual(3, done.status)
+
+    def test_thread_gone(self):
+        tid = self.vm.app_api('/usr/lib/app.so').run()
+        done = AppCompletion(self.vm, tid, poll_interval=0.05)
+        self.later(0.2, self.fake.finish_app, tid)
+        self.console_write('app output\n')
+        out_path = os.path.join(self.work_dir, 'out')
+        with open(out_path, 'w') as fout:
+            self.assertTrue(done.wait(timeout=5, out_fd=fout.fileno()))
+        self.assertEqual(completion.THREAD_GONE, done.reason)
+        self.assertIsNone(done.status)
+        self.assertEqual('app output\n', open(out_path).read())
+
+    def test_vm_down(self):
+        done = AppCompletion(self.vm, None)
+        self.vm._vm.active = False
+        self.assertTrue(done.wait(timeout=5))
+        self.assertEqual(completion.VM_DOWN, done.reason)
+
+    def test_api_error(self):
+        tid = self.vm.app_api('/usr/lib/app.so').run()
+        handle = self.fake.handle
+
+        def handle_error(method, path, params, data):
+            if path == '/os/threads':
+                return 500, 'internal error'
+            return handle(method, path, params, data)
+        self.fake.handle = handle_error
+        done = AppCompletion(self.vm, tid, poll_interval=0.05)
+        # thread state is unknown while REST api fails, VM going down ends the wait
+        self.assertFalse(done.wait(timeout=0.2))
+        self.vm._vm.active = False
+        self.assertTrue(done.wait(timeout=5))
+        self.assertEqual(completion.VM_DOWN, done.reason)
+
+    def test_timeout(self):
+        tid = self.vm.app_api('/usr/lib/app.so').run()
+        done = AppCompletion(self.vm, tid, poll_interval=0.05, pattern=EXIT_PATTERN)
+        t0 = time()
+        self.assertFalse(done.wait(timeout=0.3))
+        self.assertAlmostEqual(0.3, time() - t0, delta=0.1)
+        self.assertIsNone(done.reason)
+        # marker is still matched by next wait
+        self.console_write('app exited with status 0\n')
+        self.assertTrue(done.wait(timeout=1))
+        self.assertEqual(0, done.status)
+
+##
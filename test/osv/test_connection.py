@@ -0,0 +1,41 @@
+import unittest
+from osv import connection
+
+# libvirt test driver, no libvirtd required
+TEST_URI = 'test:///default'
+
+
+class TestConnection(unittest.TestCase):
+    def tearDown(self):
+        connection.close_all()
+
+    def test_reuse(self):
+        stats0 = connection.stats()
+        conn1 = connection.get(TEST_URI)
+        conn2 = connection.get(TEST_URI)
+        self.assertTrue(conn1 is conn2)
+        stats1 = connection.stats()
+        self.assertEqual(1, stats1['opened'] - stats0['opened'])
+        self.assertEqual(1, stats1['reused'] - stats0['reused'])
+
+    def test_reconnect(self):
+        stats0 = connection.stats()
+        conn1 = connection.get(TEST_URI)
+        conn1.close()
+        conn2 = connection.get(TEST_URI)
+        self.assertFalse(conn1 is conn2)
+        self.assertEqual(1, conn2.isAlive())
+        self.assertEqual(1, connection.stats()['reconnected'] - stats0['reconnected'])
+
+    def test_call(self):
+        # test:///default has one running domain, named 'test'
+        dom = connection.call(lambda conn: conn.lookupByName('test'), TEST_URI)
+        self.assertEqual('test', dom.name())
+
+    def test_close_all(self):
+        conn1 = connection.get(TEST_URI)
+        connection.close_all()
+        conn2 = connection.get(TEST_URI)
+        self.assertFalse(conn1 is conn2)
+
+##
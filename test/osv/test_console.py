@@ -0,0 +1,321 @@
+import unittest
+import tempfile
+import threading
+import os
+import os.path
+import shutil
+import resource
+from time import sleep, time
+from osv import VM
+import osv.vm
+from osv.vm import CMD_PROMPT_PATTERN, IP_PATTERN
+from osv.console import ConsoleWatcher, ConsoleScanner, ConsoleStream, STREAM
+from test import fake_libvirt
+
+BOOT_LOG = os.path.join(os.path.dirname(__file__), '../data/osv-boot-console.log')
+
+
+class TestConsoleWatcher(unittest.TestCase):
+    def setUp(self):
+        self.log_file = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        self.log_file.close()
+
+    # append to log file after delay, return time of write
+    def _append_later(self, delay):
+        write_time = [0]
+
+        def append():
+            sleep(delay)
+            write_time[0] = time()
+            with open(self.log_file.name, 'a') as fout:
+                fout.write('OSv v0.24\r\n')
+        th = threading.Thread(target=append)
+        th.start()
+        return th, write_time
+
+    def test_timeout(self):
+        watcher = ConsoleWatcher(self.log_file.name)
+        self.assertTrue(watcher.uses_inotify())
+        t0 = time()
+        self.assertFalse(watcher.wait(0.2))
+        self.assertTrue(time() - t0 >= 0.2)
+        watcher.close()
+
+    def test_notify_latency(self):
+        watcher = ConsoleWatcher(self.log_file.name)
+        th, write_time = self._append_later(0.2)
+        self.assertTrue(watcher.wait(5))
+        latency = time() - write_time[0]
+        th.join()
+        # polling with 0.1 s step would add up to 100 ms
+        self.assertTrue(latency < 0.01, 'time-to-notify %f s' % latency)
+        # event was consumed
+        self.assertFalse(watcher.wait(0))
+        watcher.close()
+
+    def test_poll_fallback(self):
+        watcher = ConsoleWatcher(self.log_file.name, use_inotify=False)
+        self.assertFalse(watcher.uses_inotify())
+        t0 = time()
+        self.assertTrue(watcher.wait(5, poll_interval=0.05))
+        self.assertTrue(time() - t0 < 1)
+        watcher.close()
+
+
+class TestConsoleScanner(unittest.TestCase):
+    def setUp(self):
+        self.found = {}
+        self.scanner = ConsoleScanner()
+        self.scanner.add_matcher('cmd_prompt', CMD_PROMPT_PATTERN, self._on_match('cmd_prompt'), once=True, partial=True)
+        self.scanner.add_matcher('ip', IP_PATTERN, self._on_match('ip'), once=True)
+
+    def _on_match(self, name):
+        def callback(match):
+            self.assertFalse(name in self.found)
+            self.found[name] = match.group(match.lastindex or 0)
+        return callback
+
+    def test_boot_log(self):
+        data = open(BOOT_LOG).read()
+        # any split of data into chunks
+        for chunk_size in range(1, 64) + [len(data)]:
+            self.setUp()
+            for ii in range(0, len(data), chunk_size):
+                self.scanner.feed(data[ii:ii+chunk_size])
+            self.assertEqual('192.168.122.76', self.found['ip'])
+            self.assertTrue('cmd_prompt' in self.found)
+            self.assertFalse(self.scanner.has_matchers())
+
+    def test_split_line(self):
+        self.scanner.feed('eth0: ethernet address: 52:54:00:12:34:56\r\neth0: 192.16')
+        self.assertFalse('ip' in self.found)
+        self.scanner.feed('8.122.3\r\n')
+        self.assertEqual('192.168.122.3', self.found['ip'])
+
+    def test_custom_matcher(self):
+        lines = []
+        self.scanner.add_matcher('time', r'^Time = (\S+)$', lambda mm: lines.append(mm.group(1)))
+        self.scanner.feed('Time = 0.1\r\nCourant Number mean: 0.2\r\nTime = 0.')
+        self.scanner.feed('2\r\n')
+        self.assertEqual(['0.1', '0.2'], lines)
+        self.scanner.remove_matcher('time')
+        self.scanner.feed('Time = 0.3\r\n')
+        self.assertEqual(['0.1', '0.2'], lines)
+
+    def test_long_line(self):
+        lines = []
+        self.scanner.add_matcher('all', r'^', lambda mm: lines.append(1))
+        for ii in range(100):
+            self.scanner.feed('x' * 4096)
+        self.assertTrue(len(self.scanner._partial) <= ConsoleScanner.MAX_LINE)
+        # long line was matched in MAX_LINE pieces
+        self.assertTrue(len(lines) >= 100 * 4096 / (2 * ConsoleScanner.MAX_LINE))
+
+
+class TestReadStd(unittest.TestCase):
+    def test_read_std(self):
+        vm = VM()
+        vm._console_log_fd = open(BOOT_LOG)
+        out = vm.read_std()
+        self.assertEqual(open(BOOT_LOG).read(), out)
+        self.assertEqual('192.168.122.76', vm._ip)
+        self.assertTrue(vm._child_cmdline_up)
+        vm._console_log_fd.close()
+
+    def test_read_appended(self):
+        # data appended after reader hit end of file is returned by next read
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, 'console.log')
+            open(path, 'w').close()
+            vm = VM()
+            vm._console_log_fd = open(path)
+            self.assertEqual('', vm.read_std())
+            with open(path, 'a') as fout:
+                fout.write('eth0: 192.168.122.76\r\n')
+            self.assertEqual('eth0: 192.168.122.76\r\n', vm.read_std())
+            self.assertEqual('192.168.122.76', vm._ip)
+            vm._console_log_fd.close()
+        finally:
+            shutil.rmtree(work_dir)
+
+class TestForwardStd(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'console.log')
+        shutil.copy(BOOT_LOG, self.path)
+        self.vm = VM()
+        self.vm._console_log_fd = open(self.path)
+        self.out_path = os.path.join(self.work_dir, 'out')
+        self.sent = []
+        self._sendfile = osv.vm.sendfile
+
+        def sendfile(out_fd, in_fd, offset, count):
+            self.sent.append(count)
+            return self._sendfile(out_fd, in_fd, offset, count)
+        osv.vm.sendfile = sendfile
+
+    def tearDown(self):
+        osv.vm.sendfile = self._sendfile
+        self.vm._console_log_fd.close()
+        shutil.rmtree(self.work_dir)
+
+    def append(self, data):
+        with open(self.path, 'a') as fout:
+            fout.write(data)
+
+    def test_forward(self):
+        with open(self.out_path, 'w') as fout:
+            # boot output is scanned for IP and cmd prompt
+            self.assertEqual(os.path.getsize(BOOT_LOG), self.vm.forward_std(fout.fileno()))
+            self.assertEqual('192.168.122.76', self.vm._ip)
+            self.assertTrue(self.vm._child_cmdline_up)
+            self.assertEqual([], self.sent)
+            self.assertEqual(0, self.vm.forward_std(fout.fileno()))
+            # no matcher is left, app output is moved by sendfile in chunks
+            app_out = 'x' * 1023 + '\n'
+            self.append(app_out * 1024)
+            self.assertEqual(1024 * 1024, self.vm.forward_std(fout.fileno()))
+            self.assertTrue(len(self.sent) >= 1024 * 1024 / osv.vm.settings.OSV_CONSOLE_CHUNK)
+        self.assertEqual(open(BOOT_LOG).read() + app_out * 1024, open(self.out_path).read())
+
+    def test_forward_static_ip(self):
+        # static IP and non-cli app, IP and cmd prompt are never printed, matchers are dropped anyway
+        vm = VM(command='/usr/lib/app.so')
+        vm._ip = '192.168.122.10'
+        vm._console_log_fd = self.vm._console_log_fd
+        with open(self.out_path, 'w') as fout:
+            self.assertEqual(os.path.getsize(BOOT_LOG), vm.forward_std(fout.fileno()))
+        # moved by sendfile, not scanned
+        self.assertTrue(len(self.sent) >= 1)
+        self.assertEqual('192.168.122.10', vm._ip)
+
+    def test_forward_append(self):
+        # sendfile fails on O_APPEND output, data is copied via python then
+        self.vm.forward_std(None)
+        self.append('app output\n')
+        with open(self.out_path, 'a') as fout:
+            self.assertEqual(11, self.vm.forward_std(fout.fileno()))
+        self.assertFalse(self.vm._sendfile_ok)
+        self.assertEqual('app output\n', open(self.out_path).read())
+
+    def test_matcher_after_skip(self):
+        self.vm.forward_std(None)
+        self.append('line start')
+        self.vm.forward_std(None)
+        lines = []
+        self.vm.add_console_matcher('done', r'^done (\d+)', lambda mm: lines.append(mm.group(1)))
+        # rest of skipped line is not matched
+        self.append(' done 1\ndone 2\n')
+        self.vm.forward_std(None)
+        self.assertEqual(['2'], lines)
+
+    def test_memory_bounded(self):
+        # console output much larger than chunk is scanned without reading it all at once
+        self.vm.forward_std(None)
+        self.vm.add_console_matcher('never', r'^no such line', lambda mm: None)
+        line = 'y' * 1023 + '\n'
+        with open(self.path, 'a') as fout:
+            for ii in range(64):
+                fout.write(line * 1024)
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with open(os.devnull, 'w') as fout:
+            self.assertEqual(64 * 1024 * 1024, self.vm.forward_std(fout.fileno()))
+        # ru_maxrss is in KB
+        self.assertLess(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0, 16 * 1024)
+
+PTY_DOMAIN_XML = """<domain><name>%s</name><devices>
+<console type='pty'><target type='serial' port='0'/></console>
+</devices></domain>"""
+
+
+class TestConsoleStream(unittest.TestCase):
+    def setUp(self):
+        fake_libvirt.start_event_loop()
+        self.work_dir = tempfile.mkdtemp()
+        self.conn = fake_libvirt.open('fake:///test')
+        self.dom = self.conn.defineXML(PTY_DOMAIN_XML % 'osv-stream')
+        self.dom.createWithFlags(fake_libvirt.VIR_DOMAIN_START_PAUSED)
+        self.vm = VM()
+        self.vm._vm = self.dom
+        self.vm._console_mode = STREAM
+        self.vm._console_log = os.path.join(self.work_dir, 'console.log')
+        self._saved = osv.vm.settings.OSV_CONSOLE_CAPTURE
+        self._get = osv.vm.connection.get
+        osv.vm.connection.get = lambda: self.conn
+
+    def tearDown(self):
+        osv.vm.connection.get = self._get
+        osv.vm.settings.OSV_CONSOLE_CAPTURE = self._saved
+        self.vm._close_console()
+        if self.dom._active:
+            self.dom.destroy()
+        shutil.rmtree(self.work_dir)
+
+    def read_until(self, text, timeout=5):
+        out = ''
+        deadline = time() + timeout
+        while text not in out and time() < deadline:
+            self.vm.wait_console(deadline - time())
+            out += self.vm.read_std()
+        return out
+
+    def test_boot(self):
+        osv.vm.settings.OSV_CONSOLE_CAPTURE = False
+        self.vm._open_console()
+        self.dom.resume()
+        out = self.vm.wait_up(timeout=5)
+        self.assertEqual(open(BOOT_LOG).read(), out)
+        self.assertEqual('192.168.122.76', self.vm._ip)
+        # nothing written to work dir
+        self.assertEqual([], os.listdir(self.work_dir))
+
+    def test_forward_capture(self):
+        osv.vm.settings.OSV_CONSOLE_CAPTURE = True
+        self.vm._open_console()
+        self.dom.resume()
+        self.vm.wait_up(timeout=5)
+        self.dom._console_write('app output\n')
+        out_path = os.path.join(self.work_dir, 'out')
+        with open(out_path, 'w') as fout:
+            deadline = time() + 5
+            while not self.vm.forward_std(fout.fileno()) and time() < deadline:
+                self.vm.wait_console(deadline - time())
+        self.assertEqual('app output\n', open(out_path).read())
+        self.vm._close_console()
+        self.assertEqual(open(BOOT_LOG).read() + 'app output\n', open(self.vm._console_log).read())
+
+    def test_paused_when_full(self):
+        stream = ConsoleStream(self.conn, self.dom, 1000)
+        try:
+            for ii in range(10):
+                self.dom._console_write(str(ii) * 500)
+            deadline = time() + 5
+            while not stream._paused and time() < deadline:
+                sleep(0.01)
+            self.assertTrue(stream._paused)
+            self.assertTrue(stream.pending())
+            # stream is read again after reader caught up
+            out = ''
+            while len(out) < 5000 and time() < deadline:
+                out += stream.read(300)
+                sleep(0.01)
+            self.assertEqual(''.join([str(ii) * 500 for ii in range(10)]), out)
+            self.assertFalse(stream._paused)
+        finally:
+            stream.close()
+
+    def test_hangup(self):
+        self.vm._open_console()
+        self.dom.resume()
+        self.read_until('/# ')
+        t0 = time()
+        self.dom.destroy()
+        self.vm.wait_console(5)
+        self.assertLess(time() - t0, 1)
+        self.assertTrue(self.vm._console_stream.hangup())
+        self.assertEqual('', self.vm.read_std())
+
+##
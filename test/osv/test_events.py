@@ -0,0 +1,104 @@
+import unittest
+import select
+import threading
+from time import sleep, time
+import libvirt
+from osv import events
+from osv.events import DomainState, STARTED, STOPPED, CRASHED, SHUTDOWN
+
+
+# libvirt domain stub, callback only needs name()
+class StubDomain:
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+
+class TestDomainState(unittest.TestCase):
+    def test_wait_timeout(self):
+        dom_state = DomainState(STARTED)
+        t0 = time()
+        self.assertFalse(dom_state.wait([STOPPED], 0.2))
+        self.assertTrue(time() - t0 >= 0.2)
+        self.assertTrue(dom_state.wait([STARTED], 0.2))
+        dom_state.close()
+
+    def test_wait_latency(self):
+        dom_state = DomainState(STARTED)
+        set_time = [0]
+
+        def stop_later():
+            sleep(0.2)
+            set_time[0] = time()
+            dom_state.set(STOPPED)
+        th = threading.Thread(target=stop_later)
+        th.start()
+        self.assertTrue(dom_state.wait([STOPPED, CRASHED], 5))
+        latency = time() - set_time[0]
+        th.join()
+        self.assertTrue(latency < 0.01, 'stop detected after %f s' % latency)
+        dom_state.close()
+
+    def test_fileno(self):
+        dom_state = DomainState()
+        rr, ww, xx = select.select([dom_state], [], [], 0)
+        self.assertEqual([], rr)
+        dom_state.set(STARTED)
+        rr, ww, xx = select.select([dom_state], [], [], 0)
+        self.assertEqual([dom_state], rr)
+        dom_state.drain()
+        rr, ww, xx = select.select([dom_state], [], [], 0)
+        self.assertEqual([], rr)
+        dom_state.close()
+
+
+class TestLifecycleCallback(unittest.TestCase):
+    def test_callback(self):
+        dom = StubDomain('osv-000000001')
+        dom_state = events.watch(dom.name())
+        events._lifecycle_cb(None, dom, libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        self.assertEqual(STARTED, dom_state.state)
+        events._lifecycle_cb(None, dom, libvirt.VIR_DOMAIN_EVENT_SHUTDOWN, 0, None)
+        self.assertEqual(SHUTDOWN, dom_state.state)
+        events._lifecycle_cb(None, dom, libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+        self.assertEqual(STOPPED, dom_state.state)
+        events._lifecycle_cb(None, dom, libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                             libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED, None)
+        self.assertEqual(CRASHED, dom_state.state)
+        # other events and other domains are ignored
+        events._lifecycle_cb(None, dom, libvirt.VIR_DOMAIN_EVENT_DEFINED, 0, None)
+        events._lifecycle_cb(None, StubDomain('osv-000000002'), libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        self.assertEqual(CRASHED, dom_state.state)
+        events.unwatch(dom.name())
+
+    def test_unwatch_race(self):
+        dom = StubDomain('osv-000000003')
+        # event delivered after unwatch closed the state is ignored
+        dom_state = events.watch(dom.name())
+        events.unwatch(dom.name())
+        dom_state.set(STOPPED)
+        self.assertEqual(None, dom_state.state)
+        # event thread delivers events while domain is watched and unwatched
+        errors = []
+        stop = threading.Event()
+
+        def deliver():
+            while not stop.is_set():
+                try:
+                    events._lifecycle_cb(None, dom, libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+                except Exception as ex:
+                    errors.append(ex)
+        th = threading.Thread(target=deliver)
+        th.start()
+        try:
+            for ii in range(2000):
+                events.watch(dom.name())
+                events.unwatch(dom.name())
+        finally:
+            stop.set()
+            th.join()
+        self.assertEqual([], errors)
+
+##
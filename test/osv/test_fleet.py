@@ -0,0 +1,130 @@
+import unittest
+import threading
+from time import sleep, time
+from osv.fleet import Fleet, FleetError
+
+
+class FakeVM:
+    """
+    VM with launch stages which only sleep.
+    """
+    lock = threading.Lock()
+    running = {}  # stage: currently running count
+    max_running = {}
+
+    def __init__(self, delay=0.1, fail_stage='', name=''):
+        self.delay = delay
+        self.fail_stage = fail_stage
+        self.name = name
+        self.up = False
+        self.terminated = False
+        self._stage('create')
+
+    def _stage(self, stage):
+        with self.lock:
+            self.running[stage] = self.running.get(stage, 0) + 1
+            self.max_running[stage] = max(self.max_running.get(stage, 0), self.running[stage])
+        sleep(self.delay)
+        with self.lock:
+            self.running[stage] -= 1
+        if stage == self.fail_stage:
+            raise RuntimeError('%s failed' % stage)
+
+    def edit_image(self):
+        self._stage('edit_image')
+
+    def start(self):
+        self._stage('start')
+        self.up = True
+
+    def wait_up(self, Td=5, Td2=0.1):
+        self._stage('wait_up')
+
+    def is_up(self):
+        return self.up and not self.terminated
+
+    def terminate(self):
+        sleep(self.delay)
+        self.terminated = True
+
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        FakeVM.running.clear()
+        FakeVM.max_running.clear()
+
+    def test_pipeline(self):
+        specs = [dict(delay=0.1, name='vm%d' % ii) for ii in range(8)]
+        fleet = Fleet(specs, vm_factory=FakeVM, workers=8)
+        t0 = time()
+        vms = fleet.start()
+        # 4 stages x 0.1 s per VM, 3.2 s if sequential
+        self.assertLess(time() - t0, 1.0)
+        self.assertEqual(['vm%d' % ii for ii in range(8)], [vm.name for vm in vms])
+        self.assertTrue(all([vm.is_up() for vm in vms]))
+        self.assertAlmostEqual(3.2, fleet.stats['sum_vm_seconds'], delta=0.5)
+
+        t0 = time()
+        fleet.terminate()
+        self.assertLess(time() - t0, 0.5)
+        self.assertTrue(all([vm.terminated for vm in vms]))
+        self.assertEqual([None] * 8, fleet.vms)
+
+    def test_stage_workers(self):
+        specs = [dict(delay=0.05) for ii in range(6)]
+        Fleet(specs, vm_factory=FakeVM, workers={'create': 1, 'start': 2}).start()
+        self.assertEqual(1, FakeVM.max_running['create'])
+        self.assertLessEqual(FakeVM.max_running['start'], 2)
+
+    def test_launch_yields_ready_first(self):
+        specs = [dict(delay=0.3), dict(delay=0.01), dict(delay=0.1)]
+        order = [index for index, vm in Fleet(specs, vm_factory=FakeVM, workers=3).launch()]
+        self.assertEqual([1, 2, 0], order)
+
+    def test_rollback(self):
+        specs = [dict(delay=0.01), dict(delay=0.01, fail_stage='start'), dict(delay=0.01, fail_stage='create')]
+        created = []
+
+        def factory(**kwargs):
+            created.append(FakeVM(**kwargs))
+            return created[-1]
+        fleet = Fleet(specs, vm_factory=factory)
+        ready = []
+        with self.assertRaises(FleetError) as cm:
+            for index, vm in fleet.launch():
+                ready.append(index)
+        self.assertEqual([0], ready)
+        self.assertEqual([1, 2], sorted(cm.exception.errors.keys()))
+        self.assertIsNone(fleet.vms[1])
+        self.assertFalse(fleet.vms[0].terminated)
+        self.assertEqual(2, fleet.stats['failed'])
+        # VM failed in start is terminated, VM failed in create was never created
+        self.assertEqual(2, len(created))
+        self.assertTrue([vm for vm in created if vm.fail_stage == 'start'][0].terminated)
+        fleet.terminate()
+        self.assertTrue([vm for vm in created if not vm.fail_stage][0].terminated)
+
+    def test_stop_early(self):
+        specs = [dict(delay=0.01)] + [dict(delay=0.1) for ii in range(4)]
+        created = []
+
+        def factory(**kwargs):
+            created.append(FakeVM(**kwargs))
+            return created[-1]
+        fleet = Fleet(specs, vm_factory=factory, workers=2)
+        launch = fleet.launch()
+        index, vm = next(launch)
+        launch.close()
+        # members are out of stages when close returns, nothing is created later
+        created_count = len(created)
+        sleep(0.5)
+        self.assertEqual(created_count, len(created))
+        # VMs not yielded yet (still in stages, or ready) are terminated, yielded VM is left to caller
+        self.assertEqual(0, index)
+        self.assertFalse(vm.terminated)
+        self.assertEqual([vm], [vm1 for vm1 in created if not vm1.terminated])
+        self.assertEqual([vm, None, None, None, None], fleet.vms)
+        fleet.terminate()
+        self.assertTrue(vm.terminated)
+
+##
@@ -0,0 +1,129 @@
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+import simplejson
+from osv import settings
+from osv import connection
+from osv import imagecache
+from osv import VMParam
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.orig = dict([(name, getattr(settings, name)) for name in
+                          ['OSV_WORK_DIR', 'OSV_IMAGE_CACHE_DIR', 'OSV_IMAGE_CACHE_SIZE', 'OSV_QEMU_IMG']])
+        settings.OSV_WORK_DIR = self.work_dir
+        settings.OSV_IMAGE_CACHE_DIR = ''
+        settings.OSV_IMAGE_CACHE_SIZE = 2  # MB
+        self.orig_active_domains = connection.active_domains
+        connection.active_domains = lambda: set()
+        self.image = os.path.join(self.work_dir, 'usr.img')
+        self.write_image('a')
+        self.configured = []
+
+    def tearDown(self):
+        for name, value in self.orig.items():
+            setattr(settings, name, value)
+        connection.active_domains = self.orig_active_domains
+        shutil.rmtree(self.work_dir)
+
+    def write_image(self, fill):
+        with open(self.image, 'wb') as fout:
+            fout.write(fill * 700 * 1024)
+
+    def configure(self, path):
+        # as imgedit.py setargs
+        self.configured.append(path)
+        with open(path, 'ab') as fout:
+            fout.write('cmdline')
+
+    def acquire(self, command_line, owner):
+        return imagecache.acquire(self.image, command_line, owner, self.configure)
+
+    def cached_keys(self):
+        return set([name[:-len('.img')] for name in os.listdir(imagecache.cache_dir()) if name.endswith('.img')])
+
+    def test_hit_miss(self):
+        path, key, hit = self.acquire('/cli/cli.so', 'vm1')
+        self.assertFalse(hit)
+        self.assertEqual(1, len(self.configured))
+        self.assertTrue(open(path).read().endswith('cmdline'))
+        self.assertEqual((path, key, True), self.acquire('/cli/cli.so', 'vm2'))
+        self.assertEqual(1, len(self.configured))
+        stats = imagecache.stats()
+        self.assertEqual((1, 1, 0, 1), (stats['hits'], stats['misses'], stats['evictions'], stats['entries']))
+        self.assertEqual(os.path.getsize(path), stats['bytes'])
+        self.assertEqual(2 * 1024 * 1024, stats['budget'])
+
+    def test_key(self):
+        path1, key1, hit = self.acquire('/cli/cli.so', 'vm1')
+        path2, key2, hit = self.acquire('/usr/lib/app.so', 'vm2')
+        self.assertFalse(hit)
+        self.assertNotEqual(key1, key2)
+        # same command line, different image content
+        self.write_image('b')
+        path3, key3, hit = self.acquire('/cli/cli.so', 'vm3')
+        self.assertFalse(hit)
+        self.assertNotEqual(key1, key3)
+        self.assertEqual(3, len(self.configured))
+
+    def test_lru(self):
+        # budget fits two images
+        key_a = self.acquire('a', 'vm1')[1]
+        key_b = self.acquire('b', 'vm2')[1]
+        imagecache.release(key_a, 'vm1')
+        imagecache.release(key_b, 'vm2')
+        # a is used again, so b is least recently used
+        imagecache.release(self.acquire('a', 'vm3')[1], 'vm3')
+        key_c = self.acquire('c', 'vm4')[1]
+        self.assertEqual(set([key_a, key_c]), self.cached_keys())
+        self.assertEqual(1, imagecache.stats()['evictions'])
+
+    def test_used_not_evicted(self):
+        keys = [self.acquire(name, 'vm-' + name)[1] for name in ['a', 'b', 'c']]
+        # over budget, but all are backing files of running VMs
+        self.assertEqual(set(keys), self.cached_keys())
+        imagecache.release(keys[1], 'vm-b')
+        self.assertEqual(set([keys[0], keys[2]]), self.cached_keys())
+
+    def test_dead_user(self):
+        keys = [self.acquire(name, 'vm-' + name)[1] for name in ['a', 'b']]
+        index_path = os.path.join(imagecache.cache_dir(), 'index.json')
+        data = simplejson.load(open(index_path))
+        # owner process is dead, and its VM is not running
+        data['entries'][keys[0]]['users'] = {'vm-a': 999999999}
+        simplejson.dump(data, open(index_path, 'w'))
+        key_c = self.acquire('c', 'vm-c')[1]
+        self.assertEqual(set([keys[1], key_c]), self.cached_keys())
+
+    def test_configure_error(self):
+        def configure(path):
+            raise RuntimeError('imgedit failed')
+        self.assertRaises(RuntimeError, imagecache.acquire, self.image, 'a', 'vm1', configure)
+        self.assertEqual(set(), self.cached_keys())
+        self.assertEqual([], [name for name in os.listdir(imagecache.cache_dir()) if name.endswith('.tmp')])
+
+    def test_vm_param(self):
+        # qemu-img which only creates the overlay file
+        qemu_img = os.path.join(self.work_dir, 'qemu-img')
+        with open(qemu_img, 'w') as fout:
+            fout.write('#!/bin/sh\nfor last; do true; done\necho overlay > "$last"\n')
+        os.chmod(qemu_img, 0755)
+        settings.OSV_QEMU_IMG = qemu_img
+        param = VMParam(image=self.image, use_image_copy=True, image_cache=True)
+        # image is not copied until command line is known
+        self.assertFalse(os.path.exists(param._in_use_image))
+        param._build_run_command()
+        self.assertFalse(param.use_cached_image(self.configure))
+        self.assertTrue(os.path.exists(param._in_use_image))
+        if param._image_backing_file:
+            self.assertEqual(imagecache.cache_dir(), os.path.dirname(param._image_backing_file))
+        param.remove_image_copy()
+        self.assertFalse(os.path.exists(param._in_use_image))
+        data = simplejson.load(open(os.path.join(imagecache.cache_dir(), 'index.json')))
+        self.assertEqual({}, data['entries'].values()[0]['users'])
+
+##
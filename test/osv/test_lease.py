@@ -0,0 +1,123 @@
+import unittest
+import shutil
+import tempfile
+import multiprocessing
+from osv import settings
+from osv import lease
+from osv import connection
+from osv import VMParam
+from osv.lease import LeasePool, LeaseError
+
+
+def _acquire_many(count, queue):
+    queue.put([lease.acquire_ip('vm')[0] for ii in range(count)])
+
+
+class TestLease(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.orig = dict([(name, getattr(settings, name)) for name in
+                          ['OSV_WORK_DIR', 'OSV_IP_SUBNET', 'OSV_IP_MASK', 'OSV_IP_MIN', 'OSV_IP_MAX']])
+        settings.OSV_WORK_DIR = self.work_dir
+        self.orig_active_domains = connection.active_domains
+        connection.active_domains = lambda: set()
+
+    def tearDown(self):
+        for name, value in self.orig.items():
+            setattr(settings, name, value)
+        connection.active_domains = self.orig_active_domains
+        shutil.rmtree(self.work_dir)
+
+    def test_ip_range(self):
+        first_ip, count = lease.ip_range()
+        self.assertEqual('192.168.122.200', str(first_ip))
+        self.assertEqual(51, count)
+        settings.OSV_IP_SUBNET = '10.1.0.0'
+        settings.OSV_IP_MASK = 16
+        settings.OSV_IP_MIN = 256
+        settings.OSV_IP_MAX = 511
+        self.assertEqual(('10.1.1.0', 256), (str(lease.ip_range()[0]), lease.ip_range()[1]))
+        # broadcast address is not valid
+        settings.OSV_IP_MAX = 65535
+        self.assertRaises(ValueError, lease.ip_range)
+        # subnet not aligned with mask
+        settings.OSV_IP_SUBNET = '10.1.2.0'
+        self.assertRaises(ValueError, lease.ip_network)
+
+    def test_format_mac(self):
+        self.assertEqual('52:54:00:4f:12:34', lease.format_mac('52:54:00:4f', 0x1234))
+        self.assertEqual('52:54:00:00:01:02', lease.format_mac('52:54:00', 0x102))
+
+    def test_acquire_release(self):
+        pool = LeasePool(self.work_dir + '/test.json', 4)
+        self.assertEqual([0, 1, 2], [pool.acquire('vm%d' % ii) for ii in range(3)])
+        pool.release(1)
+        # released index is not reused before the others
+        self.assertEqual(3, pool.acquire('vm3'))
+        self.assertEqual(1, pool.acquire('vm4'))
+        self.assertRaises(LeaseError, pool.acquire, 'vm5')
+        # release by other VM is ignored
+        pool.release(0, 'vm3')
+        self.assertRaises(LeaseError, pool.acquire, 'vm5')
+        pool.release(0, 'vm0')
+        self.assertEqual(0, pool.acquire('vm5'))
+        self.assertEqual(['vm5', 'vm4', 'vm2', 'vm3'], [ll['vm_name'] for ii, ll in sorted(pool.leases().items())])
+
+    def test_acquire_index(self):
+        pool = LeasePool(self.work_dir + '/test.json', 4)
+        self.assertEqual(2, pool.acquire('vm0', 2))
+        self.assertRaises(LeaseError, pool.acquire, 'vm1', 2)
+        self.assertRaises(LeaseError, pool.acquire, 'vm1', 4)
+        self.assertEqual(3, pool.acquire('vm1'))
+        self.assertEqual({2: 'vm0', 3: 'vm1'}, dict([(ii, ll['vm_name']) for ii, ll in pool.leases().items()]))
+
+    def test_large_pool(self):
+        pool = LeasePool(self.work_dir + '/test.json', 1 << 16)
+        indices = [pool.acquire() for ii in range(100)]
+        self.assertEqual(range(100), indices)
+
+    def test_expire(self):
+        pool = LeasePool(self.work_dir + '/test.json', 4)
+        index = pool.acquire('osv-1')
+        # owner process is gone, VM is still running
+        with open(pool.path) as fin:
+            content = fin.read()
+        with open(pool.path, 'w') as fout:
+            fout.write(content.replace('"pid": %d' % __import__('os').getpid(), '"pid": 999999'))
+        connection.active_domains = lambda: set(['osv-1'])
+        self.assertEqual([index], pool.leases().keys())
+        connection.active_domains = lambda: set()
+        self.assertEqual({}, pool.leases())
+
+    def test_concurrent(self):
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_acquire_many, args=(10, queue)) for ii in range(5)]
+        for proc in procs:
+            proc.start()
+        ips = sum([queue.get(timeout=10) for proc in procs], [])
+        for proc in procs:
+            proc.join()
+        self.assertEqual(50, len(set(ips)))
+
+    def test_vm_param(self):
+        vmp = VMParam(net_ip='lease', net_mac='lease')
+        self.assertEqual('192.168.122.200/24', vmp._net_ip)
+        self.assertEqual('52:54:00:4f:00:00', vmp._net_mac)
+        self.assertEqual(VMParam.NET_STATIC, vmp._net_mode)
+        self.assertEqual(1, len(lease.pool(lease.IP).leases()))
+        vmp.release_leases()
+        self.assertEqual({}, lease.pool(lease.IP).leases())
+        self.assertEqual({}, lease.pool(lease.MAC).leases())
+
+    def test_adopt_leases(self):
+        vmp1 = VMParam(net_ip='lease', net_mac='lease')
+        vmp2 = VMParam(net_ip='lease', net_mac='lease')
+        self.assertFalse(vmp2.adopt_leases({lease.IP: 0, lease.MAC: 0}))
+        self.assertEqual('192.168.122.201/24', vmp2._net_ip)
+        vmp1.release_leases()
+        self.assertTrue(vmp2.adopt_leases({lease.IP: 0, lease.MAC: 0}))
+        self.assertEqual(('192.168.122.200/24', '52:54:00:4f:00:00'), (vmp2._net_ip, vmp2._net_mac))
+        self.assertEqual([0], lease.pool(lease.IP).leases().keys())
+        self.assertEqual([0], lease.pool(lease.MAC).leases().keys())
+
+##
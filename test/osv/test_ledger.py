@@ -0,0 +1,155 @@
+import unittest
+import shutil
+import tempfile
+import multiprocessing
+import random
+from time import sleep, time
+from osv import settings
+from osv import ledger
+from osv import connection
+from osv.ledger import LedgerFull
+
+
+def _hold(cpus, memory, seconds, queue=None):
+    entry_id = ledger.allocate(cpus, memory)
+    if queue:
+        queue.put(entry_id)
+    sleep(seconds)
+    ledger.release(entry_id)
+
+
+def _allocate_and_die(queue, vm_name=''):
+    entry_id = ledger.allocate(4, 1000)
+    if vm_name:
+        ledger.attach(entry_id, vm_name)
+    queue.put(entry_id)
+
+
+def _stress_worker(seed, rounds, held_cpus, held_memory, max_seen, lock):
+    rnd = random.Random(seed)
+    for ii in range(rounds):
+        cpus = rnd.randint(1, 4)
+        memory = rnd.randint(100, 3000)
+        entry_id = ledger.allocate(cpus, memory, poll_interval=0.01)
+        with lock:
+            held_cpus.value += cpus
+            held_memory.value += memory
+            max_seen[0] = max(max_seen[0], held_cpus.value)
+            max_seen[1] = max(max_seen[1], held_memory.value)
+        sleep(rnd.uniform(0, 0.01))
+        with lock:
+            held_cpus.value -= cpus
+            held_memory.value -= memory
+        ledger.release(entry_id)
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.orig = dict([(name, getattr(settings, name)) for name in
+                          ['OSV_WORK_DIR', 'OSV_LEDGER_CPUS', 'OSV_LEDGER_MEMORY', 'OSV_LEDGER_POLICY',
+                           'OSV_LEDGER_TIMEOUT']])
+        settings.OSV_WORK_DIR = self.work_dir
+        settings.OSV_LEDGER_CPUS = 8
+        settings.OSV_LEDGER_MEMORY = 8000
+        settings.OSV_LEDGER_POLICY = ledger.QUEUE
+        settings.OSV_LEDGER_TIMEOUT = 10
+        self.orig_active_domains = connection.active_domains
+
+    def tearDown(self):
+        for name, value in self.orig.items():
+            setattr(settings, name, value)
+        connection.active_domains = self.orig_active_domains
+        shutil.rmtree(self.work_dir)
+
+    def test_allocate_release(self):
+        aa = ledger.allocate(4, 4000)
+        bb = ledger.allocate(4, 2000)
+        self.assertEqual({'cpus': 8, 'memory': 6000, 'capacity_cpus': 8, 'capacity_memory': 8000,
+                          'entries': 2, 'waiting': 0}, ledger.usage())
+        self.assertRaises(LedgerFull, ledger.allocate, 1, 100, policy=ledger.FAIL)
+        ledger.release(aa)
+        ledger.allocate(2, 6000, policy=ledger.FAIL)
+        # memory is full
+        self.assertRaises(LedgerFull, ledger.allocate, 1, 100, policy=ledger.FAIL)
+        ledger.release(bb)
+        self.assertEqual(2, ledger.usage()['cpus'])
+
+    def test_host_capacity(self):
+        settings.OSV_LEDGER_CPUS = 0
+        settings.OSV_LEDGER_MEMORY = 0
+        cpus, memory = ledger.host_size()
+        self.assertTrue(cpus >= 1 and memory > 0)
+        # read once
+        self.assertTrue(ledger.host_size() is ledger.host_size())
+        self.assertEqual((cpus, int(memory * settings.OSV_LEDGER_MEMORY_RATIO)), ledger.capacity())
+
+    def test_too_large(self):
+        self.assertRaises(LedgerFull, ledger.allocate, 9, 100)
+        self.assertRaises(LedgerFull, ledger.allocate, 1, 9000)
+
+    def test_queue(self):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_hold, args=(8, 1000, 0.5, queue))
+        proc.start()
+        queue.get(timeout=10)
+        t0 = time()
+        entry_id = ledger.allocate(2, 1000)
+        self.assertGreater(time() - t0, 0.3)
+        proc.join()
+        ledger.release(entry_id)
+        # queue timeout
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_hold, args=(8, 1000, 1.0, queue))
+        proc.start()
+        queue.get(timeout=10)
+        self.assertRaises(LedgerFull, ledger.allocate, 2, 1000, timeout=0.2)
+        self.assertEqual(0, ledger.usage()['waiting'])
+        proc.join()
+
+    def test_reclaim_dead_process(self):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_allocate_and_die, args=(queue,))
+        proc.start()
+        queue.get(timeout=10)
+        proc.join()
+        self.assertEqual(0, ledger.usage()['entries'])
+
+    def test_reclaim_vm(self):
+        connection.active_domains = lambda: set(['osv-1'])
+        for vm_name in ['osv-1', 'osv-2']:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_allocate_and_die, args=(queue, vm_name))
+            proc.start()
+            queue.get(timeout=10)
+            proc.join()
+        # owners are dead, osv-2 is not running any more, osv-1 is kept
+        self.assertEqual(1, ledger.usage()['entries'])
+        # inactive domain of live owner (e.g. VM being saved to snapshot) is kept
+        cc = ledger.allocate(2, 1000)
+        ledger.attach(cc, 'osv-3')
+        connection.active_domains = lambda: set()
+        self.assertEqual(1, ledger.usage()['entries'])
+        ledger.release(cc)
+        self.assertEqual(0, ledger.usage()['entries'])
+
+    def test_stress(self):
+        held_cpus = multiprocessing.Value('i', 0)
+        held_memory = multiprocessing.Value('i', 0)
+        max_seen = multiprocessing.Array('i', [0, 0])
+        lock = multiprocessing.Lock()
+        procs = [multiprocessing.Process(target=_stress_worker,
+                                         args=(ii, 20, held_cpus, held_memory, max_seen, lock))
+                 for ii in range(12)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        self.assertEqual([0] * len(procs), [proc.exitcode for proc in procs])
+        self.assertLessEqual(max_seen[0], 8)
+        self.assertLessEqual(max_seen[1], 8000)
+        self.assertGreater(max_seen[0], 4)  # VMs did run concurrently
+        self.assertEqual({'cpus': 0, 'memory': 0, 'capacity_cpus': 8, 'capacity_memory': 8000,
+                          'entries': 0, 'waiting': 0}, ledger.usage())
+
+##
@@ -0,0 +1,164 @@
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+import multiprocessing
+from osv import settings
+from osv import placement
+from osv.placement import Topology, Placement, PlacementError, place, parse_cpulist, format_cpulist
+from osv.statefile import StateFile
+
+
+def make_sysfs(root, nodes, threads=2, memory_kb=8 * 1024 * 1024, memory_only_nodes=()):
+    """
+    Fake sysfs. nodes - list of cpu lists, one per node (and socket).
+    Hyperthread siblings are cpu N and N + (number of cores), as on Intel hosts.
+    """
+    cpu_dir = os.path.join(root, 'devices/system/cpu')
+    all_cpus = sum(nodes, [])
+    cores = len(all_cpus) / threads
+    os.makedirs(cpu_dir)
+    open(os.path.join(cpu_dir, 'online'), 'w').write(format_cpulist(all_cpus) + '\n')
+    for node, cpus in enumerate(nodes):
+        for cpu in cpus:
+            topo_dir = os.path.join(cpu_dir, 'cpu%d/topology' % cpu)
+            os.makedirs(topo_dir)
+            open(os.path.join(topo_dir, 'physical_package_id'), 'w').write('%d\n' % node)
+            open(os.path.join(topo_dir, 'core_id'), 'w').write('%d\n' % (cpu % cores))
+        node_dir = os.path.join(root, 'devices/system/node/node%d' % node)
+        os.makedirs(node_dir)
+        open(os.path.join(node_dir, 'cpulist'), 'w').write(format_cpulist(cpus) + '\n')
+        open(os.path.join(node_dir, 'meminfo'), 'w').write('Node %d MemTotal:       %d kB\n' % (node, memory_kb))
+    for node in memory_only_nodes:
+        node_dir = os.path.join(root, 'devices/system/node/node%d' % node)
+        os.makedirs(node_dir)
+        open(os.path.join(node_dir, 'cpulist'), 'w').write('\n')
+
+
+class TestCpuList(unittest.TestCase):
+    def test_parse_format(self):
+        self.assertEqual([0, 1, 2, 3, 8, 10, 11], parse_cpulist('0-3,8,10-11\n'))
+        self.assertEqual([], parse_cpulist(''))
+        self.assertEqual('0-3,8,10-11', format_cpulist([11, 10, 8, 3, 2, 1, 0]))
+        self.assertEqual('5', format_cpulist([5]))
+
+
+class TestTopology(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_two_sockets_ht(self):
+        # 2 sockets x 4 cores x 2 threads, siblings are N and N+8
+        make_sysfs(self.root, [[0, 1, 2, 3, 8, 9, 10, 11], [4, 5, 6, 7, 12, 13, 14, 15]],
+                   memory_only_nodes=[2])
+        topo = Topology.read(self.root)
+        self.assertEqual([0, 1], sorted(topo.nodes.keys()))
+        # siblings are adjacent
+        self.assertEqual([0, 8, 1, 9, 2, 10, 3, 11], topo.nodes[0])
+        self.assertEqual(8192, topo.node_memory[1])
+        self.assertEqual(16, topo.cpu_count())
+
+    def test_no_numa(self):
+        make_sysfs(self.root, [[0, 1, 2, 3]], threads=1)
+        shutil.rmtree(os.path.join(self.root, 'devices/system/node'))
+        topo = Topology.read(self.root)
+        self.assertEqual({0: [0, 1, 2, 3]}, topo.nodes)
+
+
+class TestPlace(unittest.TestCase):
+    def setUp(self):
+        self.topo = Topology({0: [0, 8, 1, 9, 2, 10, 3, 11], 1: [4, 12, 5, 13, 6, 14, 7, 15]})
+
+    def test_single_node(self):
+        pl = place(self.topo, 4, 1024)
+        self.assertEqual([(0, [0, 8, 1, 9], 1024)], pl.cells)
+        param = pl.template_param()
+        self.assertEqual('0-1,8-9', param['cpuset'])
+        self.assertEqual([(0, 0), (1, 8), (2, 1), (3, 9)], param['vcpupin'])
+        self.assertEqual('0', param['nodeset'])
+        self.assertEqual({'sockets': 1, 'cores': 4, 'threads': 1}, param['topology'])
+
+    def test_best_fit(self):
+        used = [0, 8, 1, 9, 2, 10]  # node 0 has 2 free cpus, node 1 has 8
+        self.assertEqual(0, place(self.topo, 2, 512, used).cells[0][0])
+        self.assertEqual(1, place(self.topo, 3, 512, used).cells[0][0])
+
+    def test_span_nodes(self):
+        used = [0, 8, 1, 9]
+        pl = place(self.topo, 10, 1000, used)
+        self.assertEqual([1, 0], pl.nodes())
+        self.assertEqual(10, len(pl.pcpus()))
+        self.assertEqual([800, 200], [memory for node, pcpus, memory in pl.cells])
+        param = pl.template_param()
+        self.assertEqual(['0-7', '8-9'], [cell['vcpus'] for cell in param['cells']])
+        self.assertIsNone(param['topology'])
+
+    def test_full(self):
+        self.assertRaises(PlacementError, place, self.topo, 10, 512, range(8))
+
+    def test_node_memory(self):
+        topo = Topology(self.topo.nodes, {0: 1000, 1: 4000})
+        used = [0, 8, 1, 9, 2, 10]  # node 0 is best fit for 2 cpus, but has not enough memory
+        self.assertEqual(0, place(topo, 2, 1000, used).cells[0][0])
+        self.assertEqual(1, place(topo, 2, 2000, used).cells[0][0])
+        self.assertEqual(1, place(topo, 2, 1000, used, {0: 500}).cells[0][0])
+        # spanned VM memory is moved from full node
+        pl = place(topo, 10, 3000, [])
+        self.assertEqual([(0, 1000), (1, 2000)], [(node, memory) for node, pcpus, memory in pl.cells])
+        pl = place(topo, 10, 1100, [], {1: 3800})
+        self.assertEqual([(0, 900), (1, 200)], [(node, memory) for node, pcpus, memory in pl.cells])
+        self.assertRaises(PlacementError, place, topo, 10, 1300, [], {1: 3800})
+
+
+def _reserve_in_child(name, queue):
+    pl = placement.reserve(name, 2, 512, Topology({0: range(8)}))
+    queue.put(pl.pcpus())
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.orig_work_dir = settings.OSV_WORK_DIR
+        settings.OSV_WORK_DIR = self.work_dir
+        self.topo = Topology({0: range(8)})
+
+    def tearDown(self):
+        settings.OSV_WORK_DIR = self.orig_work_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_disjoint(self):
+        pls = [placement.reserve('vm%d' % ii, 2, 512, self.topo) for ii in range(4)]
+        cpus = sum([pl.pcpus() for pl in pls], [])
+        self.assertEqual(range(8), sorted(cpus))
+        self.assertRaises(PlacementError, placement.reserve, 'vm4', 1, 512, self.topo)
+        placement.release('vm1')
+        self.assertEqual(pls[1].pcpus(), placement.reserve('vm5', 2, 512, self.topo).pcpus())
+
+    def test_memory(self):
+        topo = Topology({0: range(4), 1: range(4, 8)}, {0: 1000, 1: 1000})
+        self.assertEqual([0], placement.reserve('vm0', 1, 800, topo).nodes())
+        # node 0 has free cpus, but not memory
+        self.assertEqual([1], placement.reserve('vm1', 1, 800, topo).nodes())
+        self.assertRaises(PlacementError, placement.reserve, 'vm2', 1, 800, topo)
+        placement.release('vm0')
+        self.assertEqual([0], placement.reserve('vm3', 1, 800, topo).nodes())
+
+    def test_concurrent_processes(self):
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_reserve_in_child, args=('vm%d' % ii, queue)) for ii in range(4)]
+        for proc in procs:
+            proc.start()
+        cpus = sum([queue.get(timeout=10) for proc in procs], [])
+        for proc in procs:
+            proc.join()
+        self.assertEqual(range(8), sorted(cpus))
+        # child processes are gone, their cpus are free again
+        self.assertEqual(8, len(placement.reserve('vm', 8, 512, self.topo).pcpus()))
+        with StateFile(placement.registry_path()) as state:
+            self.assertEqual(['vm'], state.data.keys())
+
+##
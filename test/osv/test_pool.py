@@ -0,0 +1,115 @@
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+import osv.vm
+import osv.pool
+from osv import settings
+from osv import connection
+from osv import placement
+from osv import lease
+from osv import imagecache
+from osv.statefile import StateFile
+from osv.pool import VMPool, claim, release, pool_dir, CLAIMED, DONE, _write_record, _records
+from test import fake_libvirt
+
+
+class TestPool(unittest.TestCase):
+    def test_claim_release(self):
+        vm_pool = VMPool(1, lambda: dict(debug=True, use_image_copy=True, net_mac='rand'))
+        vm_pool.refill()
+        for th in vm_pool._threads:
+            th.join()
+        self.assertEqual(1, vm_pool.ready_count())
+        # size does not match
+        self.assertEqual(None, claim(2, 512))
+        vm = claim(1, 512)
+        self.assertTrue(vm)
+        self.assertTrue(vm.is_up())
+        self.assertEqual(0, vm_pool.ready_count())
+        self.assertEqual(None, claim(1, 512))
+        vm.env_api('var_pool').set('pool_value')
+        self.assertEqual('pool_value', vm.env_api('var_pool').get())
+        image = vm._param._in_use_image
+        release(vm)
+        self.assertEqual(1, len(os.listdir(pool_dir(DONE))))
+        vm_pool.destroy_released()
+        self.assertEqual(0, len(os.listdir(pool_dir(DONE))))
+        self.assertEqual(0, len(os.listdir(pool_dir(CLAIMED))))
+        self.assertFalse(os.path.exists(image))
+        vm_pool.shutdown()
+
+
+class TestPoolPlacement(unittest.TestCase):
+    def setUp(self):
+        fake_libvirt.start_event_loop()
+        self.work_dir = tempfile.mkdtemp()
+        self.orig_work_dir = settings.OSV_WORK_DIR
+        settings.OSV_WORK_DIR = self.work_dir
+        self.conn = fake_libvirt.open('fake:///test')
+        self.orig_get = connection.get
+        connection.get = lambda uri=None: self.conn
+        self.orig_libvirt = osv.vm.libvirt
+        osv.vm.libvirt = osv.pool.libvirt = connection.libvirt = fake_libvirt
+
+    def tearDown(self):
+        connection.get = self.orig_get
+        osv.vm.libvirt = osv.pool.libvirt = connection.libvirt = self.orig_libvirt
+        settings.OSV_WORK_DIR = self.orig_work_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_destroy_releases_placement(self):
+        vm_pool = VMPool(0, dict)
+        image = os.path.join(self.work_dir, 'pool-usr.img')
+        for name, defined in [('osv-pool-1', True), ('osv-pool-2', False)]:
+            pl = placement.reserve(name, 2, 512, placement.Topology({0: range(8)}))
+            if defined:
+                self.conn.defineXML("<domain><name>%s</name><devices><console type='file'>"
+                                    "<source path='%s'/></console></devices></domain>" % (name, os.devnull))
+            open(image, 'w').close()
+            _write_record(DONE, {'name': name, 'ip': '', 'image_orig': image + '.orig', 'image': image,
+                                 'console_log': os.devnull, 'placement': pl.cells})
+        vm_pool.destroy_released()
+        self.assertEqual([], _records(DONE))
+        with StateFile(placement.registry_path()) as state:
+            self.assertEqual({}, state.data)
+
+    def test_destroy_crashed_vm(self):
+        vm_pool = VMPool(0, dict)
+        name = 'osv-pool-3'
+        image_orig = os.path.join(self.work_dir, 'usr.img')
+        open(image_orig, 'w').write('image')
+        image = os.path.join(self.work_dir, 'pool-usr.img')
+        open(image, 'w').close()
+        ip, ip_index = lease.acquire_ip(name)
+        mac, mac_index = lease.acquire_mac(name)
+        path, key, hit = imagecache.acquire(image_orig, 'cmd', name, lambda path: None)
+        # domain is gone, record is all that is left
+        _write_record(CLAIMED, {'name': name, 'ip': ip, 'image_orig': image_orig, 'image': image,
+                                'image_cache_key': key, 'leases': [[lease.IP, ip_index], [lease.MAC, mac_index]],
+                                'console_log': os.devnull})
+        vm_pool.destroy_released()
+        self.assertEqual([], _records(CLAIMED))
+        self.assertFalse(os.path.exists(image))
+        self.assertEqual({}, lease.pool(lease.IP).leases())
+        self.assertEqual({}, lease.pool(lease.MAC).leases())
+        with StateFile(os.path.join(imagecache.cache_dir(), 'index.json')) as state:
+            self.assertEqual({}, state.data['entries'][key]['users'])
+
+    def test_destroy_claimed_vm_not_up(self):
+        vm_pool = VMPool(0, dict)
+        name = 'osv-pool-4'
+        self.conn.defineXML("<domain><name>%s</name><devices><console type='file'>"
+                            "<source path='%s'/></console></devices></domain>" % (name, os.devnull))
+        image = os.path.join(self.work_dir, 'pool-usr.img')
+        open(image, 'w').close()
+        _write_record(CLAIMED, {'name': name, 'ip': '', 'image_orig': image + '.orig', 'image': image,
+                                'console_log': os.devnull, 'claimed_pid': os.getpid()})
+        fds = len(os.listdir('/proc/self/fd'))
+        vm_pool.destroy_released()
+        self.assertEqual([], _records(CLAIMED))
+        # domain state pipes of both VM objects (destroy_released and _destroy) are closed
+        self.assertEqual(fds, len(os.listdir('/proc/self/fd')))
+
+##
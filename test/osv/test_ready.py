@@ -0,0 +1,117 @@
+import unittest
+import os.path
+import shutil
+import tempfile
+from time import time
+from osv import VM
+from osv import ready
+from osv.ready import ReadyTimeout, VMStopped
+from test.fake_osv import FakeOsv
+from test.console_replay import ConsoleReplay, boot_capture
+
+
+class FakeDomain:
+    def __init__(self):
+        self.active = True
+
+    def name(self):
+        return 'osv-ready'
+
+    def isActive(self):
+        return self.active
+
+
+class TestReady(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.vm = VM()
+        self.vm._vm = FakeDomain()
+        self.vm._console_log = os.path.join(self.work_dir, 'console.log')
+        open(self.vm._console_log, 'w').close()
+        self.vm._open_console()
+        self.replay = None
+
+    def tearDown(self):
+        if self.replay:
+            self.replay.stop()
+        self.vm._close_console()
+        shutil.rmtree(self.work_dir)
+
+    def replay_boot(self, duration, capture=None):
+        self.replay = ConsoleReplay(self.vm._console_log, capture or boot_capture(), duration).start()
+
+    def test_ready_at_boot_time(self):
+        self.replay_boot(0.3)
+        t0 = time()
+        out = self.vm.wait_up(timeout=5)
+        # ready when last console line is written, not rounded up to a poll step
+        self.assertLess(time() - t0, 0.35)
+        self.assertTrue(out.endswith('/# '))
+        self.assertEqual('192.168.122.76', self.vm._ip)
+        self.assertTrue(self.vm._child_cmdline_up)
+
+    def test_timeout(self):
+        # boot without cli prompt
+        self.replay_boot(0, boot_capture().replace('/# ', ''))
+        t0 = time()
+        with self.assertRaises(ReadyTimeout) as cm:
+            self.vm.wait_up(timeout=0.3)
+        self.assertAlmostEqual(0.3, time() - t0, delta=0.1)
+        self.assertEqual(['cmd_prompt'], cm.exception.pending)
+        self.assertIn('waiting for cmd_prompt', str(cm.exception))
+        self.assertIn('Rest API server running', cm.exception.output)
+
+    def test_vm_stopped(self):
+        self.replay_boot(0, 'OSv v0.24\r\n')
+        self.vm._vm.active = False
+        self.assertRaises(ReadyTimeout, self.vm.wait_up, 0.2)
+        self.vm._vm.active = True
+        self.vm._console_log_fd.seek(0)
+        with open(self.vm._console_log, 'a') as fout:
+            fout.write('page fault\r\n')
+        # domain goes down after it was seen active
+        orig = self.vm._is_active
+        calls = []
+
+        def is_active():
+            calls.append(1)
+            return len(calls) < 2
+        self.vm._is_active = is_active
+        t0 = time()
+        self.assertRaises(VMStopped, self.vm.wait_up, 5)
+        self.assertLess(time() - t0, 1)
+        self.vm._is_active = orig
+
+    def test_wait_ip_compat(self):
+        self.replay_boot(0.1)
+        ok, out = self.vm.wait_ip(5)
+        self.assertTrue(ok)
+        self.assertIn('eth0: 192.168.122.76', out)
+        self.vm._command = ''
+        self.vm._param._command = '/usr/lib/app.so'
+        self.assertEqual((False, ''), self.vm.wait_cmd_prompt(5))
+
+
+class TestReadyApi(unittest.TestCase):
+    def test_api(self):
+        fake = FakeOsv().start()
+        try:
+            vm = fake.vm()
+            t0 = time()
+            vm.os_api().wait_up()
+            self.assertTrue(vm._api_up)
+            self.assertLess(time() - t0, 0.1)
+        finally:
+            fake.stop()
+
+    def test_api_refused(self):
+        fake = FakeOsv()
+        vm = fake.vm()
+        fake._server.server_close()
+        with self.assertRaises(ReadyTimeout) as cm:
+            ready.wait_ready(vm, [ready.IP, ready.API], 0.3)
+        self.assertEqual(['api'], cm.exception.pending)
+        self.assertIn('api: ', str(cm.exception))
+        self.assertFalse(vm._api_up)
+
+##
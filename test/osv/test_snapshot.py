@@ -0,0 +1,162 @@
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+from time import time
+import osv.vm
+from osv import settings
+from osv import connection
+from osv import snapshot
+from osv import lease
+from osv import VM
+from osv.console import STREAM
+from test import fake_libvirt
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        fake_libvirt.start_event_loop()
+        self.work_dir = tempfile.mkdtemp()
+        self.orig = dict([(name, getattr(settings, name)) for name in
+                          ['OSV_WORK_DIR', 'OSV_SRC', 'OSV_QEMU_IMG', 'OSV_SNAPSHOT_DIR', 'OSV_SNAPSHOT_SIZE',
+                           'OSV_CONSOLE_MODE', 'OSV_TRANSIENT_DOMAIN']])
+        settings.OSV_WORK_DIR = self.work_dir
+        settings.OSV_SNAPSHOT_DIR = ''
+        settings.OSV_SNAPSHOT_SIZE = 16
+        settings.OSV_SRC = os.path.join(self.work_dir, 'osv-src')
+        os.makedirs(os.path.join(settings.OSV_SRC, 'scripts'))
+        # imgedit.py and qemu-img only record the call / create the file
+        self.imgedit_log = os.path.join(self.work_dir, 'imgedit.log')
+        self.write_script(os.path.join(settings.OSV_SRC, 'scripts/imgedit.py'),
+                          'echo "$@" >> %s\n' % self.imgedit_log)
+        settings.OSV_QEMU_IMG = os.path.join(self.work_dir, 'qemu-img')
+        self.write_script(settings.OSV_QEMU_IMG, 'for last; do true; done\necho qcow2 > "$last"\n')
+        self.image = os.path.join(self.work_dir, 'usr.img')
+        with open(self.image, 'wb') as fout:
+            fout.write('\0' * 64 * 1024)
+        self.conn = fake_libvirt.open('fake:///test')
+        self.orig_get = connection.get
+        connection.get = lambda uri=None: self.conn
+        # libvirt errors and constants of fake domains
+        self.orig_libvirt = osv.vm.libvirt
+        osv.vm.libvirt = connection.libvirt = fake_libvirt
+        self.vms = []
+
+    def tearDown(self):
+        for vm in self.vms:
+            self.terminate(vm)
+        connection.get = self.orig_get
+        osv.vm.libvirt = connection.libvirt = self.orig_libvirt
+        for name, value in self.orig.items():
+            setattr(settings, name, value)
+        shutil.rmtree(self.work_dir)
+
+    def write_script(self, path, body):
+        with open(path, 'w') as fout:
+            fout.write('#!/bin/sh\n' + body)
+        os.chmod(path, 0755)
+
+    def imgedit_calls(self):
+        if not os.path.exists(self.imgedit_log):
+            return 0
+        return len(open(self.imgedit_log).readlines())
+
+    def launch(self, **kwargs):
+        params = dict(image=self.image, use_image_copy=True, snapshot=True, net_ip='lease', net_mac='lease',
+                      memory=256)
+        params.update(kwargs)
+        vm = VM(**params)
+        self.vms.append(vm)
+        vm.run()
+        vm.wait_up(timeout=5)
+        return vm
+
+    def terminate(self, vm):
+        # no REST api to shut it down
+        if vm._vm and vm._vm._active:
+            vm._vm.destroy()
+        vm.terminate()
+        if vm in self.vms:
+            self.vms.remove(vm)
+
+    def test_save_restore(self):
+        vm1 = self.launch()
+        self.assertTrue(vm1._restored)
+        self.assertTrue(vm1.is_up())
+        self.assertEqual(1, self.imgedit_calls())
+        key = vm1._snapshot.key
+        self.assertTrue(snapshot.Snapshot(key).exists())
+        # VM image is a clone or overlay of snapshot image
+        self.assertTrue(os.path.exists(vm1._param._in_use_image))
+        ip, mac = vm1._ip, vm1._param._net_mac
+        self.terminate(vm1)
+
+        hooks = []
+        t0 = time()
+        vm2 = self.launch(restore_hook=hooks.append)
+        self.assertLess(time() - t0, 2)
+        self.assertEqual([vm2], hooks)
+        self.assertTrue(vm2._restored)
+        self.assertEqual(key, vm2._snapshot.key)
+        # leases of snapshot are taken over, imgedit.py is not run again
+        self.assertEqual((ip, mac), (vm2._ip, vm2._param._net_mac))
+        self.assertEqual(1, self.imgedit_calls())
+        self.assertEqual([0], lease.pool(lease.IP).leases().keys())
+        self.assertEqual(vm2._param._vm_name, vm2._vm.name())
+        stats = snapshot.stats()
+        self.assertEqual((1, 1, 1, 1), (stats['saves'], stats['misses'], stats['hits'], stats['entries']))
+
+    def test_used_by_other_vm(self):
+        vm1 = self.launch()
+        # snapshot MAC/IP are leased by vm1, vm2 boots and saves snapshot of its own
+        vm2 = self.launch()
+        self.assertNotEqual(vm1._snapshot.key, vm2._snapshot.key)
+        self.assertNotEqual(vm1._ip, vm2._ip)
+        self.assertEqual(2, self.imgedit_calls())
+        self.terminate(vm1)
+        vm3 = self.launch()
+        self.assertEqual(vm1._ip, vm3._ip)
+        self.assertEqual(2, self.imgedit_calls())
+        self.assertEqual(2, snapshot.stats()['entries'])
+
+    def test_family(self):
+        vm1 = self.launch()
+        family = vm1._snapshot.family
+        self.terminate(vm1)
+        # different VM size, different snapshot
+        vm2 = self.launch(memory=512)
+        self.assertEqual(2, self.imgedit_calls())
+        self.assertNotEqual(family, vm2._snapshot.family)
+        # not restored - app runs from start
+        vm3 = VM(image=self.image, use_image_copy=True, snapshot=True, command='/usr/lib/app.so')
+        self.vms.append(vm3)
+        vm3.edit_image()
+        self.assertEqual(None, vm3._snapshot)
+
+    def test_evict(self):
+        settings.OSV_SNAPSHOT_SIZE = 0
+        vm1 = self.launch()
+        key = vm1._snapshot.key
+        # VM image is backed by snapshot image, snapshot is kept while VM runs
+        self.assertTrue(snapshot.Snapshot(key).exists())
+        self.terminate(vm1)
+        self.assertFalse(snapshot.Snapshot(key).exists())
+        stats = snapshot.stats()
+        self.assertEqual((0, 1), (stats['entries'], stats['evictions']))
+
+    def test_console_stream(self):
+        settings.OSV_CONSOLE_MODE = STREAM
+        settings.OSV_TRANSIENT_DOMAIN = True
+        self.terminate(self.launch())
+        vm = self.launch()
+        self.assertTrue(vm._restored)
+        vm._vm._console_write('after restore\n')
+        out = ''
+        deadline = time() + 5
+        while not out and time() < deadline:
+            vm.wait_console(deadline - time())
+            out += vm.read_std()
+        self.assertEqual('after restore\n', out)
+
+##
@@ -0,0 +1,76 @@
+import unittest
+import os
+import shutil
+import tempfile
+from osv import settings
+from osv import trace
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.orig = dict([(name, getattr(settings, name)) for name in ['OSV_WORK_DIR', 'OSV_TRACE', 'OSV_TRACE_FILE']])
+        settings.OSV_WORK_DIR = self.work_dir
+        settings.OSV_TRACE_FILE = ''
+
+    def tearDown(self):
+        for name, value in self.orig.items():
+            setattr(settings, name, value)
+        shutil.rmtree(self.work_dir)
+
+    def test_disabled(self):
+        settings.OSV_TRACE = False
+        tr = trace.begin('lin_proxy')
+        self.assertIs(trace.NULL, tr)
+        with tr.phase('imgedit'):
+            pass
+        tr.finish()
+        self.assertFalse(os.path.exists(trace.trace_path()))
+
+    def test_record(self):
+        settings.OSV_TRACE = True
+        for ii in range(3):
+            tr = trace.begin('lin_proxy', image='usr.img')
+            with tr.phase('imgedit'):
+                pass
+            # phase with same name is summed up
+            tr.add('wait_ip', tr.record['start'], 0.5)
+            tr.add('wait_ip', tr.record['start'], 0.25)
+            tr.set(vm='osv-%d' % ii)
+            tr.finish()
+            tr.finish('error')  # only first finish writes
+        tr = trace.begin('pool')
+        try:
+            with tr.phase('libvirt_start'):
+                raise ValueError('failed')
+        except ValueError as ex:
+            tr.finish('error', error=str(ex))
+        records = trace.load()
+        self.assertEqual(4, len(records))
+        self.assertEqual(['osv-0', 'osv-1', 'osv-2'], [rec['vm'] for rec in trace.load(name='lin_proxy')])
+        self.assertEqual(['imgedit', 'wait_ip', 'wait_ip'], [ph['name'] for ph in records[0]['phases']])
+        self.assertEqual('error', records[3]['status'])
+        self.assertEqual('libvirt_start', records[3]['phases'][0]['name'])
+        times = dict(trace.phase_times(records[:3]))
+        self.assertEqual([0.75] * 3, times['wait_ip'])
+        text = trace.report(records)
+        self.assertIn('4 launches, 1 failed', text)
+        self.assertEqual(['phase', 'imgedit', 'wait_ip', 'libvirt_start', 'total'],
+                         [line.split()[0] for line in text.splitlines()[:-1]])
+
+    def test_broken_line(self):
+        settings.OSV_TRACE = True
+        trace.begin('vm').finish()
+        with open(trace.trace_path(), 'a') as fout:
+            fout.write('{"name": "vm", "pha')
+        self.assertEqual(1, len(trace.load()))
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(3, trace.percentile(values, 50))
+        self.assertEqual(1, trace.percentile(values, 0))
+        self.assertEqual(5, trace.percentile(values, 100))
+        self.assertAlmostEqual(4.6, trace.percentile(values, 90))
+        self.assertEqual(0.0, trace.percentile([], 50))
+
+##
@@ -2,7 +2,8 @@ __author__ = 'justin_cinkelj'
 
 import unittest
 from osv import VM, VMParam
-from osv.vm import cidr_to_ip_mask
+from osv.vm import cidr_to_ip_mask, domain_template, prefetch_domain_template
+from osv.placement import Placement
 
 from osv.settings import OSV_BRIDGE, OSV_CLI_APP, OSV_SRC
 from time import sleep
@@ -83,6 +84,59 @@ class TestVMParam(unittest.TestCase):
         result = "['./scripts/run.py', '--image', 'build/release/usr.img', '--memsize', '512', '-n', '-v', '-e', '--ip=eth0,1.2.3.4,255.0.0.0 --defaultgw=4.3.2.1 --nameserver=8.8.8.8 /cli/cli.so']"
         self.assertEqual(str(arg), result)
 
+
+class TestDomainXml(unittest.TestCase):
+    def test_template_cached(self):
+        self.assertTrue(domain_template() is domain_template())
+
+    def test_template_prefetch(self):
+        prefetch_domain_template()
+        # waits for template loaded by prefetch thread
+        self.assertTrue(domain_template() is domain_template())
+
+    def test_xml(self):
+        vm = VM(cpus=3, memory=777, image='/tmp/usr.img', net_mac='52:54:00:00:00:01')
+        xml = vm._domain_xml()
+        self.assertTrue('<name>%s</name>' % vm._param._vm_name in xml)
+        self.assertTrue("<memory unit='MiB'>777</memory>" in xml)
+        self.assertTrue("<vcpu placement='static'>3</vcpu>" in xml)
+        self.assertTrue("<source dev='/tmp/usr.img'/>" in xml)
+        self.assertTrue("<mac address='52:54:00:00:00:01'/>" in xml)
+        self.assertFalse('-gdb' in xml)
+
+    def test_xml_placement(self):
+        vm = VM(cpus=3, memory=777, image='/tmp/usr.img')
+        vm._placement = Placement([(1, [4, 12, 5], 777)])
+        xml = vm._domain_xml()
+        self.assertTrue("<vcpu placement='static' cpuset='4-5,12'>3</vcpu>" in xml)
+        self.assertTrue("<vcpupin vcpu='1' cpuset='12'/>" in xml)
+        self.assertTrue("<memory mode='strict' nodeset='1'/>" in xml)
+        self.assertTrue("<memnode cellid='0' mode='strict' nodeset='1'/>" in xml)
+        self.assertTrue("<topology sockets='1' cores='3' threads='1'/>" in xml)
+        self.assertTrue("<cell id='0' cpus='0-2' memory='777' unit='MiB'/>" in xml)
+
+    def test_transient(self):
+        self.assertTrue(VMParam(transient=True)._transient)
+        self.assertFalse(VMParam(transient=False)._transient)
+
+
+class TestImageOverlay(unittest.TestCase):
+    def test_overlay(self):
+        vmp = VMParam(debug=True, use_image_copy=True, image_copy_mode=VMParam.IMAGE_OVERLAY)
+        self.assertNotEqual(vmp._image_orig, vmp._in_use_image)
+        self.assertEqual(vmp._image_orig, vmp._image_backing_file)
+        self.assertTrue(os.path.getsize(vmp._in_use_image) < os.path.getsize(vmp._image_orig))
+        vmp.remove_image_copy()
+        self.assertFalse(os.path.exists(vmp._in_use_image))
+        self.assertTrue(os.path.exists(vmp._image_orig))
+
+    def test_copy(self):
+        vmp = VMParam(debug=True, use_image_copy=True, image_copy_mode=VMParam.IMAGE_COPY)
+        self.assertFalse(vmp._image_backing_file)
+        self.assertEqual(os.path.getsize(vmp._image_orig), os.path.getsize(vmp._in_use_image))
+        vmp.remove_image_copy()
+        self.assertFalse(os.path.exists(vmp._in_use_image))
+
 ## /etc/init.d/libvirt-bin restart - to reset DHCP server
 class TestVM(unittest.TestCase):
     def test_run(self, td=1):